@@ -0,0 +1,294 @@
+"""
+The `average-checkpoints` subcommand averages the weights of the last or best K checkpoints of
+a training run and evaluates the averaged model once.
+"""
+
+import argparse
+import glob
+import inspect
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import torch
+
+from allennlp.commands.subcommand import Subcommand
+from allennlp.common import Params
+from allennlp.common import logging as common_logging
+from allennlp.common.checks import ConfigurationError
+from allennlp.models.archival import CONFIG_NAME
+from allennlp.training.checkpointer import Checkpointer
+
+from allen_modules.commands.eval import evaluate_from_archive
+
+logger = logging.getLogger(__name__)
+
+
+@Subcommand.register("average-checkpoints")
+class AverageCheckpoints(Subcommand):
+    def add_subparser(self, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        description = """Average the weights of the last or best K checkpoints of a training run
+        and evaluate the averaged model once"""
+        subparser = parser.add_parser(
+            self.name,
+            description=description,
+            help="Average the last or best K checkpoints of a training run and evaluate them.",
+        )
+
+        subparser.add_argument(
+            "serialization_dir", type=str, help="the serialization directory of the training run"
+        )
+
+        subparser.add_argument(
+            "-k",
+            "--num-checkpoints",
+            type=int,
+            default=5,
+            help="number of checkpoints to average",
+        )
+
+        subparser.add_argument(
+            "--select",
+            type=str,
+            choices=["last", "best"],
+            default="last",
+            help="average the most recent checkpoints, or those with the best validation metric",
+        )
+
+        subparser.add_argument(
+            "--validation-metric",
+            type=str,
+            help="metric used by `--select best`, e.g. +acc; defaults to the trainer's "
+            "`validation_metric`",
+        )
+
+        subparser.add_argument(
+            "--weights-output-file",
+            type=str,
+            help="path to write the averaged weights to (default: averaged_weights.th in the "
+            "serialization directory)",
+        )
+
+        subparser.add_argument(
+            "--input-file",
+            type=str,
+            help="if given, the averaged model is evaluated on this file (for multiple files, "
+            "put between filenames e.g., input1.txt,input2.txt)",
+        )
+
+        subparser.add_argument(
+            "--output-file", type=str, help="optional path to write the metrics to as JSON"
+        )
+
+        subparser.add_argument(
+            "--predictions-output-file",
+            type=str,
+            help="optional path to write the predictions to",
+        )
+
+        subparser.add_argument(
+            "--cuda-device", type=int, default=-1, help="id of GPU to use (if any)"
+        )
+
+        subparser.add_argument(
+            "-o",
+            "--overrides",
+            type=str,
+            default="",
+            help=(
+                "a json(net) structure used to override the experiment configuration, e.g., "
+                "'{\"model.beam_search.beam_size\": 4}'."
+            ),
+        )
+
+        subparser.add_argument(
+            "--batch-size", type=int, help="If non-empty, the batch size to use during evaluation."
+        )
+
+        subparser.add_argument(
+            "--single-pass",
+            action="store_true",
+            default=False,
+            help="decode the union of the source sentences of all input files a single time, "
+            "see `allennlp eval --single-pass`",
+        )
+
+        subparser.add_argument(
+            "--file-friendly-logging",
+            action="store_true",
+            default=False,
+            help="outputs tqdm status on separate lines and slows tqdm refresh rate",
+        )
+
+        subparser.set_defaults(func=average_checkpoints_from_args)
+
+        return subparser
+
+
+def average_checkpoints_from_args(args: argparse.Namespace) -> Dict[str, Any]:
+    common_logging.FILE_FRIENDLY_LOGGING = args.file_friendly_logging
+
+    weights_file = args.weights_output_file or os.path.join(
+        args.serialization_dir, "averaged_weights.th"
+    )
+    checkpoints = select_checkpoints(
+        args.serialization_dir, args.num_checkpoints, args.select, args.validation_metric
+    )
+    average_checkpoints(checkpoints, weights_file)
+
+    if args.input_file is None:
+        return {}
+    return evaluate_from_archive(
+        archive_file=args.serialization_dir,
+        input_file=args.input_file,
+        metrics_output_file=args.output_file,
+        predictions_output_file=args.predictions_output_file,
+        batch_size=args.batch_size,
+        cmd_overrides=args.overrides,
+        cuda_device=args.cuda_device,
+        weights_file=weights_file,
+        file_friendly_logging=args.file_friendly_logging,
+        single_pass=args.single_pass,
+    )
+
+
+def find_checkpoints(serialization_dir: str) -> List[Tuple[int, int, str]]:
+    """
+    Returns `(epochs_completed, batches_in_epoch_completed, path)` of every (unsharded) model
+    state saved by the `Checkpointer` in `serialization_dir`, oldest first.
+    """
+    checkpoints = []
+    for path in glob.iglob(os.path.join(serialization_dir, "model_state_e*_b*.th")):
+        point_in_time = Checkpointer._parse_model_state_path(path)
+        if point_in_time is not None:
+            checkpoints.append((point_in_time[0], point_in_time[1], path))
+    return sorted(checkpoints)
+
+
+def select_checkpoints(
+    serialization_dir: str,
+    num_checkpoints: int,
+    select: str = "last",
+    validation_metric: Optional[str] = None,
+) -> List[str]:
+    """
+    Selects the `num_checkpoints` most recent checkpoints (`select="last"`), or those of the
+    epochs with the best `validation_metric` (`select="best"`) according to the
+    `metrics_epoch_*.json` files. Only the checkpoints the `Checkpointer` kept on disk can be
+    selected, see its `keep_most_recent_by_count`.
+    """
+    if num_checkpoints < 1:
+        raise ConfigurationError(f"num_checkpoints must be at least 1, got {num_checkpoints}")
+    checkpoints = find_checkpoints(serialization_dir)
+    if not checkpoints:
+        raise ConfigurationError(f"No checkpoints found in {serialization_dir}")
+
+    if select == "last":
+        selected = [path for _, _, path in checkpoints[-num_checkpoints:]]
+    elif select == "best":
+        if validation_metric is None:
+            config = Params.from_file(os.path.join(serialization_dir, CONFIG_NAME))
+            validation_metric = config.get("trainer", {}).get("validation_metric", "-loss")
+        if not isinstance(validation_metric, str):
+            raise ConfigurationError("--select best needs a single validation metric")
+        sign = -1.0 if validation_metric.startswith("-") else 1.0
+        metric_name = "validation_" + validation_metric.lstrip("+-")
+
+        validation_metrics = read_validation_metrics(serialization_dir)
+        scored = []
+        for epochs_completed, batches_in_epoch_completed, path in checkpoints:
+            # Only the end-of-epoch checkpoints have the metrics of a validation.
+            metrics = validation_metrics.get(epochs_completed - 1, {})
+            if batches_in_epoch_completed == 0 and metric_name in metrics:
+                scored.append((sign * float(metrics[metric_name]), epochs_completed, path))
+        if not scored:
+            raise ConfigurationError(
+                f"No checkpoint in {serialization_dir} has a validated {metric_name}"
+            )
+        scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+        selected = [path for _, _, path in sorted(scored[:num_checkpoints], key=lambda item: item[1])]
+    else:
+        raise ConfigurationError(f"select must be 'last' or 'best', got '{select}'")
+
+    if len(selected) < num_checkpoints:
+        logger.warning(
+            "Only %d of %d checkpoints are available for averaging, keep more of them with "
+            "the checkpointer's keep_most_recent_by_count.",
+            len(selected),
+            num_checkpoints,
+        )
+    logger.info("Averaging %s", ", ".join(os.path.basename(path) for path in selected))
+    return selected
+
+
+def read_validation_metrics(serialization_dir: str) -> Dict[int, Dict[str, Any]]:
+    """
+    Returns the `validation_*` metrics of every epoch that ran a validation, by epoch.
+
+    The trainer writes the metrics of the last validation into the `metrics_epoch_*.json` of
+    the epochs that skipped it (e.g. before `validation_start`, or with the `proxy_validation`
+    callback), those repeat the `validation_loss` of the previous epoch and are left out.
+    """
+    validation_metrics: Dict[int, Dict[str, Any]] = {}
+    previous_loss = None
+    epoch = 0
+    while True:
+        metrics_file = os.path.join(serialization_dir, f"metrics_epoch_{epoch}.json")
+        if not os.path.exists(metrics_file):
+            return validation_metrics
+        with open(metrics_file) as metrics_fh:
+            metrics = json.load(metrics_fh)
+        loss = metrics.get("validation_loss")
+        if loss is not None and loss != previous_loss:
+            validation_metrics[epoch] = {
+                key: value for key, value in metrics.items() if key.startswith("validation_")
+            }
+        previous_loss = loss
+        epoch += 1
+
+
+def _load_state(path: str) -> Dict[str, torch.Tensor]:
+    if "mmap" in inspect.signature(torch.load).parameters:
+        # The tensors are read from disk when they are accessed.
+        return torch.load(path, map_location="cpu", mmap=True)
+    return torch.load(path, map_location="cpu")
+
+
+def average_checkpoints(checkpoint_paths: List[str], output_file: Union[str, os.PathLike]) -> None:
+    """
+    Averages the model states in `checkpoint_paths` and saves the result to `output_file`.
+
+    The checkpoints are streamed: only the running sum and the checkpoint being added are held
+    in memory, so the memory does not grow with the number of checkpoints (and with torch
+    versions that can memory-map `torch.load`, only one tensor of the checkpoint at a time).
+    Floating point tensors are summed in fp32 and cast back; the others, e.g. integer buffers,
+    are taken from the last checkpoint.
+    """
+    if not checkpoint_paths:
+        raise ConfigurationError("No checkpoints to average.")
+    total: Dict[str, torch.Tensor] = {}
+    dtypes: Dict[str, torch.dtype] = {}
+    for index, path in enumerate(checkpoint_paths):
+        state = _load_state(path)
+        if index > 0 and set(state) != set(total):
+            raise ConfigurationError(f"The parameters of {path} differ from the other checkpoints.")
+        for name in list(state):
+            tensor = state.pop(name)
+            if index == 0:
+                dtypes[name] = tensor.dtype
+            if not tensor.is_floating_point():
+                total[name] = tensor.clone()
+            elif index == 0:
+                total[name] = tensor.to(torch.float32, copy=True)
+            else:
+                total[name].add_(tensor.to(torch.float32))
+            del tensor
+        del state
+
+    num_checkpoints = len(checkpoint_paths)
+    for name, tensor in total.items():
+        if tensor.is_floating_point():
+            total[name] = tensor.div_(num_checkpoints).to(dtypes[name])
+    torch.save(total, output_file)
+    logger.info("Saved the average of %d checkpoints to %s", num_checkpoints, output_file)
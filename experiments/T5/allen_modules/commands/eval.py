@@ -5,24 +5,36 @@ and report any metrics calculated by the model.
 """
 
 import argparse
+import contextlib
 import json
 import logging
 from json import JSONDecodeError
 from pathlib import Path
 from os import PathLike
-from typing import Union, Dict, Any, Optional
+from typing import Union, Dict, Any, Optional, List, Tuple
 from copy import deepcopy
 import wandb
 import os, fnmatch
+import torch
 
 from allennlp.commands.subcommand import Subcommand
 from allennlp.common import logging as common_logging
 from allennlp.common import Params
-from allennlp.common.util import prepare_environment
-from allennlp.data import DataLoader
+from allennlp.common.checks import ConfigurationError, check_for_gpu
+from allennlp.common.tqdm import Tqdm
+from allennlp.common.util import prepare_environment, dump_metrics, int_to_device, sanitize
+from allennlp.data import DataLoader, DatasetReader, Instance
 from allennlp.data.data_loaders import SimpleDataLoader
+from allennlp.models import Model
 from allennlp.models.archival import load_archive
 from allennlp.evaluation import Evaluator
+from allennlp.nn import util as nn_util
+
+from allen_modules.common.profiling import StageProfiler, active_profiler, profile_stage, profiling, timed_collation
+from allen_modules.common.threads import ThreadingPolicy
+from allen_modules.evaluation.custmized_evaluator import synchronous_decoding
+from allen_modules.modules.transformer.weights_cache import skip_pretrained_weights
+from allen_modules.training.metrics.exact_match import ExactMatchAcc
 
 logger = logging.getLogger(__name__)
 
@@ -136,12 +148,95 @@ class Eval(Subcommand):
             choices=["NONE", "METRICS", "PREDS", "ALL"],
         )
 
+        subparser.add_argument(
+            "--single-pass",
+            action="store_true",
+            default=False,
+            help="read every input file once into a shared instance store and decode the "
+            "union of their source sentences a single time; metrics are still reported per "
+            "file, so overlapping files (e.g. gen.tsv and its per-gen_type splits) are not "
+            "decoded twice",
+        )
+
+        subparser.add_argument(
+            "--intra-op-threads",
+            type=int,
+            help="number of CPU threads used inside one operator; overrides `model.cpu_threads`",
+        )
+
+        subparser.add_argument(
+            "--inter-op-threads",
+            type=int,
+            help="number of CPU threads used to run independent operators; overrides "
+            "`model.cpu_threads`",
+        )
+
+        subparser.add_argument(
+            "--cpu-affinity",
+            type=str,
+            help="comma-separated ids of the cores to run on (e.g. 0,1,2,3); overrides "
+            "`model.cpu_threads`",
+        )
+
+        subparser.add_argument(
+            "--profile",
+            action="store_true",
+            default=False,
+            help="time the stages of the evaluation (tokenization, collation, encoder, beam "
+            "steps, batch_decode, postprocessing), print the breakdown at the end and write it "
+            "to eval_stages.json in --profile-dir",
+        )
+
+        subparser.add_argument(
+            "--profile-dir",
+            type=str,
+            help="directory of the --profile outputs (default: profile/ in the directory of "
+            "the archive)",
+        )
+
+        subparser.add_argument(
+            "--profile-trace-start",
+            type=int,
+            help="with --profile, record a torch.profiler window after this many batches and "
+            "write it as the Chrome trace eval_trace.json",
+        )
+
+        subparser.add_argument(
+            "--profile-trace-batches",
+            type=int,
+            default=5,
+            help="number of batches in the torch.profiler window",
+        )
+
         subparser.set_defaults(func=evaluate_from_args)
 
         return subparser
 
 
 def evaluate_from_args(args: argparse.Namespace) -> Dict[str, Any]:
+    profiler: Optional[StageProfiler] = None
+    if args.profile:
+        archive_dir = (
+            args.archive_file if os.path.isdir(args.archive_file) else os.path.dirname(args.archive_file)
+        )
+        profiler = StageProfiler(
+            args.profile_dir or os.path.join(archive_dir, "profile"),
+            prefix="eval_",
+            trace_start_batch=args.profile_trace_start,
+            trace_num_batches=args.profile_trace_batches,
+        )
+    if profiler is None:
+        return _evaluate_from_args(args)
+    try:
+        with profiling(profiler):
+            return _evaluate_from_args(args)
+    finally:
+        # Also for a failed evaluation: close the torch.profiler window and write the timings.
+        profiler.close()
+        print(profiler.format_breakdown())
+
+
+def _evaluate_from_args(args: argparse.Namespace) -> Dict[str, Any]:
     return evaluate_from_archive(
         archive_file=args.archive_file,
         input_file=args.input_file,
@@ -157,6 +252,10 @@ def evaluate_from_args(args: argparse.Namespace) -> Dict[str, Any]:
         batch_weight_key=args.batch_weight_key,
         auto_names=args.auto_names,
         log_probabilities=args.log_probabilities,
+        single_pass=args.single_pass,
+        intra_op_threads=args.intra_op_threads,
+        inter_op_threads=args.inter_op_threads,
+        cpu_affinity=[int(cpu) for cpu in args.cpu_affinity.split(",")] if args.cpu_affinity else None,
     )
 
 
@@ -174,7 +273,11 @@ def evaluate_from_archive(
     file_friendly_logging: bool = False,
     batch_weight_key: str = None,
     auto_names: str = "NONE",
-    log_probabilities: bool = False
+    log_probabilities: bool = False,
+    single_pass: bool = False,
+    intra_op_threads: Optional[int] = None,
+    inter_op_threads: Optional[int] = None,
+    cpu_affinity: Optional[List[int]] = None,
 ) -> Dict[str, Any]:
     """
 
@@ -237,6 +340,26 @@ def evaluate_from_archive(
         automatically create a file name for the predictions outputs. `ALL`
         will create a filename for both the metrics and the predictions.
 
+    log_probabilities: `bool`, optional (default=`False`)
+        log probabilities of predictions and gold
+
+    single_pass: `bool`, optional (default=`False`)
+        Read every input file once into a shared instance store and decode each distinct source
+        sentence a single time. Metrics are computed per file from the shared predictions, so
+        overlapping files are not decoded twice. Only exact match metrics are reported in this
+        mode, so it can't be combined with `log_probabilities` or `batch_weight_key`.
+
+    intra_op_threads: `int`, optional (default=`None`)
+        Number of CPU threads used inside one operator. Overrides the `cpu_threads` policy
+        of the model configuration.
+
+    inter_op_threads: `int`, optional (default=`None`)
+        Number of CPU threads used to run independent operators. Overrides the `cpu_threads`
+        policy of the model configuration.
+
+    cpu_affinity: `List[int]`, optional (default=`None`)
+        The cores to run on. Overrides the `cpu_threads` policy of the model configuration.
+
     # Returns
 
     all_metrics: `Dict[str, Any]`
@@ -250,13 +373,18 @@ def evaluate_from_archive(
     logging.getLogger("allennlp.nn.initializers").disabled = True
     logging.getLogger("allennlp.modules.token_embedders.embedding").setLevel(logging.INFO)
 
-    # Load from archive
-    archive = load_archive(
-        archive_file,
-        weights_file=weights_file,
-        cuda_device=cuda_device,
-        overrides=cmd_overrides,
-    )
+    if intra_op_threads is not None or inter_op_threads is not None or cpu_affinity is not None:
+        # Before loading the archive, so the policy in its configuration is skipped.
+        ThreadingPolicy(intra_op_threads, inter_op_threads, cpu_affinity).apply(force=True)
+
+    # Load from archive, its weights replace the pretrained ones.
+    with skip_pretrained_weights():
+        archive = load_archive(
+            archive_file,
+            weights_file=weights_file,
+            cuda_device=cuda_device,
+            overrides=cmd_overrides,
+        )
     config = deepcopy(archive.config)
     prepare_environment(config)
     model = archive.model
@@ -348,6 +476,23 @@ def evaluate_from_archive(
             json.loads(embedding_sources_mapping) if embedding_sources_mapping else {}
         )
 
+    if single_pass:
+        if log_probabilities or batch_weight_key:
+            raise ConfigurationError(
+                "--single-pass only reports exact match metrics, it can't be combined with "
+                "--log-probabilities or --batch-weight-key."
+            )
+        return _evaluate_single_pass(
+            model,
+            dataset_reader,
+            evaluation_data_path_list,
+            output_file_list if metrics_output_file is not None else None,
+            predictions_output_file_list if predictions_output_file is not None else None,
+            batch_size or 64,
+            cuda_device,
+            embedding_sources if extend_vocab else None,
+        )
+
     all_metrics = {}
     for index, evaluation_data_path in enumerate(evaluation_data_path_list):
         config = deepcopy(archive.config)
@@ -414,4 +559,169 @@ def evaluate_from_archive(
 
     logger.info("Finished evaluating.")
 
-    return all_metrics
\ No newline at end of file
+    return all_metrics
+
+
+def _read_instance_store(
+    dataset_reader: DatasetReader, evaluation_data_path_list: List[Any]
+) -> Tuple[List[Instance], List[List[int]], List[List[Instance]]]:
+    """
+    Reads every evaluation file once and deduplicates their instances by source text.
+
+    # Returns
+
+    unique_instances: `List[Instance]`
+        One instance per distinct source sentence across all files.
+    file_indices: `List[List[int]]`
+        For every file, the position of each of its instances in `unique_instances`.
+    file_instances: `List[List[Instance]]`
+        The instances of every file, which keep their own gold targets and metadata.
+    """
+    instances_by_path: Dict[str, List[Instance]] = {}
+    row_by_source: Dict[str, int] = {}
+    unique_instances: List[Instance] = []
+    file_indices: List[List[int]] = []
+    file_instances: List[List[Instance]] = []
+    for evaluation_data_path in evaluation_data_path_list:
+        path_key = json.dumps(evaluation_data_path, sort_keys=True)
+        if path_key not in instances_by_path:
+            logger.info("Reading evaluation data from %s", evaluation_data_path)
+            instances = list(dataset_reader.read(evaluation_data_path))
+            # The multiprocess data loader usually does this, `SimpleDataLoader` does not.
+            for instance in instances:
+                dataset_reader.apply_token_indexers(instance)
+            instances_by_path[path_key] = instances
+        instances = instances_by_path[path_key]
+        indices = []
+        for instance in instances:
+            source_text = instance["metadata"]["source_text"]
+            if source_text not in row_by_source:
+                row_by_source[source_text] = len(unique_instances)
+                unique_instances.append(instance)
+            indices.append(row_by_source[source_text])
+        file_indices.append(indices)
+        file_instances.append(instances)
+    return unique_instances, file_indices, file_instances
+
+
+def _decode_instances(
+    model: Model, instances: List[Instance], batch_size: int, cuda_device: int
+) -> List[str]:
+    """
+    Decodes `instances` in batches of similar source length and returns the predicted text of
+    every instance, in the order of `instances`.
+    """
+    check_for_gpu(cuda_device)
+    # Sorting by length keeps padding, and so wasted encoder and beam search work, small.
+    order = sorted(
+        range(len(instances)), key=lambda i: len(instances[i]["source_tokens"]), reverse=True
+    )
+    data_loader = SimpleDataLoader([instances[i] for i in order], batch_size, shuffle=False)
+    data_loader.index_with(model.vocab)
+    data_loader.set_target_device(int_to_device(cuda_device))
+
+    predicted_text: List[Optional[str]] = [None] * len(instances)
+    position = 0
+    profiler = active_profiler()
+    collation = timed_collation(data_loader) if profiler is not None else contextlib.nullcontext()
+    # The text is needed right away, a background decoding would only delay it.
+    with torch.no_grad(), collation, synchronous_decoding(model):
+        model.eval()
+        for batch in Tqdm.tqdm(data_loader):
+            with profile_stage("eval/forward"):
+                batch = nn_util.move_to_device(batch, cuda_device)
+                output_dict = model(**batch)
+            if profiler is not None:
+                profiler.step()
+            if "predicted_text" not in output_dict:
+                raise ConfigurationError(
+                    "--single-pass needs a model that returns `predicted_text`."
+                )
+            for text in output_dict["predicted_text"]:
+                predicted_text[order[position]] = text
+                position += 1
+    # Clear the metrics the model accumulated over the union, they are recomputed per file.
+    model.get_metrics(reset=True)
+    return predicted_text  # type: ignore[return-value]
+
+
+def _evaluate_single_pass(
+    model: Model,
+    dataset_reader: DatasetReader,
+    evaluation_data_path_list: List[Any],
+    output_file_list: Optional[List[Union[str, PathLike]]],
+    predictions_output_file_list: Optional[List[Union[str, PathLike]]],
+    batch_size: int,
+    cuda_device: int,
+    embedding_sources: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    unique_instances, file_indices, file_instances = _read_instance_store(
+        dataset_reader, evaluation_data_path_list
+    )
+    num_instances = sum(len(instances) for instances in file_instances)
+    logger.info(
+        "Decoding %d distinct source sentences for %d instances in %d files.",
+        len(unique_instances),
+        num_instances,
+        len(evaluation_data_path_list),
+    )
+
+    if embedding_sources is not None:
+        logger.info("Vocabulary is being extended with test instances.")
+        model.vocab.extend_from_instances(instances=unique_instances)
+        model.extend_embedder_vocab(embedding_sources)
+
+    predicted_text = _decode_instances(model, unique_instances, batch_size, cuda_device)
+
+    all_metrics = {}
+    for index, evaluation_data_path in enumerate(evaluation_data_path_list):
+        if isinstance(evaluation_data_path, str):
+            eval_file_name = Path(evaluation_data_path).stem
+        else:
+            eval_file_name = str(index)
+
+        predictions = [predicted_text[i] for i in file_indices[index]]
+        metadata = [instance["metadata"].metadata for instance in file_instances[index]]
+        accuracy = ExactMatchAcc()
+        accuracy(predictions, metadata)
+        metrics = accuracy.get_metric(reset=True)
+
+        if output_file_list is not None:
+            dump_metrics(str(output_file_list[index]), metrics, log=True)
+        if predictions_output_file_list is not None:
+            _write_predictions(
+                str(predictions_output_file_list[index]), predictions, metadata, batch_size
+            )
+
+        for name, value in metrics.items():
+            key = f"{eval_file_name}_" if len(evaluation_data_path_list) > 1 else ""
+            all_metrics[f"{key}{name}"] = value
+
+    logger.info("Finished evaluating.")
+
+    return all_metrics
+
+
+def _write_predictions(
+    predictions_output_file: str, predictions: List[str], metadata: List[Dict], batch_size: int
+):
+    # Same files as the `cust_evaluator`. The batches of the union are not those of the file, so
+    # each line of the predictions file only holds the metadata and predicted text of
+    # `batch_size` instances, without the token ids and the loss.
+    Path(predictions_output_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(predictions_output_file, "w", encoding="utf-8") as predictions_file, open(
+        predictions_output_file + ".read.tsv", "w", encoding="utf-8"
+    ) as readable_file, open(
+        predictions_output_file + ".err.tsv", "w", encoding="utf-8"
+    ) as mistake_file:
+        for start in range(0, len(predictions), batch_size):
+            serialized_batch = {
+                "metadata": metadata[start : start + batch_size],
+                "predicted_text": predictions[start : start + batch_size],
+            }
+            predictions_file.write(json.dumps(sanitize(serialized_batch)) + "\n")
+        for prediction, meta in zip(predictions, metadata):
+            line = "{}\t{}\t{}\n".format(meta["source_text"], meta["target_text"], prediction)
+            readable_file.write(line)
+            if prediction != meta["target_text"]:
+                mistake_file.write(line)
@@ -0,0 +1,330 @@
+"""
+The `eval-sweep` subcommand evaluates several archived models (e.g. the seeds of one
+configuration) on the same dataset and aggregates their metrics into one mean/std table.
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+from os import PathLike
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import torch
+import torch.multiprocessing as mp
+
+from allennlp.commands.subcommand import Subcommand
+from allennlp.common import Params
+from allennlp.common import logging as common_logging
+from allennlp.common.checks import ConfigurationError, check_for_gpu
+from allennlp.common.file_utils import cached_path
+from allennlp.common.util import dump_metrics, import_module_and_submodules
+from allennlp.data import DatasetReader, TensorDict, Vocabulary
+from allennlp.data.data_loaders import SimpleDataLoader
+from allennlp.models.archival import CONFIG_NAME, extracted_archive, load_archive
+from allennlp.nn import util as nn_util
+
+from allen_modules.common.threads import ThreadingPolicy
+from allen_modules.modules.transformer.weights_cache import skip_pretrained_weights
+
+logger = logging.getLogger(__name__)
+
+# Set in every worker process by `_init_worker`.
+_worker_batches: List[TensorDict] = []
+_worker_device: int = -1
+
+
+@Subcommand.register("eval-sweep")
+class EvalSweep(Subcommand):
+    def add_subparser(self, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        description = """Evaluate several archived models on one dataset and aggregate their metrics"""
+        subparser = parser.add_parser(
+            self.name,
+            description=description,
+            help="Evaluate several archived models (e.g. a seed sweep) on one dataset.",
+        )
+
+        subparser.add_argument(
+            "archive_files", type=str, nargs="+", help="paths to the archived trained models"
+        )
+
+        subparser.add_argument(
+            "--input-file",
+            type=str,
+            required=True,
+            help="path to the file containing the evaluation data",
+        )
+
+        subparser.add_argument(
+            "--output-file",
+            type=str,
+            help="optional path to write the per-archive metrics and the aggregated table to as JSON",
+        )
+
+        subparser.add_argument(
+            "--cuda-devices",
+            type=str,
+            default="",
+            help="comma-separated ids of the GPUs to use, one worker per GPU (e.g. 0,1,2,3). "
+            "If empty, `--num-workers` CPU workers are used.",
+        )
+
+        subparser.add_argument(
+            "--num-workers",
+            type=int,
+            default=2,
+            help="number of CPU workers, only used without `--cuda-devices`",
+        )
+
+        subparser.add_argument(
+            "-o",
+            "--overrides",
+            type=str,
+            default="",
+            help=(
+                "a json(net) structure used to override the experiment configuration of every "
+                "archive, e.g., '{\"model.beam_search.beam_size\": 4}'."
+            ),
+        )
+
+        subparser.add_argument(
+            "--batch-size", type=int, default=64, help="the batch size to use during evaluation"
+        )
+
+        subparser.add_argument(
+            "--file-friendly-logging",
+            action="store_true",
+            default=False,
+            help="outputs tqdm status on separate lines and slows tqdm refresh rate",
+        )
+
+        subparser.set_defaults(func=evaluate_sweep_from_args)
+
+        return subparser
+
+
+def evaluate_sweep_from_args(args: argparse.Namespace) -> Dict[str, Any]:
+    cuda_devices = [int(device) for device in args.cuda_devices.split(",") if device.strip()]
+    return evaluate_sweep(
+        archive_files=args.archive_files,
+        input_file=args.input_file,
+        output_file=args.output_file,
+        cuda_devices=cuda_devices,
+        num_workers=args.num_workers,
+        cmd_overrides=args.overrides,
+        batch_size=args.batch_size,
+        file_friendly_logging=args.file_friendly_logging,
+        include_package=getattr(args, "include_package", []),
+    )
+
+
+def _share_memory(value: Any) -> Any:
+    if isinstance(value, torch.Tensor):
+        return value.share_memory_()
+    if isinstance(value, dict):
+        return {key: _share_memory(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_share_memory(item) for item in value]
+    return value
+
+
+def _read_batches(
+    archive_file: Union[str, PathLike], input_file: str, cmd_overrides: str, batch_size: int
+) -> List[TensorDict]:
+    """
+    Reads and tensorizes the evaluation data once, with the validation dataset reader and
+    vocabulary of `archive_file`. All archives of a sweep share the same configuration, so the
+    batches can be reused for every one of them.
+    """
+    resolved_archive_file = cached_path(archive_file)
+
+    def read(serialization_dir: str) -> List[TensorDict]:
+        config = Params.from_file(os.path.join(serialization_dir, CONFIG_NAME), cmd_overrides)
+        reader_params = config.get("validation_dataset_reader", config.get("dataset_reader"))
+        dataset_reader = DatasetReader.from_params(
+            reader_params, serialization_dir=serialization_dir
+        )
+        vocab = Vocabulary.from_files(os.path.join(serialization_dir, "vocabulary"))
+        logger.info("Reading evaluation data from %s", input_file)
+        instances = list(dataset_reader.read(input_file))
+        for instance in instances:
+            dataset_reader.apply_token_indexers(instance)
+        data_loader = SimpleDataLoader(instances, batch_size, shuffle=False, vocab=vocab)
+        return [_share_memory(batch) for batch in data_loader]
+
+    if os.path.isdir(resolved_archive_file):
+        return read(resolved_archive_file)
+    with extracted_archive(resolved_archive_file) as serialization_dir:
+        return read(serialization_dir)
+
+
+def _init_worker(
+    devices: "mp.Queue",
+    batches: List[TensorDict],
+    include_package: List[str],
+    file_friendly_logging: bool,
+) -> None:
+    global _worker_batches, _worker_device
+    common_logging.FILE_FRIENDLY_LOGGING = file_friendly_logging
+    worker_index, num_workers, _worker_device = devices.get()
+    if _worker_device < 0:
+        # CPU workers split the cores between them instead of oversubscribing the host.
+        ThreadingPolicy.for_worker(worker_index, num_workers).apply(force=True)
+    else:
+        ThreadingPolicy(intra_op_threads=1).apply(force=True)
+    # Spawned workers start from a fresh interpreter, so the registrations are imported again.
+    for package_name in ["allen_modules"] + list(include_package):
+        import_module_and_submodules(package_name)
+    _worker_batches = batches
+    check_for_gpu(_worker_device)
+
+
+def _evaluate_archive(archive_file: str, cmd_overrides: str) -> Dict[str, Any]:
+    with skip_pretrained_weights():
+        archive = load_archive(archive_file, cuda_device=_worker_device, overrides=cmd_overrides)
+    model = archive.model
+    logger.info("Evaluating %s on device %d", archive_file, _worker_device)
+    with torch.no_grad():
+        model.eval()
+        for batch in _worker_batches:
+            model(**nn_util.move_to_device(batch, _worker_device))
+    metrics = model.get_metrics(reset=True)
+    del archive, model
+    if _worker_device >= 0:
+        torch.cuda.empty_cache()
+    return metrics
+
+
+def aggregate_metrics(metrics_per_archive: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """
+    Computes the mean and standard deviation across archives of every numeric metric, e.g. the
+    overall accuracy and the accuracy of every `gen_type`.
+    """
+    names: List[str] = []
+    for metrics in metrics_per_archive.values():
+        names += [name for name in metrics if name not in names]
+    table = {}
+    for name in names:
+        values = [
+            float(metrics[name])
+            for metrics in metrics_per_archive.values()
+            if isinstance(metrics.get(name), (int, float))
+        ]
+        if not values:
+            continue
+        table[name] = {
+            "mean": statistics.mean(values),
+            "std": statistics.stdev(values) if len(values) > 1 else 0.0,
+            "n": len(values),
+        }
+    return table
+
+
+def format_table(table: Dict[str, Dict[str, float]]) -> str:
+    width = max([len(name) for name in table] + [len("metric")])
+    lines = [f"{'metric':<{width}}  {'mean':>7}  {'std':>7}  {'n':>3}"]
+    for name, row in table.items():
+        lines.append(f"{name:<{width}}  {row['mean']:>7.4f}  {row['std']:>7.4f}  {row['n']:>3}")
+    return "\n".join(lines)
+
+
+def evaluate_sweep(
+    archive_files: List[str],
+    input_file: str,
+    output_file: Optional[str] = None,
+    cuda_devices: Optional[List[int]] = None,
+    num_workers: int = 2,
+    cmd_overrides: Union[str, Dict[str, Any]] = "",
+    batch_size: int = 64,
+    file_friendly_logging: bool = False,
+    include_package: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Evaluates every archive of `archive_files` on `input_file` and aggregates the metrics.
+
+    The evaluation data is read and tensorized once, moved to shared memory and handed to a
+    pool of workers, one per entry of `cuda_devices` (or `num_workers` CPU workers). Each
+    worker loads one archive at a time and evaluates it on the shared batches.
+
+    # Parameters
+
+    archive_files: `List[str]`
+        Paths to the archived trained models, e.g. one per seed. They are expected to share the
+        dataset reader and vocabulary of the first archive.
+
+    input_file: `str`
+        Path to the file containing the evaluation data.
+
+    output_file: `str`, optional (default=`None`)
+        Optional path to write the per-archive metrics and the aggregated table to as JSON.
+
+    cuda_devices: `List[int]`, optional (default=`None`)
+        Ids of the GPUs to use, one worker per GPU. If empty, CPU workers are used.
+
+    num_workers: `int`, optional (default=`2`)
+        Number of CPU workers, only used without `cuda_devices`.
+
+    cmd_overrides: `str`, optional (default=`""`)
+        a json(net) structure used to override the experiment configuration of every archive.
+
+    batch_size: `int`, optional (default=`64`)
+        The batch size to use during evaluation.
+
+    file_friendly_logging : `bool`, optional (default=`False`)
+        If `True`, we add newlines to tqdm output, even on an interactive terminal.
+
+    include_package: `List[str]`, optional (default=`None`)
+        Packages imported in every worker to register custom classes.
+
+    # Returns
+
+    results: `Dict[str, Any]`
+        The metrics of every archive under `"archives"` and the aggregated table under `"table"`.
+    """
+    common_logging.FILE_FRIENDLY_LOGGING = file_friendly_logging
+    logging.getLogger("allennlp.common.params").disabled = True
+    logging.getLogger("allennlp.nn.initializers").disabled = True
+
+    if not archive_files:
+        raise ConfigurationError("eval-sweep needs at least one archive.")
+    if isinstance(cmd_overrides, dict):
+        cmd_overrides = json.dumps(cmd_overrides)
+
+    devices = list(cuda_devices or [])
+    if not devices:
+        devices = [-1] * max(1, min(num_workers, len(archive_files)))
+
+    batches = _read_batches(archive_files[0], input_file, cmd_overrides, batch_size)
+
+    context = mp.get_context("spawn")
+    device_queue = context.Queue()
+    for worker_index, device in enumerate(devices):
+        device_queue.put((worker_index, len(devices), device))
+
+    metrics_per_archive: Dict[str, Dict[str, Any]] = {}
+    with context.Pool(
+        processes=len(devices),
+        initializer=_init_worker,
+        initargs=(device_queue, batches, include_package or [], file_friendly_logging),
+    ) as pool:
+        jobs = {
+            archive_file: pool.apply_async(_evaluate_archive, (archive_file, cmd_overrides))
+            for archive_file in archive_files
+        }
+        for archive_file, job in jobs.items():
+            metrics_per_archive[archive_file] = job.get()
+            logger.info("%s: %s", archive_file, metrics_per_archive[archive_file])
+
+    table = aggregate_metrics(metrics_per_archive)
+    print(format_table(table))
+
+    results = {"archives": metrics_per_archive, "table": table}
+    if output_file is not None:
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        dump_metrics(output_file, results, log=False)
+
+    logger.info("Finished evaluating.")
+
+    return results
@@ -0,0 +1,227 @@
+"""
+Lightweight timers for the stages of the training and evaluation hot path: reader tokenization,
+collation, encoder, beam search steps, `batch_decode` and postprocessing.
+
+The stages are marked with `profile_stage(name)` where they run. Without an active
+`StageProfiler` that is a no-op; with one, the wall time of every stage is accumulated and,
+within a `torch.profiler` window, the stage shows up as a range of the Chrome trace. Stages
+nest (e.g. the beam steps run within the beam search), so their times are inclusive.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_active: Optional["StageProfiler"] = None
+
+_no_stage = contextlib.nullcontext()
+
+
+class StageProfiler:
+    """
+    Accumulates the time spent in each stage and, optionally, traces a window of
+    `trace_num_batches` batches with `torch.profiler`, starting after `trace_start_batch`
+    batches. Call `step` after every batch and `close` at the end.
+
+    The breakdown is written to `<output_dir>/<prefix>stages.json` and the trace to
+    `<output_dir>/<prefix>trace.json`.
+
+    # Parameters
+
+    output_dir : `str`
+        The directory of the breakdown and the trace.
+    prefix : `str`, optional (default = `""`)
+        Prepended to the file names, e.g. `"train_"`.
+    synchronize_cuda : `bool`, optional (default = `True`)
+        Wait for the GPU at the start and end of every stage, so its time is attributed to the
+        stage that launched the kernels rather than to the next one that synchronizes.
+    trace_start_batch : `int`, optional (default = `None`)
+        The number of batches after which the `torch.profiler` window starts. No trace is
+        recorded if this is `None`.
+    trace_num_batches : `int`, optional (default = `5`)
+        The number of batches in the `torch.profiler` window.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        prefix: str = "",
+        synchronize_cuda: bool = True,
+        trace_start_batch: Optional[int] = None,
+        trace_num_batches: int = 5,
+    ) -> None:
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.synchronize_cuda = synchronize_cuda
+        self.trace_start_batch = trace_start_batch
+        self.trace_num_batches = trace_num_batches
+        # Stages also run on worker threads, e.g. the asynchronous decoding.
+        self._lock = threading.Lock()
+        self._totals: Dict[str, float] = {}
+        self._calls: Dict[str, int] = {}
+        self._num_batches = 0
+        self._trace: Optional[torch.profiler.profile] = None
+
+    @property
+    def tracing(self) -> bool:
+        return self._trace is not None
+
+    def synchronize(self) -> None:
+        if self.synchronize_cuda and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._totals[name] = self._totals.get(name, 0.0) + seconds
+            self._calls[name] = self._calls.get(name, 0) + 1
+
+    def step(self) -> None:
+        """
+        Marks the end of a batch, and opens or closes the `torch.profiler` window.
+        """
+        self._num_batches += 1
+        if self.trace_start_batch is None:
+            return
+        if self._num_batches == self.trace_start_batch:
+            self._start_trace()
+        elif self._num_batches == self.trace_start_batch + self.trace_num_batches:
+            self._stop_trace()
+
+    def breakdown(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {
+                name: {
+                    "total_seconds": total,
+                    "calls": self._calls[name],
+                    "mean_ms": 1000.0 * total / self._calls[name],
+                }
+                for name, total in sorted(self._totals.items(), key=lambda item: -item[1])
+            }
+        return {"batches": self._num_batches, "stages": stages}
+
+    def format_breakdown(self) -> str:
+        breakdown = self.breakdown()
+        lines = [
+            f"Stage timings over {breakdown['batches']} batches (inclusive of nested stages):",
+            f"{'stage':<24} {'total s':>10} {'calls':>9} {'mean ms':>10}",
+        ]
+        for name, stage in breakdown["stages"].items():
+            lines.append(
+                f"{name:<24} {stage['total_seconds']:>10.3f} {stage['calls']:>9d} {stage['mean_ms']:>10.3f}"
+            )
+        return "\n".join(lines)
+
+    def write(self) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"{self.prefix}stages.json")
+        with open(path, "w") as stages_file:
+            json.dump(self.breakdown(), stages_file, indent=2)
+        return path
+
+    def close(self) -> None:
+        """
+        Closes an open `torch.profiler` window and writes the breakdown.
+        """
+        self._stop_trace()
+        path = self.write()
+        logger.info("Wrote the stage timings to %s", path)
+
+    def _start_trace(self) -> None:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._trace = torch.profiler.profile(activities=activities)
+        self._trace.__enter__()
+
+    def _stop_trace(self) -> None:
+        if self._trace is None:
+            return
+        trace, self._trace = self._trace, None
+        trace.__exit__(None, None, None)
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"{self.prefix}trace.json")
+        trace.export_chrome_trace(path)
+        logger.info("Wrote the Chrome trace of the profiled batches to %s", path)
+
+
+class _Stage:
+    __slots__ = ("_profiler", "_name", "_start", "_range")
+
+    def __init__(self, profiler: StageProfiler, name: str) -> None:
+        self._profiler = profiler
+        self._name = name
+        self._range: Optional[torch.profiler.record_function] = None
+
+    def __enter__(self) -> None:
+        self._profiler.synchronize()
+        if self._profiler.tracing:
+            self._range = torch.profiler.record_function(self._name)
+            self._range.__enter__()
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self._profiler.synchronize()
+        self._profiler.record(self._name, time.perf_counter() - self._start)
+        if self._range is not None:
+            self._range.__exit__(*exc_info)
+
+
+def profile_stage(name: str):
+    """
+    A context manager that times the stage `name` with the active `StageProfiler`, if any.
+    """
+    profiler = _active
+    if profiler is None:
+        return _no_stage
+    return _Stage(profiler, name)
+
+
+def active_profiler() -> Optional[StageProfiler]:
+    return _active
+
+
+def activate(profiler: Optional[StageProfiler]) -> Optional[StageProfiler]:
+    """
+    Makes `profiler` the active one and returns the previous one.
+    """
+    global _active
+    previous, _active = _active, profiler
+    return previous
+
+
+@contextlib.contextmanager
+def profiling(profiler: StageProfiler) -> Iterator[StageProfiler]:
+    previous = activate(profiler)
+    try:
+        yield profiler
+    finally:
+        activate(previous)
+
+
+@contextlib.contextmanager
+def timed_collation(data_loader: Any) -> Iterator[None]:
+    """
+    Times the `collate_fn` of `data_loader` as the stage `"data/collate"`. Data loaders
+    without one (and collation in worker processes) are not timed.
+    """
+    collate_fn = getattr(data_loader, "collate_fn", None)
+    if collate_fn is None:
+        yield
+        return
+
+    def collate(instances):
+        with profile_stage("data/collate"):
+            return collate_fn(instances)
+
+    data_loader.collate_fn = collate
+    try:
+        yield
+    finally:
+        data_loader.collate_fn = collate_fn
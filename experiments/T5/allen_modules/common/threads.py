@@ -0,0 +1,95 @@
+"""
+CPU threading policy of a training or evaluation process.
+"""
+import logging
+import os
+from typing import List, Optional
+
+import torch
+
+from allennlp.common import FromParams
+from allennlp.common.checks import ConfigurationError
+
+logger = logging.getLogger(__name__)
+
+# Set once a policy was applied with `force=True`, e.g. from the command line.
+_forced_policy: Optional["ThreadingPolicy"] = None
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ThreadingPolicy(FromParams):
+    """
+    How many CPU threads torch uses, and on which cores the process runs.
+    Unset values keep the torch (or OS) defaults.
+
+    # Parameters
+
+    intra_op_threads : `int`, optional (default = `None`)
+        Threads used inside one operator (`torch.set_num_threads`).
+    inter_op_threads : `int`, optional (default = `None`)
+        Threads used to run independent operators (`torch.set_num_interop_threads`).
+        This can only be set before the first parallel operator runs.
+    cpu_affinity : `List[int]`, optional (default = `None`)
+        The cores the process is pinned to (`os.sched_setaffinity`). Linux only.
+    """
+
+    def __init__(
+        self,
+        intra_op_threads: Optional[int] = None,
+        inter_op_threads: Optional[int] = None,
+        cpu_affinity: Optional[List[int]] = None,
+    ) -> None:
+        for name, value in (("intra_op_threads", intra_op_threads), ("inter_op_threads", inter_op_threads)):
+            if value is not None and value < 1:
+                raise ConfigurationError(f"{name} must be at least 1, got {value}")
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.cpu_affinity = cpu_affinity
+
+    @classmethod
+    def for_worker(
+        cls, worker_index: int, num_workers: int, inter_op_threads: Optional[int] = None
+    ) -> "ThreadingPolicy":
+        """
+        Gives each of `num_workers` processes a disjoint share of the available cores, with one
+        intra-op thread per core.
+        """
+        cpus = available_cpus()
+        share = cpus[worker_index::num_workers] or cpus
+        return cls(intra_op_threads=len(share), inter_op_threads=inter_op_threads, cpu_affinity=share)
+
+    def apply(self, force: bool = False) -> None:
+        """
+        Applies the policy to the current process. A policy applied with `force=True` (from the
+        command line) takes precedence over the ones applied later from a configuration.
+        """
+        global _forced_policy
+        if _forced_policy is not None and not force:
+            logger.info("Ignoring the configured threading policy, it was set on the command line.")
+            return
+        if force:
+            _forced_policy = self
+
+        if self.cpu_affinity is not None:
+            if not hasattr(os, "sched_setaffinity"):
+                logger.warning("cpu_affinity is not supported on this platform, ignoring it.")
+            else:
+                os.sched_setaffinity(0, self.cpu_affinity)
+        if self.intra_op_threads is not None:
+            torch.set_num_threads(self.intra_op_threads)
+        if self.inter_op_threads is not None and self.inter_op_threads != torch.get_num_interop_threads():
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError as e:
+                logger.warning("Could not set %d inter-op threads: %s", self.inter_op_threads, e)
+        logger.info(
+            "Using %d intra-op and %d inter-op threads on %d cores.",
+            torch.get_num_threads(),
+            torch.get_num_interop_threads(),
+            len(available_cpus()),
+        )
@@ -13,6 +13,8 @@ from allennlp.data.instance import Instance
 from allennlp.data.tokenizers import Tokenizer, SpacyTokenizer, Token, WhitespaceTokenizer, PretrainedTransformerTokenizer
 from allennlp.data.token_indexers import TokenIndexer, SingleIdTokenIndexer, PretrainedTransformerIndexer
 
+from allen_modules.common.profiling import profile_stage
+
 logger = logging.getLogger(__name__)
 
 
@@ -163,7 +165,8 @@ class Seq2SeqDatasetReader(DatasetReader):
             gen_type: str = None,
     ) -> Instance:  # type: ignore
         fields: Dict[str: Field] = {}
-        tokenized_source = self._source_tokenizer.tokenize(source_string)
+        with profile_stage("reader/tokenize"):
+            tokenized_source = self._source_tokenizer.tokenize(source_string)
         if self._source_max_tokens and len(tokenized_source) > self._source_max_tokens:
             self._source_max_exceeded += 1
             tokenized_source = tokenized_source[: self._source_max_tokens]
@@ -178,7 +181,8 @@ class Seq2SeqDatasetReader(DatasetReader):
             "gen_type": gen_type
         }
         if target_string is not None:
-            tokenized_target = self._target_tokenizer.tokenize(target_string)
+            with profile_stage("reader/tokenize"):
+                tokenized_target = self._target_tokenizer.tokenize(target_string)
             # print(tokenized_target)
             # raise NotImplementedError
             if self._target_max_tokens and len(tokenized_target) > self._target_max_tokens:
@@ -1,9 +1,13 @@
 """
 Evaluator class for evaluating a model with a given dataset
 """
-from typing import Union, Dict, Any, Optional
+from typing import Union, Dict, Any, Optional, IO, Iterator, List
 from os import PathLike
 from pathlib import Path
+import contextlib
+import queue
+import threading
+import time
 import torch
 import logging
 import os, pathlib
@@ -18,8 +22,80 @@ from allennlp.data import DataLoader
 from allennlp.evaluation.evaluator import Evaluator
 from allennlp.evaluation.serializers.serializers import Serializer, SimpleSerializer
 
+from allen_modules.common.profiling import active_profiler, profile_stage, timed_collation
+
 logger = logging.getLogger(__name__)
 
+
+class _BackgroundWriter:
+    """
+    Writes lines to open files from a background thread and flushes them after every batch,
+    so predictions are not held in memory and survive an interrupted evaluation.
+    """
+
+    def __init__(self, max_pending_batches: int = 64):
+        # Bounded, so a slow disk throttles the evaluation instead of growing memory.
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending_batches)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                for file, lines in item:
+                    file.writelines(lines)
+                    file.flush()
+            except BaseException as e:  # noqa: B036
+                self._error = e
+
+    def write(self, writes: List[tuple]):
+        """
+        Queues `(file, lines)` pairs, which are written and flushed together.
+        """
+        if self._error is not None:
+            raise self._error
+        writes = [(file, lines) for file, lines in writes if lines]
+        if writes:
+            self._queue.put(writes)
+
+    def close(self, files: List[IO], raise_error: bool = True):
+        """
+        Writes what is still queued and closes `files`. A write error is raised if `raise_error`,
+        otherwise only logged, e.g. while another exception is propagating.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        for file in files:
+            file.close()
+        if self._error is not None:
+            if raise_error:
+                raise self._error
+            logger.error("Writing the predictions failed: %s", self._error)
+
+
+@contextlib.contextmanager
+def synchronous_decoding(model: Model) -> Iterator[None]:
+    """
+    Turns off the background decoding of models with an `async_decoding` flag (`modified_t5`),
+    so `forward` returns `predicted_text` and every batch is decoded once when the text is
+    written out.
+    """
+    async_decoding = getattr(model, "async_decoding", False)
+    if async_decoding:
+        model.async_decoding = False
+    try:
+        yield
+    finally:
+        if async_decoding:
+            model.async_decoding = True
+
+
 @Evaluator.register("cust_evaluator")
 class SimpleEvaluator(Evaluator):
     """
@@ -38,6 +114,13 @@ class SimpleEvaluator(Evaluator):
 
     postprocessor_fn_name: `str`, optional (default=`"make_output_human_readable"`)
         Function name of the model's postprocessing function.
+
+    metrics_refresh_interval: `int`, optional (default=`1`)
+        The progress bar description is refreshed with `model.get_metrics()` every this many batches.
+
+    While a `StageProfiler` is active (`allennlp eval --profile`), the evaluator times the data
+    loading (`eval/data`), the forward pass (`eval/forward`) and every batch as a whole
+    (`eval/batch`), besides the stages of the model, and steps the profiler after every batch.
     """
 
     def __init__(
@@ -45,8 +128,10 @@ class SimpleEvaluator(Evaluator):
         batch_serializer: Optional[Serializer] = None,
         cuda_device: Union[int, torch.device] = -1,
         postprocessor_fn_name: str = "make_output_human_readable",
+        metrics_refresh_interval: int = 1,
     ):
         super(SimpleEvaluator, self).__init__(batch_serializer, cuda_device, postprocessor_fn_name)
+        self.metrics_refresh_interval = max(1, metrics_refresh_interval)
 
     def __call__(
         self,
@@ -85,19 +170,64 @@ class SimpleEvaluator(Evaluator):
         check_for_gpu(self.cuda_device)
         data_loader.set_target_device(int_to_device(self.cuda_device))
         metrics_output_file = Path(metrics_output_file) if metrics_output_file is not None else None
+        readable_predictions_file = mistake_predictions_file = prob_predictions_file = None
+        writer = None
         if predictions_output_file is not None:
             pathlib.Path(os.path.dirname(predictions_output_file)).mkdir(exist_ok=True)
             predictions_file = Path(predictions_output_file).open("w", encoding="utf-8")
             readable_predictions_file = Path(predictions_output_file+".read.tsv").open("w", encoding="utf-8")
             mistake_predictions_file = Path(predictions_output_file+".err.tsv").open("w", encoding="utf-8")
+            output_files = [predictions_file, readable_predictions_file, mistake_predictions_file]
             if log_probabilities:
                 prob_predictions_file = Path(predictions_output_file+".prob.md").open("w", encoding="utf-8")
+                output_files.append(prob_predictions_file)
+            writer = _BackgroundWriter()
         else:
             predictions_file = None  # type: ignore
 
+        decoding = synchronous_decoding(model) if predictions_file is not None else contextlib.nullcontext()
+        try:
+            with decoding:
+                metrics = self._evaluate(
+                    model,
+                    data_loader,
+                    batch_weight_key,
+                    metrics_output_file,
+                    log_probabilities,
+                    predictions_file,
+                    readable_predictions_file,
+                    mistake_predictions_file,
+                    prob_predictions_file,
+                    writer,
+                )
+        except BaseException:
+            # Whatever was evaluated so far is on disk, even if the evaluation was interrupted.
+            # A write error must not hide the exception that interrupted it.
+            if writer is not None:
+                writer.close(output_files, raise_error=False)
+            raise
+        if writer is not None:
+            writer.close(output_files)
+        return metrics
+
+    def _evaluate(
+        self,
+        model: Model,
+        data_loader: DataLoader,
+        batch_weight_key: Optional[str],
+        metrics_output_file: Optional[Path],
+        log_probabilities: bool,
+        predictions_file: Optional[IO],
+        readable_predictions_file: Optional[IO],
+        mistake_predictions_file: Optional[IO],
+        prob_predictions_file: Optional[IO],
+        writer: Optional[_BackgroundWriter],
+    ):
         model_postprocess_function = getattr(model, self.postprocessor_fn_name, None)
+        profiler = active_profiler()
+        collation = timed_collation(data_loader) if profiler is not None else contextlib.nullcontext()
 
-        with torch.no_grad():
+        with torch.no_grad(), collation:
             model.eval()
 
             iterator = iter(data_loader)
@@ -112,18 +242,23 @@ class SimpleEvaluator(Evaluator):
             # Cumulative weight across all batches.
             total_weight = 0.0
 
-            if predictions_output_file is not None:
-                mistake_data = []
-                readable_data = []
-                prob_data = []
+            # Number of lines written to the probability file.
+            prob_line_count = 0
+            metrics: Dict[str, Any] = {}
 
+            batch_end = time.perf_counter()
             for batch in generator_tqdm:
+                if profiler is not None:
+                    batch_start = time.perf_counter()
+                    profiler.record("eval/data", batch_start - batch_end)
                 batch_count += 1
-                batch = nn_util.move_to_device(batch, self.cuda_device)
-                output_dict = model(**batch)
+                with profile_stage("eval/forward"):
+                    batch = nn_util.move_to_device(batch, self.cuda_device)
+                    output_dict = model(**batch)
                 loss = output_dict.get("loss")
 
-                metrics = model.get_metrics()
+                if (batch_count - 1) % self.metrics_refresh_interval == 0:
+                    metrics = model.get_metrics()
 
                 if loss is not None:
                     loss_count += 1
@@ -154,10 +289,14 @@ class SimpleEvaluator(Evaluator):
                 # print(dict(filter(lambda x: x[0] in ["predictions", "loss"], output_dict.items)))
                 # raise NotImplementedError
                 if predictions_file is not None:
-                    save_keys = ["predictions", "loss"]
+                    mistake_data = []
+                    readable_data = []
+                    prob_data = []
+                    # The text is passed on so the postprocess function doesn't decode it again.
+                    save_keys = ["predictions", "predicted_text", "loss"]
                     if "logger_output" in output_dict:
                         save_keys.append("logger_output")
-                    predictions_file.write(
+                    serialized_batch = (
                         self.batch_serializer(
                             batch,
                             dict(filter(lambda x: x[0] in save_keys, output_dict.items())),
@@ -187,7 +326,7 @@ class SimpleEvaluator(Evaluator):
                             readable_data.append(line)
 
                             if log_probabilities:
-                                if len(prob_data) >= log_prob_line_num:
+                                if prob_line_count >= log_prob_line_num:
                                     continue
                                 pred_probs = output_dict["predicted_probs"][idx]
                                 # print(output_dict["loss"])
@@ -205,6 +344,7 @@ class SimpleEvaluator(Evaluator):
                                 #                                        gold, gold_probs,
                                 #                                        output_dict["predicted_text"][idx], pred_probs)
                                         prob_data.append(line)
+                                        prob_line_count += 1
                     else:
                         for idx in range(len(output_dict["predicted_tokens"])):
                             tok_pred = output_dict["predicted_tokens"][idx]
@@ -215,16 +355,20 @@ class SimpleEvaluator(Evaluator):
                                 mistake_data.append(line)
                             readable_data.append(line)
 
+                    writes = [
+                        (predictions_file, [serialized_batch]),
+                        (readable_predictions_file, readable_data),
+                        (mistake_predictions_file, mistake_data),
+                    ]
+                    if log_probabilities:
+                        writes.append((prob_predictions_file, prob_data))
+                    writer.write(writes)
+
+                if profiler is not None:
+                    batch_end = time.perf_counter()
+                    profiler.record("eval/batch", batch_end - batch_start)
+                    profiler.step()
 
-            if predictions_file is not None:
-                predictions_file.close()
-                readable_predictions_file.writelines(readable_data)
-                readable_predictions_file.close()
-                mistake_predictions_file.writelines(mistake_data)
-                mistake_predictions_file.close()
-                if log_probabilities:
-                    prob_predictions_file.writelines(prob_data)
-                    prob_predictions_file.close()
             final_metrics = model.get_metrics(reset=True)
             if loss_count > 0:
                 # Sanity check
@@ -241,7 +385,8 @@ class SimpleEvaluator(Evaluator):
 
     def _to_params(self) -> Dict[str, Any]:
         return {
-            "type": "simple",
+            "type": "cust_evaluator",
             "cuda_device": self.cuda_device,
             "batch_postprocessor": self.batch_serializer.to_params(),
+            "metrics_refresh_interval": self.metrics_refresh_interval,
         }
\ No newline at end of file
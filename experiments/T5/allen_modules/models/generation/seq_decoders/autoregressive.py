@@ -206,6 +206,13 @@ class AutoRegressiveSeqDecoder(SeqDecoder):
         Defines ratio between teacher forced training and real output usage. If its zero
         (teacher forcing only) and `decoder_net`supports parallel decoding, we get the output
         predictions in a single forward pass of the `decoder_net`.
+    scheduled_sampling_mode : `str`, optional (default = `"loop"`)
+        How scheduled sampling is done when `scheduled_sampling_ratio > 0`. `"loop"` decodes
+        step by step and feeds back the model's own predictions. `"two_pass"` needs a
+        `decoder_net` that decodes in parallel: a first teacher-forced pass (without gradients)
+        predicts every position, each gold input token is then replaced by the prediction
+        for its position with probability `scheduled_sampling_ratio`, and a second parallel
+        pass on the mixed inputs gives the logits for the loss.
     """
 
     def __init__(
@@ -218,6 +225,7 @@ class AutoRegressiveSeqDecoder(SeqDecoder):
         beam_search: Lazy[BeamSearch] = Lazy(BeamSearch),
         tie_output_embedding: bool = False,
         scheduled_sampling_ratio: float = 0,
+        scheduled_sampling_mode: str = "loop",
         label_smoothing_ratio: Optional[float] = None,
         tensor_based_metric: Metric = None,
         token_based_metric: Metric = None,
@@ -281,6 +289,143 @@ class AutoRegressiveSeqDecoder(SeqDecoder):
         self._token_based_metric = token_based_metric
 
         self._scheduled_sampling_ratio = scheduled_sampling_ratio
+        if scheduled_sampling_mode not in ("loop", "two_pass"):
+            raise ConfigurationError(
+                f"Unknown scheduled_sampling_mode '{scheduled_sampling_mode}', expected 'loop' or 'two_pass'."
+            )
+        if scheduled_sampling_mode == "two_pass" and not self._decoder_net.decodes_parallel:
+            raise ConfigurationError("Two-pass scheduled sampling requires a decoder_net that decodes in parallel.")
+        self._scheduled_sampling_mode = scheduled_sampling_mode
+
+    def _forward_parallel(
+        self,
+        state: Dict[str, torch.Tensor],
+        previous_steps_predictions: torch.Tensor,
+        previous_steps_mask: torch.BoolTensor,
+    ) -> torch.Tensor:
+        """
+        Decodes all target positions in a single pass of the `decoder_net`.
+        """
+        _, decoder_output = self._decoder_net(
+            previous_state=state,
+            previous_steps_predictions=previous_steps_predictions,
+            encoder_outputs=state["encoder_outputs"],
+            source_mask=state["source_mask"],
+            previous_steps_mask=previous_steps_mask,
+        )
+
+        # shape: (group_size, max_target_sequence_length, num_classes)
+        return self._output_projection_layer(decoder_output)
+
+    def _forward_two_pass_scheduled_sampling(
+        self,
+        state: Dict[str, torch.Tensor],
+        targets: torch.LongTensor,
+        target_embedding: torch.Tensor,
+        target_mask: torch.BoolTensor,
+    ) -> torch.Tensor:
+        """
+        Two-pass scheduled sampling: a teacher-forced pass predicts every position, then gold
+        inputs are replaced by these predictions at a rate of `_scheduled_sampling_ratio`
+        and the decoder is run again, in parallel, on the mixed inputs.
+        """
+        # shape: (batch_size, num_decoding_steps)
+        input_mask = target_mask[:, :-1]
+
+        with torch.no_grad():
+            # shape: (batch_size, num_decoding_steps, num_classes)
+            first_pass_logits = self._forward_parallel(state, target_embedding[:, :-1, :], input_mask)
+            # The prediction at position i is the model's own choice for input i + 1.
+            # shape: (batch_size, num_decoding_steps - 1)
+            predicted_classes = first_pass_logits[:, :-1].argmax(-1)
+
+        # The start symbol is always kept.
+        # shape: (batch_size, num_decoding_steps - 1)
+        replace = torch.rand(predicted_classes.size(), device=predicted_classes.device) < self._scheduled_sampling_ratio
+        mixed_inputs = targets[:, :-1].clone()
+        mixed_inputs[:, 1:] = torch.where(replace, predicted_classes, mixed_inputs[:, 1:])
+
+        # shape: (batch_size, num_decoding_steps, target_embedding_dim)
+        mixed_embedding = self.embedder_factor * self.target_embedder(mixed_inputs)
+        return self._forward_parallel(state, mixed_embedding, input_mask)
+
+    def _forward_step_by_step(
+        self,
+        state: Dict[str, torch.Tensor],
+        targets: torch.LongTensor,
+        target_embedding: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Decodes one step at a time, feeding back the model's own predictions at a rate of
+        `_scheduled_sampling_ratio` during training.
+
+        The decoder inputs of every step are views of two preallocated buffers, one for the gold
+        prefix and one for the prefix of the model's own predictions, instead of being
+        concatenated every step. Each step writes the embedding of its last input in place and
+        each prediction is embedded once. Writing in place is fine for decoder nets that decode in
+        parallel, which rebuild their input (scaled and with positions) before anything saves it
+        for the backward pass; other decoder nets get a copy of the view.
+        """
+        batch_size, target_sequence_length = targets.size()
+
+        # The last input from the target is either padding or the end symbol.
+        # Either way, we don't have to process it.
+        num_decoding_steps = target_sequence_length - 1
+
+        # Initialize target predictions with the start index.
+        # shape: (batch_size,)
+        last_predictions = targets.new_full((batch_size,), fill_value=self._start_index)
+
+        # The model's own predictions are only ever fed back while training.
+        use_predictions = self.training and self._scheduled_sampling_ratio > 0
+
+        # The first `timestep` rows hold the scaled embeddings of the prefix; row `timestep` the
+        # unscaled embedding of the last input, as in `_prepare_output_projections`.
+        # shape (both): (batch_size, num_decoding_steps, target_embedding_dim)
+        gold_inputs = target_embedding[:, :num_decoding_steps].clone()
+        predicted_inputs = gold_inputs.new_empty(gold_inputs.size()) if use_predictions else None
+
+        # shape: (batch_size, num_decoding_steps, num_classes)
+        logits: Optional[torch.Tensor] = None
+
+        for timestep in range(num_decoding_steps):
+            if use_predictions and torch.rand(1).item() < self._scheduled_sampling_ratio:
+                # Use gold tokens at test time and at a rate of 1 - _scheduled_sampling_ratio
+                # during training.
+                inputs = predicted_inputs
+                # shape: (batch_size, )
+                effective_last_prediction = last_predictions
+            else:
+                inputs = gold_inputs
+                # shape: (batch_size, )
+                effective_last_prediction = targets[:, timestep]
+
+            inputs[:, timestep] = self.target_embedder(effective_last_prediction)
+            # shape: (batch_size, steps, target_embedding_dim)
+            steps_inputs = inputs[:, : timestep + 1]
+            if not self._decoder_net.decodes_parallel:
+                steps_inputs = steps_inputs.clone()
+
+            # shape: (batch_size, num_classes)
+            output_projections, state = self._project_steps(steps_inputs, state)
+
+            if logits is None:
+                logits = output_projections.new_empty(
+                    (batch_size, num_decoding_steps, output_projections.size(-1))
+                )
+            logits[:, timestep] = output_projections
+
+            # shape (predicted_classes): (batch_size,)
+            _, predicted_classes = torch.max(output_projections, 1)
+
+            # shape (predicted_classes): (batch_size,)
+            last_predictions = predicted_classes
+            if inputs is gold_inputs:
+                gold_inputs[:, timestep] = target_embedding[:, timestep]
+            if use_predictions:
+                predicted_inputs[:, timestep] = self.embedder_factor * self.target_embedder(predicted_classes)
+
+        return logits
 
     def _forward_beam_search(self, state: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """
@@ -330,7 +475,15 @@ class AutoRegressiveSeqDecoder(SeqDecoder):
         # shape: (batch_size, max_target_batch_sequence_length)
         target_mask = util.get_text_field_mask(target_tokens)
 
-        if self._scheduled_sampling_ratio == 0 and self._decoder_net.decodes_parallel:
+        if self._scheduled_sampling_mode == "two_pass" and self._scheduled_sampling_ratio > 0:
+            if self.training:
+                logits = self._forward_two_pass_scheduled_sampling(
+                    state, targets, target_embedding, target_mask
+                )
+            else:
+                # Without sampling the loop below is plain teacher forcing.
+                logits = self._forward_parallel(state, target_embedding[:, :-1, :], target_mask[:, :-1])
+        elif self._scheduled_sampling_ratio == 0 and self._decoder_net.decodes_parallel:
             _, decoder_output = self._decoder_net(
                 previous_state=state,
                 previous_steps_predictions=target_embedding[:, :-1, :],
@@ -342,71 +495,8 @@ class AutoRegressiveSeqDecoder(SeqDecoder):
             # shape: (group_size, max_target_sequence_length, num_classes)
             logits = self._output_projection_layer(decoder_output)
         else:
-            batch_size = source_mask.size()[0]
-            _, target_sequence_length = targets.size()
-
-            # The last input from the target is either padding or the end symbol.
-            # Either way, we don't have to process it.
-            num_decoding_steps = target_sequence_length - 1
-
-            # Initialize target predictions with the start index.
-            # shape: (batch_size,)
-            last_predictions = source_mask.new_full(
-                (batch_size,), fill_value=self._start_index, dtype=torch.long
-            )
-
-            # shape: (steps, batch_size, target_embedding_dim)
-            steps_embeddings = torch.Tensor([])
-
-            step_logits: List[torch.Tensor] = []
-
-            for timestep in range(num_decoding_steps):
-                if self.training and torch.rand(1).item() < self._scheduled_sampling_ratio:
-                    # Use gold tokens at test time and at a rate of 1 - _scheduled_sampling_ratio
-                    # during training.
-                    # shape: (batch_size, steps, target_embedding_dim)
-                    state["previous_steps_predictions"] = steps_embeddings
-
-                    # shape: (batch_size, )
-                    effective_last_prediction = last_predictions
-                else:
-                    # shape: (batch_size, )
-                    effective_last_prediction = targets[:, timestep]
-
-                    if timestep == 0:
-                        state["previous_steps_predictions"] = torch.Tensor([])
-                    else:
-                        # shape: (batch_size, steps, target_embedding_dim)
-                        state["previous_steps_predictions"] = target_embedding[:, :timestep]
-
-                # shape: (batch_size, num_classes)
-                output_projections, state = self._prepare_output_projections(
-                    effective_last_prediction, state
-                )
-
-                # list of tensors, shape: (batch_size, 1, num_classes)
-                step_logits.append(output_projections.unsqueeze(1))
-
-                # shape (predicted_classes): (batch_size,)
-                _, predicted_classes = torch.max(output_projections, 1)
-
-                # shape (predicted_classes): (batch_size,)
-                last_predictions = predicted_classes
-
-                # shape: (batch_size, 1, target_embedding_dim)
-                last_predictions_embeddings = self.embedder_factor * self.target_embedder(last_predictions).unsqueeze(1)
-
-                # This step is required, since we want to keep up two different prediction history: gold and real
-                if steps_embeddings.shape[-1] == 0:
-                    # There is no previous steps, except for start vectors in `last_predictions`
-                    # shape: (group_size, 1, target_embedding_dim)
-                    steps_embeddings = last_predictions_embeddings
-                else:
-                    # shape: (group_size, steps_count, target_embedding_dim)
-                    steps_embeddings = torch.cat([steps_embeddings, last_predictions_embeddings], 1)
-
             # shape: (batch_size, num_decoding_steps, num_classes)
-            logits = torch.cat(step_logits, 1)
+            logits = self._forward_step_by_step(state, targets, target_embedding)
 
         # Compute loss.
         target_mask = util.get_text_field_mask(target_tokens)
@@ -429,12 +519,6 @@ class AutoRegressiveSeqDecoder(SeqDecoder):
 
         Inputs are the same as for `take_step()`.
         """
-        # shape: (group_size, max_input_sequence_length, encoder_output_dim)
-        encoder_outputs = state["encoder_outputs"]
-
-        # shape: (group_size, max_input_sequence_length)
-        source_mask = state["source_mask"]
-
         # shape: (group_size, steps_count, decoder_output_dim)
         previous_steps_predictions = state.get("previous_steps_predictions")
 
@@ -451,13 +535,23 @@ class AutoRegressiveSeqDecoder(SeqDecoder):
                 [previous_steps_predictions, last_predictions_embeddings], 1
             )
 
+        state["previous_steps_predictions"] = previous_steps_predictions
+        return self._project_steps(previous_steps_predictions, state)
+
+    def _project_steps(
+        self, steps_embeddings: torch.Tensor, state: Dict[str, torch.Tensor]
+    ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """
+        Runs the decoder net on the embeddings of all steps so far, of shape
+        `(group_size, steps_count, target_embedding_dim)`, and projects the output of the last
+        step into the target space.
+        """
         decoder_state, decoder_output = self._decoder_net(
             previous_state=state,
-            encoder_outputs=encoder_outputs,
-            source_mask=source_mask,
-            previous_steps_predictions=previous_steps_predictions,
+            encoder_outputs=state["encoder_outputs"],
+            source_mask=state["source_mask"],
+            previous_steps_predictions=steps_embeddings,
         )
-        state["previous_steps_predictions"] = previous_steps_predictions
 
         # Update state with new decoder state, override previous state
         state.update(decoder_state)
@@ -656,71 +750,8 @@ class AutoRegressiveSeqDecoder(SeqDecoder):
             # shape: (group_size, max_target_sequence_length, num_classes)
             logits = self._output_projection_layer(decoder_output)
         else:
-            batch_size = source_mask.size()[0]
-            _, target_sequence_length = targets.size()
-
-            # The last input from the target is either padding or the end symbol.
-            # Either way, we don't have to process it.
-            num_decoding_steps = target_sequence_length - 1
-
-            # Initialize target predictions with the start index.
-            # shape: (batch_size,)
-            last_predictions = source_mask.new_full(
-                (batch_size,), fill_value=self._start_index, dtype=torch.long
-            )
-
-            # shape: (steps, batch_size, target_embedding_dim)
-            steps_embeddings = torch.Tensor([])
-
-            step_logits: List[torch.Tensor] = []
-
-            for timestep in range(num_decoding_steps):
-                if self.training and torch.rand(1).item() < self._scheduled_sampling_ratio:
-                    # Use gold tokens at test time and at a rate of 1 - _scheduled_sampling_ratio
-                    # during training.
-                    # shape: (batch_size, steps, target_embedding_dim)
-                    state["previous_steps_predictions"] = steps_embeddings
-
-                    # shape: (batch_size, )
-                    effective_last_prediction = last_predictions
-                else:
-                    # shape: (batch_size, )
-                    effective_last_prediction = targets[:, timestep]
-
-                    if timestep == 0:
-                        state["previous_steps_predictions"] = torch.Tensor([])
-                    else:
-                        # shape: (batch_size, steps, target_embedding_dim)
-                        state["previous_steps_predictions"] = target_embedding[:, :timestep]
-
-                # shape: (batch_size, num_classes)
-                output_projections, state = self._prepare_output_projections(
-                    effective_last_prediction, state
-                )
-
-                # list of tensors, shape: (batch_size, 1, num_classes)
-                step_logits.append(output_projections.unsqueeze(1))
-
-                # shape (predicted_classes): (batch_size,)
-                _, predicted_classes = torch.max(output_projections, 1)
-
-                # shape (predicted_classes): (batch_size,)
-                last_predictions = predicted_classes
-
-                # shape: (batch_size, 1, target_embedding_dim)
-                last_predictions_embeddings = self.embedder_factor * self.target_embedder(last_predictions).unsqueeze(1)
-
-                # This step is required, since we want to keep up two different prediction history: gold and real
-                if steps_embeddings.shape[-1] == 0:
-                    # There is no previous steps, except for start vectors in `last_predictions`
-                    # shape: (group_size, 1, target_embedding_dim)
-                    steps_embeddings = last_predictions_embeddings
-                else:
-                    # shape: (group_size, steps_count, target_embedding_dim)
-                    steps_embeddings = torch.cat([steps_embeddings, last_predictions_embeddings], 1)
-
             # shape: (batch_size, num_decoding_steps, num_classes)
-            logits = torch.cat(step_logits, 1)
+            logits = self._forward_step_by_step(state, targets, target_embedding)
 
         probs = torch.softmax(logits, dim=2)
         pred_confidence, pred_indices = torch.max(probs, dim=2)
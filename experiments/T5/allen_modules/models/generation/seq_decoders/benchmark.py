@@ -0,0 +1,254 @@
+"""
+Benchmark of the step-by-step decoding loop of the `modified_auto_regressive_seq_decoder`, the
+former implementation growing its outputs with `torch.cat` against the preallocated one.
+
+    python -m allen_modules.models.generation.seq_decoders.benchmark ../../data/generalization_sets/gen_cogsLF.tsv --cuda-device 0
+
+Source and target pairs are read from the first two columns of the tsv file (e.g. the SLOG
+generalization set) and split on whitespace. The decoder is randomly initialized with a
+vocabulary built from the file, and the encoder is a single embedding layer, so only the
+decoding loop is measured. Every batch runs a forward and backward pass in training mode, the
+peak GPU memory (`torch.cuda.max_memory_allocated`) and the mean time per decoding step are
+reported for both implementations.
+"""
+import argparse
+import csv
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+
+from allennlp.common.util import END_SYMBOL, START_SYMBOL
+from allennlp.data import Vocabulary
+from allennlp.modules import Embedding
+
+from allen_modules.models.generation.decoder_nets.stacked_self_attention import StackedSelfAttentionDecoderNet
+from allen_modules.models.generation.seq_decoders.autoregressive import AutoRegressiveSeqDecoder
+
+StepFunction = Callable[
+    [AutoRegressiveSeqDecoder, Dict[str, torch.Tensor], torch.Tensor, torch.Tensor], torch.Tensor
+]
+
+
+def legacy_step_by_step(
+    decoder: AutoRegressiveSeqDecoder,
+    state: Dict[str, torch.Tensor],
+    targets: torch.Tensor,
+    target_embedding: torch.Tensor,
+) -> torch.Tensor:
+    # The loop of `_forward_loss` before the step buffers were preallocated, kept as the reference.
+    batch_size, target_sequence_length = targets.size()
+    num_decoding_steps = target_sequence_length - 1
+    last_predictions = targets.new_full((batch_size,), fill_value=decoder._start_index)
+    steps_embeddings = torch.Tensor([])
+    step_logits: List[torch.Tensor] = []
+
+    for timestep in range(num_decoding_steps):
+        if decoder.training and torch.rand(1).item() < decoder._scheduled_sampling_ratio:
+            state["previous_steps_predictions"] = steps_embeddings
+            effective_last_prediction = last_predictions
+        else:
+            effective_last_prediction = targets[:, timestep]
+            if timestep == 0:
+                state["previous_steps_predictions"] = torch.Tensor([])
+            else:
+                state["previous_steps_predictions"] = target_embedding[:, :timestep]
+
+        output_projections, state = decoder._prepare_output_projections(effective_last_prediction, state)
+        step_logits.append(output_projections.unsqueeze(1))
+        _, predicted_classes = torch.max(output_projections, 1)
+        last_predictions = predicted_classes
+
+        last_predictions_embeddings = decoder.embedder_factor * decoder.target_embedder(last_predictions).unsqueeze(1)
+        if steps_embeddings.shape[-1] == 0:
+            steps_embeddings = last_predictions_embeddings
+        else:
+            steps_embeddings = torch.cat([steps_embeddings, last_predictions_embeddings], 1)
+
+    return torch.cat(step_logits, 1)
+
+
+def preallocated_step_by_step(
+    decoder: AutoRegressiveSeqDecoder,
+    state: Dict[str, torch.Tensor],
+    targets: torch.Tensor,
+    target_embedding: torch.Tensor,
+) -> torch.Tensor:
+    return decoder._forward_step_by_step(state, targets, target_embedding)
+
+
+def read_pairs(file_path: str, num_instances: Optional[int]) -> List[Tuple[List[str], List[str]]]:
+    pairs = []
+    with open(file_path, "r") as data_file:
+        for row in csv.reader(data_file, delimiter="\t", quoting=csv.QUOTE_NONE):
+            if len(row) < 2 or not row[0] or not row[1]:
+                continue
+            pairs.append((row[0].split(), [START_SYMBOL] + row[1].split() + [END_SYMBOL]))
+            if num_instances is not None and len(pairs) == num_instances:
+                break
+    if not pairs:
+        raise ValueError("No source and target pairs in {}".format(file_path))
+    return pairs
+
+
+def build_vocab(pairs: List[Tuple[List[str], List[str]]]) -> Vocabulary:
+    vocab = Vocabulary()
+    for source, target in pairs:
+        vocab.add_tokens_to_namespace(source, "source_tokens")
+        vocab.add_tokens_to_namespace(target, "target_tokens")
+    return vocab
+
+
+def to_tensor(sequences: List[List[str]], vocab: Vocabulary, namespace: str, device: torch.device) -> torch.Tensor:
+    # Index 0 is the padding of every namespace.
+    ids = torch.zeros((len(sequences), max(len(sequence) for sequence in sequences)), dtype=torch.long)
+    for row, sequence in enumerate(sequences):
+        ids[row, : len(sequence)] = torch.tensor([vocab.get_token_index(token, namespace) for token in sequence])
+    return ids.to(device)
+
+
+def make_batches(
+    pairs: List[Tuple[List[str], List[str]]], vocab: Vocabulary, batch_size: int, device: torch.device
+) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    batches = []
+    for start in range(0, len(pairs), batch_size):
+        chunk = pairs[start : start + batch_size]
+        batches.append(
+            (
+                to_tensor([source for source, _ in chunk], vocab, "source_tokens", device),
+                to_tensor([target for _, target in chunk], vocab, "target_tokens", device),
+            )
+        )
+    return batches
+
+
+def decode_batch(
+    decoder: AutoRegressiveSeqDecoder,
+    source_embedder: Embedding,
+    step_function: StepFunction,
+    source_ids: torch.Tensor,
+    targets: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    source_mask = source_ids != 0
+    state = {"encoder_outputs": source_embedder(source_ids), "source_mask": source_mask}
+    state.update(decoder._decoder_net.init_decoder_state(state))
+    target_embedding = decoder.embedder_factor * decoder.target_embedder(targets)
+    logits = step_function(decoder, state, targets, target_embedding)
+    return logits, decoder._get_loss(logits, targets, targets != 0)
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def run(
+    decoder: AutoRegressiveSeqDecoder,
+    source_embedder: Embedding,
+    step_function: StepFunction,
+    batches: List[Tuple[torch.Tensor, torch.Tensor]],
+    device: torch.device,
+) -> Tuple[Optional[float], float]:
+    """
+    Returns the peak GPU memory in MB (`None` on the CPU) and the mean seconds per decoding step.
+    """
+    parameters = list(decoder.parameters()) + list(source_embedder.parameters())
+    # Warm up the allocator and the kernels.
+    _, loss = decode_batch(decoder, source_embedder, step_function, *batches[0])
+    loss.backward()
+    for parameter in parameters:
+        parameter.grad = None
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    num_steps = 0
+    synchronize(device)
+    start = time.perf_counter()
+    for source_ids, targets in batches:
+        _, loss = decode_batch(decoder, source_embedder, step_function, source_ids, targets)
+        loss.backward()
+        for parameter in parameters:
+            parameter.grad = None
+        num_steps += targets.size(1) - 1
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    peak_memory = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == "cuda" else None
+    return peak_memory, elapsed / num_steps
+
+
+def check_outputs(
+    decoder: AutoRegressiveSeqDecoder,
+    source_embedder: Embedding,
+    batch: Tuple[torch.Tensor, torch.Tensor],
+) -> None:
+    # The same random draws for scheduled sampling and dropout give the same logits.
+    outputs = []
+    for step_function in (legacy_step_by_step, preallocated_step_by_step):
+        torch.manual_seed(0)
+        with torch.no_grad():
+            outputs.append(decode_batch(decoder, source_embedder, step_function, *batch)[0])
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-5), "preallocated decoding differs from the reference"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data_file", type=str, help="tsv file with source and target columns")
+    parser.add_argument("--num-instances", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--cuda-device", type=int, default=-1)
+    parser.add_argument("--decoding-dim", type=int, default=512)
+    parser.add_argument("--num-layers", type=int, default=3)
+    parser.add_argument("--num-attention-heads", type=int, default=8)
+    parser.add_argument(
+        "--scheduled-sampling-ratio",
+        type=float,
+        default=0.5,
+        help="rate of the model's own predictions fed back while training; the stacked "
+        "self-attention decoder only decodes step by step when it is above 0",
+    )
+    args = parser.parse_args()
+
+    device = torch.device("cuda", args.cuda_device) if args.cuda_device >= 0 else torch.device("cpu")
+    pairs = read_pairs(args.data_file, args.num_instances)
+    vocab = build_vocab(pairs)
+    batches = make_batches(pairs, vocab, args.batch_size, device)
+
+    torch.manual_seed(0)
+    source_embedder = Embedding(
+        embedding_dim=args.decoding_dim, num_embeddings=vocab.get_vocab_size("source_tokens")
+    )
+    decoder = AutoRegressiveSeqDecoder(
+        vocab,
+        StackedSelfAttentionDecoderNet(
+            decoding_dim=args.decoding_dim,
+            encoder_output_dim=args.decoding_dim,
+            target_embedding_dim=args.decoding_dim,
+            feedforward_hidden_dim=4 * args.decoding_dim,
+            num_layers=args.num_layers,
+            num_attention_heads=args.num_attention_heads,
+        ),
+        Embedding(embedding_dim=args.decoding_dim, num_embeddings=vocab.get_vocab_size("target_tokens")),
+        target_namespace="target_tokens",
+        scheduled_sampling_ratio=args.scheduled_sampling_ratio,
+    )
+    source_embedder.to(device).train()
+    decoder.to(device).train()
+
+    check_outputs(decoder, source_embedder, batches[0])
+    print("{} instances in batches of {}, scheduled sampling ratio {}".format(
+        len(pairs), args.batch_size, args.scheduled_sampling_ratio))
+    results = {}
+    for name, step_function in (("torch.cat", legacy_step_by_step), ("preallocated", preallocated_step_by_step)):
+        results[name] = run(decoder, source_embedder, step_function, batches, device)
+        peak_memory, step_time = results[name]
+        print("{:<13} peak memory: {}, mean step time: {:.3f}ms".format(
+            name + ":",
+            "{:.1f}MB".format(peak_memory) if peak_memory is not None else "n/a (CPU)",
+            1000 * step_time,
+        ))
+    print("step time speedup: {:.2f}x".format(results["torch.cat"][1] / results["preallocated"][1]))
+
+
+if __name__ == "__main__":
+    main()
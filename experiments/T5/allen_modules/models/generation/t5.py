@@ -1,11 +1,15 @@
+import csv
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from os import PathLike
 from typing import Optional, Dict, Any, Union, List, Tuple
 
 import numpy as np
 import torch
-# Set the maximal number of CPU cores
-torch.set_num_threads(4)
 
+from allennlp.common.checks import ConfigurationError
+from allennlp.common.file_utils import cached_path
 from allennlp.common.lazy import Lazy
 from allennlp.data import TextFieldTensors, Vocabulary
 from allennlp.data.tokenizers import PretrainedTransformerTokenizer
@@ -16,11 +20,18 @@ from allennlp.nn.beam_search import BeamSearch
 from allennlp.nn.checkpoint import CheckpointWrapper
 from allennlp.training.metrics import ROUGE, BLEU
 
+from allen_modules.common.profiling import profile_stage
+from allen_modules.common.threads import ThreadingPolicy
 from allen_modules.training.metrics.exact_match import ExactMatchAcc
 from allen_modules.training.metrics.epoch import EpochsPassed
-from allen_modules.training.postprocess.postprocessor import Postprocessor
+from allen_modules.training.metrics.bracket_balance import BracketBalance
+from allen_modules.training.metrics.teacher_forced import TeacherForcedAccuracy
+from allen_modules.training.postprocess.postprocessor import Postprocessor, BracketStats
 from allen_modules.training.postprocess.simple import SimplePostprocessor
 from allen_modules.modules.transformer.t5 import T5 as T5Module
+from allen_modules.modules.transformer.weights_cache import skip_pretrained_weights
+
+logger = logging.getLogger(__name__)
 
 @Model.register("modified_t5")
 class T5(Model):
@@ -35,9 +46,18 @@ class T5(Model):
         print_err: bool = False,
         val_epoch: bool = False,
         val_bleu: bool = False,
+        restrict_output_vocab: Optional[str] = None,
+        async_decoding: bool = False,
+        cpu_threads: Optional[ThreadingPolicy] = None,
+        autocast_dtype: Optional[str] = None,
+        cache_pretrained_weights: bool = True,
         **kwargs
     ) -> None:
         super().__init__(vocab, **kwargs)
+        # Applied before the pretrained weights are loaded, inter-op threads can only be set
+        # before the first parallel operator runs.
+        if cpu_threads is not None:
+            cpu_threads.apply()
         self._model_name = model_name
         # We only instantiate this when we need it.
         self._tokenizer: Optional[PretrainedTransformerTokenizer] = None
@@ -48,6 +68,7 @@ class T5(Model):
             ddp_accelerator=self.ddp_accelerator,
             checkpoint_wrapper=checkpoint_wrapper,
             weights_path=weights_path,
+            use_weights_cache=cache_pretrained_weights,
         )
         # print("Set beam size to 4")
         # print(self.t5.beam_search.beam_size)
@@ -57,15 +78,34 @@ class T5(Model):
         #     for parameter in self.t5.decoder.parameters():
         #         parameter.requires_grad = False
 
+        # Beam search only scores the token ids that occur in the targets of this (training) file.
+        if restrict_output_vocab is not None:
+            self.t5.restrict_output_vocab(self._read_target_token_ids(restrict_output_vocab))
+
         exclude_indices = {
             self.t5.pad_token_id,
             self.t5.decoder_start_token_id,
             self.t5.eos_token_id,
         }
+        # Mixed precision: the forward pass runs under autocast, the weights (and so the optimizer
+        # state) stay in fp32. bfloat16 has the range of fp32, so no gradient scaling is needed.
+        if autocast_dtype is not None and autocast_dtype not in ("bfloat16", "float16"):
+            raise ConfigurationError(
+                f"autocast_dtype must be 'bfloat16' or 'float16', got '{autocast_dtype}'"
+            )
+        self._autocast_dtype = getattr(torch, autocast_dtype) if autocast_dtype is not None else None
         self.postprocessor = postprocessor
         # Use exact match accuracy as main validation metric
         self._acc = ExactMatchAcc(print_err=print_err)
-        self._metrics = [self._acc]
+        # Teacher-forced greedy accuracy, computed from the logits of the validation loss
+        self._proxy = TeacherForcedAccuracy()
+        self._metrics = [self._acc, self._proxy]
+        # Set by the "proxy_validation" callback: validation only runs the teacher-forced pass
+        # and skips beam search.
+        self.proxy_validation = False
+        if self.postprocessor is not None:
+            self._brackets = BracketBalance()
+            self._metrics.append(self._brackets)
 
         # For most experiments, we want to maintain epoch number to train for a certain number of epochs
         self.val_epoch = val_epoch
@@ -78,6 +118,15 @@ class T5(Model):
             self._bleu = BLEU(exclude_indices=exclude_indices)
             self._metrics.append(self._bleu)
 
+        # Decode, postprocess and score the predictions of a validation batch in a background
+        # thread, so the next batch is already running on the device. `predicted_text` is then
+        # not part of the output of `forward`, and the metrics catch up at `get_metrics(reset=True)`.
+        self.async_decoding = async_decoding
+        # Created on first use.
+        self._decoding_executor: Optional[ThreadPoolExecutor] = None
+        self._decoding_lock: Optional[threading.Lock] = None
+        self._pending_decodes: List[Future] = []
+
 
     def _post_load_state_dict(
         self, missing_keys: List[str], unexpected_keys: List[str]
@@ -93,6 +142,15 @@ class T5(Model):
                 missing_keys.remove(key)
         return missing_keys, unexpected_keys
 
+    def _read_target_token_ids(self, file_path: str) -> List[int]:
+        with open(cached_path(file_path), "r") as data_file:
+            targets = [row[1] for row in csv.reader(data_file, delimiter="\t") if len(row) > 1]
+        token_ids = set()
+        for input_ids in self.tokenizer.tokenizer(targets)["input_ids"]:
+            token_ids.update(input_ids)
+        logger.info("Restricting the output vocabulary to %d token ids from %s", len(token_ids), file_path)
+        return sorted(token_ids)
+
     @property
     def tokenizer(self) -> PretrainedTransformerTokenizer:
         if self._tokenizer is None:
@@ -138,17 +196,27 @@ class T5(Model):
         elif self.training:
             raise ValueError("'target_tokens' required during training")
 
-        output: T5Output = self.t5(
-            input_ids,
-            attention_mask=attention_mask,
-            labels=labels,
-            decoder_attention_mask=decoder_attention_mask,
-        )
+        with torch.autocast(
+            device_type=input_ids.device.type,
+            dtype=self._autocast_dtype or torch.bfloat16,
+            enabled=self._autocast_dtype is not None,
+        ):
+            output: T5Output = self.t5(
+                input_ids,
+                attention_mask=attention_mask,
+                labels=labels,
+                decoder_attention_mask=decoder_attention_mask,
+                run_beam_search=not (self.proxy_validation and labels is not None),
+            )
         output_dict: Dict[str, torch.Tensor] = {}
 
         if self.training:
             assert output.loss is not None
             output_dict["loss"] = output.loss
+        elif self.proxy_validation and labels is not None:
+            assert output.logits is not None and output.loss is not None
+            self._proxy(output.logits, labels, decoder_attention_mask)
+            output_dict["loss"] = output.loss.mean()
         else:
             # Shape: (batch_size, beam_size, num_tokens)
             assert output.predictions is not None
@@ -159,14 +227,27 @@ class T5(Model):
             # Shape: (batch_size, )
             output_dict["predicted_log_probs"] = output.predicted_log_probs[:, 0]
 
-            output_dict = self.make_output_human_readable(output_dict)
+            if self.async_decoding:
+                self._submit_decoding(
+                    output_dict["predictions"], metadata if labels is not None else None
+                )
+            else:
+                output_dict["predicted_text"], bracket_stats = self._decode_predictions(
+                    output_dict["predictions"]
+                )
+                if self.postprocessor is not None:
+                    self._brackets(bracket_stats)
 
             if self.val_epoch:
                 self._epochs()
 
             if labels is not None:
-                # Compute exact match accuracy as main validation metric
-                self._acc(output_dict["predicted_text"], metadata)
+                if not self.async_decoding:
+                    # Compute exact match accuracy as main validation metric
+                    self._acc(output_dict["predicted_text"], metadata)
+
+                assert output.logits is not None
+                self._proxy(output.logits, labels, decoder_attention_mask)
 
                 if self.val_bleu:
                     self._bleu(output_dict["predictions"], labels)
@@ -183,25 +264,83 @@ class T5(Model):
 
         return output_dict
 
+    def _decode_predictions(self, predictions: torch.Tensor) -> Tuple[List[str], BracketStats]:
+        with profile_stage("decode/batch_decode"):
+            predicted_texts = self.tokenizer.tokenizer.batch_decode(
+                predictions, skip_special_tokens=self.postprocessor.skip_special_tokens if self.postprocessor is not None else True, clean_up_tokenization_spaces=False  # type: ignore[attr-defined]
+            )
+        if self.postprocessor is None:
+            return predicted_texts, BracketStats()
+        # One tokenization pass per prediction, which also measures the bracket balance.
+        with profile_stage("decode/postprocess"):
+            return self.postprocessor.process_batch(predicted_texts)
+
+    def _submit_decoding(self, predictions: torch.Tensor, metadata: Optional[List[Dict]]) -> None:
+        if self._decoding_executor is None:
+            # A single worker keeps the updates in batch order.
+            self._decoding_executor = ThreadPoolExecutor(max_workers=1)
+        if self._decoding_lock is None:
+            self._decoding_lock = threading.Lock()
+        # Resolve the lazy tokenizer here, not in the worker.
+        self.tokenizer
+        # Beam search has already synchronized with the device, so this copy is cheap.
+        predictions = predictions.detach().cpu()
+        pending = []
+        for future in self._pending_decodes:
+            if future.done():
+                # Re-raises any error of the worker.
+                future.result()
+            else:
+                pending.append(future)
+        self._pending_decodes = pending
+        self._pending_decodes.append(
+            self._decoding_executor.submit(self._decode_and_score, predictions, metadata)
+        )
+
+    def _decode_and_score(self, predictions: torch.Tensor, metadata: Optional[List[Dict]]) -> None:
+        predicted_texts, bracket_stats = self._decode_predictions(predictions)
+        with self._decoding_lock:
+            if self.postprocessor is not None:
+                self._brackets(bracket_stats)
+            if metadata is not None:
+                self._acc(predicted_texts, metadata)
+
+    def _wait_for_decoding(self) -> None:
+        pending, self._pending_decodes = self._pending_decodes, []
+        try:
+            for future in pending:
+                # Re-raises any error of the worker.
+                future.result()
+        finally:
+            # The worker thread is started again by the next validation.
+            if self._decoding_executor is not None:
+                self._decoding_executor.shutdown(wait=True)
+                self._decoding_executor = None
+
     def make_output_human_readable(self, output_dict: Dict[str, torch.Tensor]) -> Dict[str, Any]:
         # print(output_dict.keys())
-        predictions = output_dict["predictions"]
-
-        predicted_texts = self.tokenizer.tokenizer.batch_decode(
-            predictions, skip_special_tokens=self.postprocessor.skip_special_tokens if self.postprocessor is not None else True, clean_up_tokenization_spaces=False  # type: ignore[attr-defined]
-        )
-        if self.postprocessor is not None:
-            output_dict["predicted_text"] = self.postprocessor(predicted_texts)
-        else:
-            output_dict["predicted_text"] = predicted_texts
+        # The bracket statistics are only recorded in `forward`, which has already decoded the
+        # text unless the decoding is asynchronous.
+        if "predicted_text" not in output_dict:
+            output_dict["predicted_text"], _ = self._decode_predictions(output_dict["predictions"])
 
         return output_dict
 
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         metrics: Dict[str, float] = {}
         if not self.training:
-            for metric in self._metrics:
-                metrics.update(metric.get_metric(reset=reset))
+            if self.proxy_validation:
+                return self._proxy.get_metric(reset=reset)
+            if self._decoding_lock is None:
+                for metric in self._metrics:
+                    metrics.update(metric.get_metric(reset=reset))
+                return metrics
+            if reset:
+                self._wait_for_decoding()
+            # Without a reset these are the metrics of the batches decoded so far.
+            with self._decoding_lock:
+                for metric in self._metrics:
+                    metrics.update(metric.get_metric(reset=reset))
         return metrics
 
     @classmethod
@@ -218,7 +357,8 @@ class T5(Model):
         """
         from allennlp.models.archival import load_archive  # here to avoid circular imports
 
-        model = load_archive(archive_file, weights_file=weights_file).model
+        with skip_pretrained_weights():
+            model = load_archive(archive_file, weights_file=weights_file).model
         if vocab:
             model.vocab.extend_from_vocab(vocab)
             model.extend_embedder_vocab()
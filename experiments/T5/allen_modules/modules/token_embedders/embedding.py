@@ -1,11 +1,17 @@
+import functools
+import hashlib
 import io
 import itertools
+import json
 import logging
+import os
 import re
+import shutil
 import tarfile
+import tempfile
 import warnings
 import zipfile
-from typing import Any, cast, Iterator, NamedTuple, Optional, Sequence, Tuple, BinaryIO
+from typing import Any, cast, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, BinaryIO
 
 import numpy
 import torch
@@ -14,7 +20,12 @@ from torch.nn.functional import embedding
 
 from allennlp.common import Tqdm
 from allennlp.common.checks import ConfigurationError
-from allennlp.common.file_utils import cached_path, get_file_extension, is_url_or_existing_file
+from allennlp.common.file_utils import (
+    CACHE_DIRECTORY,
+    cached_path,
+    get_file_extension,
+    is_url_or_existing_file,
+)
 from allennlp.data.vocabulary import Vocabulary
 from allennlp.modules.time_distributed import TimeDistributed
 from allennlp.modules.token_embedders.token_embedder import TokenEmbedder
@@ -86,6 +97,10 @@ class Embedding(TokenEmbedder):
         In a typical AllenNLP configuration file, this parameter does not get an entry under the
         "embedding", it gets specified as a top-level parameter, then is passed in to this module
         separately.
+    incremental_extension : `bool`, optional (default = `True`)
+        If `True`, `extend_vocab` only looks up the new tokens in the (cached, binary) pretrained
+        text file and fills the new rows with one gather. If `False`, it reads the embeddings of
+        the whole extended vocabulary and keeps the new rows, as allennlp does.
 
     # Returns
 
@@ -107,7 +122,8 @@ class Embedding(TokenEmbedder):
         vocab_namespace: str = "tokens",
         pretrained_file: str = None,
         vocab: Vocabulary = None,
-        initializer: InitializerApplicator = None
+        initializer: InitializerApplicator = None,
+        incremental_extension: bool = True,
     ) -> None:
         super().__init__()
 
@@ -132,6 +148,7 @@ class Embedding(TokenEmbedder):
         self.sparse = sparse
         self._vocab_namespace = _vocab_namespace
         self._pretrained_file = pretrained_file
+        self._incremental_extension = incremental_extension
 
         self.output_dim = projection_dim or embedding_dim
 
@@ -301,6 +318,16 @@ class Embedding(TokenEmbedder):
             )
 
         embedding_dim = self.weight.data.shape[-1]
+        if (
+            extension_pretrained_file
+            and self._incremental_extension
+            and get_file_extension(extension_pretrained_file) not in [".h5", ".hdf5"]
+        ):
+            self._extend_vocab_incrementally(
+                extended_vocab, vocab_namespace, extension_pretrained_file
+            )
+            return
+
         if not extension_pretrained_file:
             extra_num_embeddings = extended_num_embeddings - self.num_embeddings
             extra_weight = torch.FloatTensor(extra_num_embeddings, embedding_dim)
@@ -318,6 +345,46 @@ class Embedding(TokenEmbedder):
         self.weight = torch.nn.Parameter(extended_weight, requires_grad=self.weight.requires_grad)
         self.num_embeddings = extended_num_embeddings
 
+    def _extend_vocab_incrementally(
+        self, extended_vocab: Vocabulary, vocab_namespace: str, pretrained_file: str
+    ) -> None:
+        """
+        Appends the rows of the tokens of `extended_vocab` beyond `num_embeddings`. Only those
+        tokens are looked up in the token index of the binary `pretrained_file` (converted and
+        loaded once per process, so the text file is never scanned again), and their vectors
+        are read with a single gather. The new tokens without a pretrained vector are drawn
+        from a normal distribution with the mean and standard deviation of the new pretrained
+        vectors, or of the current embeddings if there are none.
+        """
+        embedding_dim = self.weight.data.shape[-1]
+        extended_num_embeddings = extended_vocab.get_vocab_size(vocab_namespace)
+        index_to_token = extended_vocab.get_index_to_token_vocabulary(vocab_namespace)
+        new_tokens = [
+            index_to_token[i] for i in range(self.num_embeddings, extended_num_embeddings)
+        ]
+        binary_embeddings = BinaryEmbeddings.from_text_file(pretrained_file, embedding_dim)
+        positions, vectors = binary_embeddings.lookup(new_tokens)
+        logger.info(
+            "Pretrained embeddings were found for %d out of %d new tokens",
+            len(positions),
+            len(new_tokens),
+        )
+
+        old_weight = self.weight.data
+        statistics = vectors if len(positions) else old_weight
+        extended_weight = old_weight.new_empty(extended_num_embeddings, embedding_dim)
+        extended_weight[: self.num_embeddings] = old_weight
+        extended_weight[self.num_embeddings :].normal_(
+            float(statistics.mean()), float(statistics.std(unbiased=False))
+        )
+        if positions:
+            rows = torch.tensor(positions, dtype=torch.long, device=old_weight.device)
+            extended_weight[self.num_embeddings + rows] = vectors.to(
+                device=old_weight.device, dtype=old_weight.dtype
+            )
+        self.weight = torch.nn.Parameter(extended_weight, requires_grad=self.weight.requires_grad)
+        self.num_embeddings = extended_num_embeddings
+
 
 def _read_pretrained_embeddings_file(
     file_uri: str, embedding_dim: int, vocab: Vocabulary, namespace: str = "tokens"
@@ -381,75 +448,16 @@ def _read_embeddings_from_text_file(
 
     Lines that contain more numerical tokens than `embedding_dim` raise a warning and are skipped.
 
+    The file is converted once into a binary matrix and a token index (see
+    `BinaryEmbeddings`), later reads only gather the rows of the vocabulary from the
+    memory-mapped matrix.
+
     The remainder of the docstring is identical to `_read_pretrained_embeddings_file`.
     """
-    tokens_to_keep = set(vocab.get_index_to_token_vocabulary(namespace).values())
-    vocab_size = vocab.get_vocab_size(namespace)
-    embeddings = {}
-
-    # First we read the embeddings from the file, only keeping vectors for the words we need.
-    logger.info("Reading pretrained embeddings from file")
-
-    with EmbeddingsTextFile(file_uri) as embeddings_file:
-        for line in Tqdm.tqdm(embeddings_file):
-            token = line.split(" ", 1)[0]
-            if token in tokens_to_keep:
-                fields = line.rstrip().split(" ")
-                if len(fields) - 1 != embedding_dim:
-                    # Sometimes there are funny unicode parsing problems that lead to different
-                    # fields lengths (e.g., a word with a unicode space character that splits
-                    # into more than one column).  We skip those lines.  Note that if you have
-                    # some kind of long header, this could result in all of your lines getting
-                    # skipped.  It's hard to check for that here; you just have to look in the
-                    # embedding_misses_file and at the model summary to make sure things look
-                    # like they are supposed to.
-                    logger.warning(
-                        "Found line with wrong number of dimensions (expected: %d; actual: %d): %s",
-                        embedding_dim,
-                        len(fields) - 1,
-                        line,
-                    )
-                    continue
-
-                vector = numpy.asarray(fields[1:], dtype="float32")
-                embeddings[token] = vector
-
-    if not embeddings:
-        raise ConfigurationError(
-            "No embeddings of correct dimension found; you probably "
-            "misspecified your embedding_dim parameter, or didn't "
-            "pre-populate your Vocabulary"
-        )
-
-    all_embeddings = numpy.asarray(list(embeddings.values()))
-    embeddings_mean = float(numpy.mean(all_embeddings))
-    embeddings_std = float(numpy.std(all_embeddings))
-    # Now we initialize the weight matrix for an embedding layer, starting with random vectors,
-    # then filling in the word vectors we just read.
-    logger.info("Initializing pre-trained embedding layer")
-    embedding_matrix = torch.FloatTensor(vocab_size, embedding_dim).normal_(
-        embeddings_mean, embeddings_std
-    )
-    num_tokens_found = 0
+    binary_embeddings = BinaryEmbeddings.from_text_file(file_uri, embedding_dim)
     index_to_token = vocab.get_index_to_token_vocabulary(namespace)
-    for i in range(vocab_size):
-        token = index_to_token[i]
-
-        # If we don't have a pre-trained vector for this word, we'll just leave this row alone,
-        # so the word has a random initialization.
-        if token in embeddings:
-            embedding_matrix[i] = torch.FloatTensor(embeddings[token])
-            num_tokens_found += 1
-        else:
-            logger.debug(
-                "Token %s was not found in the embedding file. Initialising randomly.", token
-            )
-
-    logger.info(
-        "Pretrained embeddings were found for %d out of %d tokens", num_tokens_found, vocab_size
-    )
-
-    return embedding_matrix
+    vocab_size = vocab.get_vocab_size(namespace)
+    return binary_embeddings.embedding_matrix([index_to_token[i] for i in range(vocab_size)])
 
 
 def _read_embeddings_from_hdf5(
@@ -494,6 +502,168 @@ def parse_embeddings_file_uri(uri: str) -> "EmbeddingsFileURI":
         return EmbeddingsFileURI(uri, None)
 
 
+class BinaryEmbeddings:
+    """
+    A pretrained embeddings text file converted into a float32 matrix (`vectors.bin`, one row
+    per token) and the tokens of its rows (`tokens.txt`). The conversion runs once per file and
+    `embedding_dim` and is cached next to allennlp's downloads; the matrix is memory-mapped, so
+    only the rows of the tokens that are looked up are read from disk.
+
+    Use `BinaryEmbeddings.from_text_file`, which also keeps the loaded index for the lifetime of
+    the process.
+    """
+
+    # Bump when the binary format changes.
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        self.embedding_dim: int = meta["embedding_dim"]
+        with open(os.path.join(directory, "tokens.txt"), "rb") as tokens_file:
+            tokens = tokens_file.read().decode("utf-8").split("\n") if meta["num_rows"] else []
+        # Later lines of a token win, like they did when the text file was read directly.
+        self.token_to_row: Dict[str, int] = {token: row for row, token in enumerate(tokens)}
+        self.vectors = numpy.memmap(
+            os.path.join(directory, "vectors.bin"),
+            dtype=numpy.float32,
+            mode="r",
+            shape=(meta["num_rows"], self.embedding_dim),
+        ) if meta["num_rows"] else numpy.zeros((0, self.embedding_dim), dtype=numpy.float32)
+
+    @classmethod
+    def from_text_file(cls, file_uri: str, embedding_dim: int) -> "BinaryEmbeddings":
+        """
+        Returns the binary embeddings of the text file `file_uri`, converting it the first time.
+        """
+        main_file_uri, _ = parse_embeddings_file_uri(file_uri)
+        stat = os.stat(cached_path(main_file_uri))
+        key = "\t".join(
+            [file_uri, str(embedding_dim), str(stat.st_size), str(stat.st_mtime_ns), str(cls.FORMAT_VERSION)]
+        )
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", os.path.basename(main_file_uri))
+        directory = os.path.join(CACHE_DIRECTORY, "binary_embeddings", f"{name}-{digest}")
+        if not os.path.isfile(os.path.join(directory, "meta.json")):
+            _convert_embeddings_text_file(file_uri, embedding_dim, directory)
+        return _load_binary_embeddings(directory)
+
+    def lookup(self, tokens: Sequence[str]) -> Tuple[List[int], torch.FloatTensor]:
+        """
+        Returns the positions in `tokens` that have a pretrained vector, and those vectors
+        (shape `(num_found, embedding_dim)`), read with a single gather.
+        """
+        positions = []
+        rows = []
+        for position, token in enumerate(tokens):
+            row = self.token_to_row.get(token)
+            if row is not None:
+                positions.append(position)
+                rows.append(row)
+        if not rows:
+            return positions, torch.zeros(0, self.embedding_dim)
+        rows_array = numpy.asarray(rows, dtype=numpy.int64)
+        # Reading the rows in file order keeps the reads of the memory map sequential.
+        order = numpy.argsort(rows_array, kind="stable")
+        vectors = numpy.empty((len(rows), self.embedding_dim), dtype=numpy.float32)
+        vectors[order] = self.vectors[rows_array[order]]
+        return positions, torch.from_numpy(vectors)
+
+    def embedding_matrix(self, tokens: Sequence[str]) -> torch.FloatTensor:
+        """
+        Returns an embedding matrix for `tokens`. Tokens without a pretrained vector are randomly
+        initialized with a normal distribution with mean and standard deviation equal to those of
+        the pretrained vectors that were found.
+        """
+        positions, vectors = self.lookup(tokens)
+        if not positions:
+            raise ConfigurationError(
+                "No embeddings of correct dimension found; you probably "
+                "misspecified your embedding_dim parameter, or didn't "
+                "pre-populate your Vocabulary"
+            )
+        embeddings_mean = float(vectors.mean())
+        embeddings_std = float(vectors.std(unbiased=False))
+        # Now we initialize the weight matrix for an embedding layer, starting with random vectors,
+        # then filling in the word vectors we just read.
+        logger.info("Initializing pre-trained embedding layer")
+        embedding_matrix = torch.FloatTensor(len(tokens), self.embedding_dim).normal_(
+            embeddings_mean, embeddings_std
+        )
+        embedding_matrix[torch.tensor(positions, dtype=torch.long)] = vectors
+        logger.info(
+            "Pretrained embeddings were found for %d out of %d tokens", len(positions), len(tokens)
+        )
+        return embedding_matrix
+
+
+@functools.lru_cache(maxsize=None)
+def _load_binary_embeddings(directory: str) -> BinaryEmbeddings:
+    return BinaryEmbeddings(directory)
+
+
+def _convert_embeddings_text_file(file_uri: str, embedding_dim: int, directory: str) -> None:
+    """
+    Converts the text embeddings file `file_uri` into the `BinaryEmbeddings` files in
+    `directory`. Lines whose number of fields doesn't match `embedding_dim` are skipped.
+    """
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    logger.info("Converting pretrained embeddings from %s into a binary matrix", file_uri)
+    try:
+        tokens: List[str] = []
+        num_skipped = 0
+        buffer: List[List[str]] = []
+        with EmbeddingsTextFile(file_uri) as embeddings_file, open(
+            os.path.join(tmp_dir, "vectors.bin"), "wb"
+        ) as vectors_file:
+            for line in Tqdm.tqdm(embeddings_file):
+                fields = line.rstrip().split(" ")
+                if len(fields) - 1 != embedding_dim:
+                    # Sometimes there are funny unicode parsing problems that lead to different
+                    # fields lengths (e.g., a word with a unicode space character that splits
+                    # into more than one column).  We skip those lines.
+                    num_skipped += 1
+                    logger.debug(
+                        "Found line with wrong number of dimensions (expected: %d; actual: %d): %s",
+                        embedding_dim,
+                        len(fields) - 1,
+                        line,
+                    )
+                    continue
+                tokens.append(fields[0])
+                buffer.append(fields[1:])
+                if len(buffer) == 10000:
+                    numpy.asarray(buffer, dtype=numpy.float32).tofile(vectors_file)
+                    buffer = []
+            if buffer:
+                numpy.asarray(buffer, dtype=numpy.float32).tofile(vectors_file)
+        if num_skipped:
+            logger.warning(
+                "Skipped %d lines with a wrong number of dimensions (expected: %d)",
+                num_skipped,
+                embedding_dim,
+            )
+        with open(os.path.join(tmp_dir, "tokens.txt"), "wb") as tokens_file:
+            tokens_file.write("\n".join(tokens).encode("utf-8"))
+        # Written last, its presence marks a complete conversion.
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as meta_file:
+            json.dump(
+                {"file_uri": file_uri, "embedding_dim": embedding_dim, "num_rows": len(tokens)},
+                meta_file,
+            )
+        try:
+            os.rename(tmp_dir, directory)
+        except OSError:
+            # Another process has converted the file in the meantime.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
 class EmbeddingsTextFile(Iterator[str]):
     """
     Utility class for opening embeddings text files. Handles various compression formats,
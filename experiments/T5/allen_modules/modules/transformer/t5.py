@@ -1,4 +1,7 @@
+import functools
 import logging
+import os
+from os import PathLike
 from typing import Optional, Tuple, List, Union, Dict, TYPE_CHECKING, NamedTuple, Callable
 
 import torch
@@ -8,6 +11,7 @@ from torch.nn import CrossEntropyLoss
 
 from allennlp.common import FromParams, Params, Lazy, Registrable
 from allennlp.common.checks import ConfigurationError
+from allennlp.common.util import is_distributed
 from allennlp.modules.transformer.transformer_module import TransformerModule
 from allennlp.modules.transformer.attention_module import (
     T5Attention,
@@ -23,10 +27,17 @@ from allennlp.modules.transformer.util import (
 from allennlp.nn.beam_search import BeamSearch
 from allennlp.nn.parallel import DdpAccelerator
 from allennlp.nn.checkpoint import CheckpointWrapper
+from allennlp.nn.util import _check_incompatible_keys
+
+from allen_modules.common.profiling import profile_stage
+from allen_modules.nn.beam_search import COGSConstrainedBeamSearch
+from allen_modules.modules.transformer import weights_cache
 
 if TYPE_CHECKING:
     from transformers.configuration_utils import PretrainedConfig
 
+logger = logging.getLogger(__name__)
+
 
 class T5(TransformerModule, Registrable):
 
@@ -91,7 +102,27 @@ class T5(TransformerModule, Registrable):
 
         self.beam_search = beam_search.construct(end_index=self.eos_token_id)
 
-        
+        # Optional subset of the vocabulary that beam search scores against, see `restrict_output_vocab`.
+        self.register_buffer("_output_ids", None, persistent=False)
+        self._restricted_lm_weight: Optional[torch.Tensor] = None
+        # Keys, values and encoder outputs of the current beam search, see `take_search_step`.
+        self._search_cache: Optional[_BeamSearchCache] = None
+
+    def restrict_output_vocab(self, output_ids: List[int]) -> None:
+        """
+        Restricts beam search to the given token ids. The LM head is sliced to these rows
+        before decoding, so each step projects onto and normalizes over `len(output_ids)`
+        entries instead of the full vocabulary. Predictions are mapped back to the original
+        ids, and teacher-forced logits (training and validation loss) still use the full head.
+        """
+        output_ids = sorted(
+            set(output_ids) | {self.pad_token_id, self.eos_token_id, self.decoder_start_token_id}
+        )
+        self._output_ids = torch.tensor(
+            output_ids, dtype=torch.long, device=self.lm_head.weight.device
+        )
+        self.beam_search._end_index = output_ids.index(self.eos_token_id)
+
     def resize_token_embeddings(
         self, new_size: int, *, init_fn: Callable = torch.nn.init.normal_
     ) -> None:
@@ -147,6 +178,69 @@ class T5(TransformerModule, Registrable):
                 missing_keys.remove(key)
         return missing_keys, unexpected_keys
 
+    @classmethod
+    def from_pretrained_module(  # type: ignore[override]
+        cls,
+        model_name: str,
+        *,
+        load_weights: bool = True,
+        weights_path: Optional[Union[str, PathLike]] = None,
+        strict: bool = True,
+        use_weights_cache: bool = True,
+        **kwargs,
+    ) -> "T5":
+        """
+        Same as `TransformerModule.from_pretrained_module`, but the HuggingFace config and the
+        converted weights of a model on the hub are stored in a local cache (see
+        `weights_cache`) the first time. Later calls build the module from the cached config
+        and load the memory-mapped weights, without the conversion and without the hub.
+
+        Within `weights_cache.skip_pretrained_weights()`, e.g. while an archive is loaded, the
+        pretrained weights are not loaded at all.
+        """
+        if weights_cache.skipping_pretrained_weights():
+            load_weights = False
+        cacheable = (
+            use_weights_cache
+            and weights_path is None
+            and not os.path.isdir(model_name)
+            and not is_distributed()
+            # These change the conversion, which is not part of the cache key.
+            and not any(
+                key in kwargs
+                for key in ("auto_config_kwargs", "mapping", "relevant_module", "ignore", "allow_missing")
+            )
+        )
+        if not cacheable:
+            return super().from_pretrained_module(  # type: ignore[return-value]
+                model_name, load_weights=load_weights, weights_path=weights_path, strict=strict, **kwargs
+            )
+
+        entry = weights_cache.cache_entry(cls, model_name)
+        cached = weights_cache.load_converted(entry, load_weights=load_weights)
+        if cached is not None:
+            config, state_dict = cached
+            model = cls._from_config(config, **kwargs)
+            if state_dict is not None:
+                missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+                _check_incompatible_keys(model, missing_keys, unexpected_keys, strict)
+            return model
+
+        model = super().from_pretrained_module(  # type: ignore[assignment]
+            model_name, load_weights=load_weights, strict=strict, **kwargs
+        )
+        if load_weights:
+            from transformers import AutoConfig
+
+            try:
+                weights_cache.save_converted(
+                    entry, AutoConfig.from_pretrained(model_name), model.state_dict()
+                )
+            except (OSError, TypeError) as error:
+                # e.g. a read-only cache directory, or a dtype numpy can't represent
+                logger.warning("Could not cache the converted weights of %s: %s", model_name, error)
+        return model
+
     @classmethod
     def _from_config(cls, config: "PretrainedConfig", **kwargs):
         attention_kwargs = {
@@ -214,7 +308,7 @@ class T5(TransformerModule, Registrable):
 
         return shifted_input_ids
 
-    def _get_lm_logits(self, decoder_last_hidden_state: FloatT) -> FloatT:
+    def _get_lm_logits(self, decoder_last_hidden_state: FloatT, restricted: bool = False) -> FloatT:
         # Shape: (batch_size, target_length, model_dim)
         sequence_output = decoder_last_hidden_state
         # Rescale output before projecting on vocab
@@ -222,6 +316,9 @@ class T5(TransformerModule, Registrable):
         # Currently tied embeddings is the only option we have, but if make
         # that configurable then we should put this in an 'if' block.
         sequence_output = sequence_output * (self.model_dim**-0.5)
+        if restricted and self._restricted_lm_weight is not None:
+            # Shape: (batch_size, target_length, num_output_ids)
+            return F.linear(sequence_output, self._restricted_lm_weight)
         # Shape: (batch_size, target_length, vocab_size)
         logits = self.lm_head(sequence_output)
         return logits
@@ -232,20 +329,25 @@ class T5(TransformerModule, Registrable):
         attention_mask: Optional[BoolT] = None,
         labels: Optional[IntT] = None,
         decoder_attention_mask: Optional[BoolT] = None,
+        run_beam_search: bool = True,
     ) -> T5Output:
         """
         Run forward pass of the model.
+
+        In evaluation mode, beam search is skipped if `run_beam_search` is `False`, e.g. when only
+        the teacher-forced logits are needed.
         """
         if attention_mask is None:
             attention_mask = ~(input_ids == self.pad_token_id)
 
         # Encode inputs.
-        encoder_outputs: T5StackOutput = self.encoder(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            output_attentions=self.output_attentions,
-            output_all_hidden_states=self.output_all_hidden_states,
-        )
+        with profile_stage("model/encoder"):
+            encoder_outputs: T5StackOutput = self.encoder(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                output_attentions=self.output_attentions,
+                output_all_hidden_states=self.output_all_hidden_states,
+            )
 
         logits: Optional[FloatT] = None
         loss: Optional[FloatT] = None
@@ -268,17 +370,18 @@ class T5(TransformerModule, Registrable):
             decoder_input_ids.masked_fill_(decoder_input_ids == -100, self.pad_token_id)
 
             # Decode.
-            decoder_outputs = self.decoder(
-                input_ids=decoder_input_ids,
-                attention_mask=decoder_attention_mask,
-                encoder_hidden_states=encoder_outputs.last_hidden_state,
-                encoder_attention_mask=attention_mask,
-                output_attentions=self.output_attentions,
-                output_all_hidden_states=self.output_all_hidden_states,
-            )
-
-            # Shape: (batch_size, target_length, vocab_size)
-            logits = self._get_lm_logits(decoder_outputs.last_hidden_state)  # type: ignore[union-attr]
+            with profile_stage("model/decoder"):
+                decoder_outputs = self.decoder(
+                    input_ids=decoder_input_ids,
+                    attention_mask=decoder_attention_mask,
+                    encoder_hidden_states=encoder_outputs.last_hidden_state,
+                    encoder_attention_mask=attention_mask,
+                    output_attentions=self.output_attentions,
+                    output_all_hidden_states=self.output_all_hidden_states,
+                )
+
+                # Shape: (batch_size, target_length, vocab_size)
+                logits = self._get_lm_logits(decoder_outputs.last_hidden_state)  # type: ignore[union-attr]
 
             if self.training:
                 # Shape: (1,)
@@ -300,7 +403,7 @@ class T5(TransformerModule, Registrable):
         elif self.training:
             raise ValueError("'labels' required during training")
 
-        if not self.training:
+        if not self.training and run_beam_search:
             # Use beam search to generate a sequence of predicted tokens.
 
             # Shape: (batch_size, 1)
@@ -310,18 +413,40 @@ class T5(TransformerModule, Registrable):
                 device=input_ids.device,
             ).repeat(input_ids.shape[0], 1)
 
-            initial_state = {
-                "input_ids": input_ids,
-                "encoder_hidden_states": encoder_outputs.last_hidden_state,
-                "encoder_attention_mask": attention_mask,
-            }
+            initial_state = {"input_ids": input_ids}
+            if isinstance(self.beam_search, COGSConstrainedBeamSearch):
+                initial_state.update(
+                    self.beam_search.init_constraint_state(input_ids.shape[0], input_ids.device)
+                )
+
+            if self._output_ids is not None:
+                # Slice the LM head once per batch, the weights may have changed since the last one.
+                self._restricted_lm_weight = self.lm_head.weight.index_select(0, self._output_ids)
+                # Beam search works with positions in `_output_ids` rather than token ids.
+                initial_decoder_ids = torch.searchsorted(self._output_ids, initial_decoder_ids)
 
             # Run the beam search.
             # Shape (predictions): (batch_size, beam_size, max_decoding_steps)
             # Shape (predicted_log_probs):   (batch_size, beam_size)
-            predictions, predicted_log_probs = self.beam_search.search(
-                initial_decoder_ids, initial_state, self.take_search_step
+            self._search_cache = _BeamSearchCache(
+                self.decoder,
+                encoder_outputs.last_hidden_state,
+                attention_mask,
+                beam_size=self.beam_search.beam_size,
+                max_steps=self.beam_search.max_steps,
             )
+            try:
+                with profile_stage("model/beam_search"):
+                    predictions, predicted_log_probs = self.beam_search.search(
+                        initial_decoder_ids, initial_state, self.take_search_step
+                    )
+            finally:
+                self._search_cache.close()
+                self._search_cache = None
+
+            if self._output_ids is not None:
+                predictions = self._output_ids[predictions]
+                self._restricted_lm_weight = None
 
         return T5Output(
             encoder_last_hidden_state=encoder_outputs.last_hidden_state,
@@ -406,63 +531,160 @@ class T5(TransformerModule, Registrable):
         predictions from the last timestep and the current state and outputs
         the log probabilities assigned to tokens for the next timestep, as well as the updated
         state.
+
+        The keys, values and encoder outputs are kept in a `_BeamSearchCache` rather than in
+        `state`, since the beam search gathers every state tensor after each step. `state` only
+        carries the row of the cache each hypothesis came from, `"decoder_cache_rows"`.
         """
+        cache = self._search_cache
+        assert cache is not None, "`take_search_step` is only called by the beam search of `forward`"
         decoder_cache: Optional[List[KeyValueStates]] = None
-        decoder_cache_dict = {
-            k: state[k].contiguous() for k in state if k.startswith("decoder_cache_")
-        }
-        if decoder_cache_dict:
-            decoder_cache = self._dict_to_decoder_cache(decoder_cache_dict)
+        if step > 0:
+            cache.reorder(state["decoder_cache_rows"], step)
+            decoder_cache = cache.past_key_values(step)
 
         if len(last_predictions.shape) == 1:
             last_predictions = last_predictions.unsqueeze(-1)
 
-        decoder_outputs: T5StackOutput = self.decoder(
-            input_ids=last_predictions,
-            past_key_values=decoder_cache,
-            encoder_hidden_states=state["encoder_hidden_states"],
-            encoder_attention_mask=state["encoder_attention_mask"],
-            use_cache=True,
-        )
+        if self._restricted_lm_weight is not None:
+            last_predictions = self._output_ids[last_predictions]
+
+        with profile_stage("model/beam_step"):
+            decoder_outputs: T5StackOutput = self.decoder(
+                input_ids=last_predictions,
+                past_key_values=decoder_cache,
+                encoder_hidden_states=cache.encoder_hidden_states,
+                encoder_attention_mask=cache.encoder_attention_mask,
+                use_cache=True,
+            )
 
-        # Shape: (group_size, 2, vocab_size)
-        lm_logits = self._get_lm_logits(decoder_outputs.last_hidden_state)
+            # Shape: (group_size, 2, vocab_size)
+            lm_logits = self._get_lm_logits(decoder_outputs.last_hidden_state, restricted=True)
 
-        # Shape: (group_size, vocab_size)
-        logits = lm_logits[:, -1, :]
+            # Shape: (group_size, vocab_size)
+            logits = lm_logits[:, -1, :]
 
-        # Shape: (group_size, vocab_size)
-        log_probabilities = F.log_softmax(logits, dim=-1)
+            if isinstance(self.beam_search, COGSConstrainedBeamSearch):
+                logits = self.beam_search.constrain_logits(
+                    logits,
+                    last_predictions[:, -1],
+                    state,
+                    step,
+                    output_ids=self._output_ids if self._restricted_lm_weight is not None else None,
+                )
 
-        # Update state with decoder cache.
-        decoder_cache = decoder_outputs.past_key_values
-        assert decoder_cache is not None
-        decoder_cache_dict = self._decoder_cache_to_dict(decoder_cache)
-        state.update(decoder_cache_dict)
+            # Shape: (group_size, vocab_size)
+            log_probabilities = F.log_softmax(logits, dim=-1)
+
+        if step == 0:
+            assert decoder_outputs.past_key_values is not None
+            cache.start(decoder_outputs.past_key_values)
+        # After the beam search reorders the state, this holds the row each hypothesis came from.
+        state["decoder_cache_rows"] = torch.arange(last_predictions.size(0), device=last_predictions.device)
 
         return log_probabilities, state
 
-    @staticmethod
-    def _decoder_cache_to_dict(decoder_cache: List[KeyValueStates]) -> Dict[str, torch.Tensor]:
-        cache_dict = {}
-        for layer_index, layer_cache in enumerate(decoder_cache):
-            # Each layer caches the key and value tensors for its self-attention and cross-attention.
-            # Hence the `layer_cache` tuple has 4 elements.
-            assert len(layer_cache) == 4
-            for tensor_index, tensor in enumerate(layer_cache):
-                key = f"decoder_cache_{layer_index}_{tensor_index}"
-                cache_dict[key] = tensor
-        return cache_dict
-
-    def _dict_to_decoder_cache(self, cache_dict: Dict[str, torch.Tensor]) -> List[KeyValueStates]:
-        decoder_cache: List[KeyValueStates] = []
-        for block_index in range(self.decoder.num_blocks):
-            base_key = f"decoder_cache_{block_index}_"
-            layer_cache = (
-                cache_dict[base_key + "0"].contiguous(),
-                cache_dict[base_key + "1"].contiguous(),
-                cache_dict[base_key + "2"].contiguous(),
-                cache_dict[base_key + "3"].contiguous(),
+
+class _BeamSearchCache:
+    """
+    The decoder keys and values and the encoder outputs of one beam search.
+
+    The self-attention keys and values of every decoder block live in buffers preallocated for
+    `max_steps` steps of all beams. While the cache is open, the self-attention of each block
+    writes the key and value of the new step into its buffers in place and attends over the
+    `[:step + 1]` view, instead of concatenating them to the past ones. When the beam search
+    reorders the hypotheses, the filled prefix of the buffers is gathered once, and not at all
+    if the order did not change.
+
+    The cross-attention keys and values and the encoder outputs are the same for all beams of an
+    instance: they are computed by the first step and only expanded to the beams once.
+    """
+
+    def __init__(
+        self,
+        decoder: T5DecoderStack,
+        encoder_hidden_states: FloatT,
+        encoder_attention_mask: BoolT,
+        beam_size: int,
+        max_steps: int,
+    ) -> None:
+        self.encoder_hidden_states = encoder_hidden_states
+        self.encoder_attention_mask = encoder_attention_mask
+        self._attentions = [block.layer[0].self_attention for block in decoder.blocks]
+        self._beam_size = beam_size
+        self._max_steps = max_steps
+        self._cross_attention: List[Tuple[torch.Tensor, torch.Tensor]] = []
+        self._keys: List[torch.Tensor] = []
+        self._values: List[torch.Tensor] = []
+        self._identity_rows: Optional[torch.Tensor] = None
+
+    def start(self, decoder_cache: List[KeyValueStates]) -> None:
+        """
+        Stores the keys and values of the first step, which ran once per instance, and opens the
+        cache.
+        """
+        batch_size = self.encoder_hidden_states.size(0)
+        group_size = batch_size * self._beam_size
+        self.encoder_hidden_states = self.encoder_hidden_states.repeat_interleave(self._beam_size, dim=0)
+        self.encoder_attention_mask = self.encoder_attention_mask.repeat_interleave(self._beam_size, dim=0)
+        for key, value, cross_key, cross_value in decoder_cache:
+            self._cross_attention.append(
+                (
+                    cross_key.repeat_interleave(self._beam_size, dim=0),
+                    cross_value.repeat_interleave(self._beam_size, dim=0),
+                )
             )
-            decoder_cache.append(layer_cache)
-        return decoder_cache
+            # Shape (both): (group_size, num_heads, max_steps, key_value_proj_dim)
+            # Only the first `batch_size` rows are filled, the next reorder expands them to the beams.
+            for past, buffers in ((key, self._keys), (value, self._values)):
+                buffer = past.new_empty((group_size, past.size(1), self._max_steps, past.size(3)))
+                buffer[:batch_size, :, :1] = past
+                buffers.append(buffer)
+        for index, attention in enumerate(self._attentions):
+            # Same instance patching as the checkpoint wrappers, undone by `close`.
+            attention._project = functools.partial(  # type: ignore[assignment]
+                self._project, index, attention, type(attention)._project
+            )
+
+    def close(self) -> None:
+        for attention in self._attentions:
+            attention.__dict__.pop("_project", None)
+        self._cross_attention = []
+        self._keys = []
+        self._values = []
+
+    def reorder(self, rows: torch.LongTensor, step: int) -> None:
+        """
+        Moves the keys and values of the first `step` steps to the rows of the hypotheses that
+        extend them. `rows` has shape `(group_size,)`.
+        """
+        if self._identity_rows is None:
+            self._identity_rows = torch.arange(rows.size(0), device=rows.device)
+        elif torch.equal(rows, self._identity_rows):
+            return
+        for buffer in self._keys + self._values:
+            buffer[:, :, :step] = buffer[:, :, :step].index_select(0, rows)
+
+    def past_key_values(self, step: int) -> List[KeyValueStates]:
+        return [
+            (key[:, :, :step], value[:, :, :step], cross_key, cross_value)
+            for key, value, (cross_key, cross_value) in zip(self._keys, self._values, self._cross_attention)
+        ]
+
+    def _project(
+        self,
+        index: int,
+        attention: T5Attention,
+        original_project: Callable,
+        hidden_states: torch.Tensor,
+        layer: nn.Linear,
+        source_states: Optional[torch.Tensor] = None,
+        past_key_or_value: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        if source_states is not None or past_key_or_value is None:
+            return original_project(attention, hidden_states, layer, source_states, past_key_or_value)
+        buffer = self._keys[index] if layer is attention.key else self._values[index]
+        # `past_key_or_value` is the `[:step]` view of `buffer`.
+        step = past_key_or_value.size(2)
+        buffer[:, :, step : step + 1] = attention._transpose_for_scores(layer(hidden_states))
+        return buffer[:, :, : step + 1]
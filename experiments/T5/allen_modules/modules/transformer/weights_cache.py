@@ -0,0 +1,153 @@
+"""
+A local cache of pretrained HuggingFace weights, converted to the state dict of an allennlp
+`TransformerModule`.
+
+Every entry holds the HuggingFace config (`config.json`), an index of the tensors
+(`index.json`) and their raw bytes (`weights.bin`). The weights are memory-mapped when they are
+loaded, so a cache hit reads the pages of a tensor from disk only when it is copied into the
+module, and neither the HuggingFace config nor the weights are looked up on the hub.
+"""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+from typing import Any, Dict, Iterator, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+import torch
+
+from allennlp.common.file_utils import CACHE_DIRECTORY
+from allennlp.version import VERSION
+
+if TYPE_CHECKING:
+    from transformers.configuration_utils import PretrainedConfig
+
+logger = logging.getLogger(__name__)
+
+# Bump when the conversion of the weights changes, e.g. `_pretrained_mapping` or `_from_config`.
+CACHE_VERSION = 1
+
+# Tensors start at multiples of this many bytes in `weights.bin`.
+_ALIGNMENT = 64
+
+_skip_pretrained_weights = False
+
+
+def cache_directory() -> str:
+    return os.environ.get(
+        "ALLEN_MODULES_WEIGHTS_CACHE", os.path.join(CACHE_DIRECTORY, "converted_weights")
+    )
+
+
+def cache_entry(module_class: type, model_name: str) -> str:
+    """
+    The directory of the converted weights of `model_name` for `module_class`. The key includes
+    the allennlp version and `CACHE_VERSION`, so a change of either converts the weights again.
+    """
+    key = "\t".join(
+        [model_name, f"{module_class.__module__}.{module_class.__qualname__}", VERSION, str(CACHE_VERSION)]
+    )
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+    return os.path.join(cache_directory(), f"{safe_name}-{digest}")
+
+
+def save_converted(
+    entry: str, config: "PretrainedConfig", state_dict: Dict[str, torch.Tensor]
+) -> None:
+    """
+    Writes `config` and `state_dict` to the cache directory `entry`. Tensors that share their
+    storage, like tied embeddings, are written once. The entry is written to a temporary
+    directory and renamed, so concurrent processes never read a partial entry.
+    """
+    parent = os.path.dirname(entry)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        index: Dict[str, Dict[str, Any]] = {}
+        written: Dict[Tuple[int, int, Tuple[int, ...]], Dict[str, Any]] = {}
+        offset = 0
+        with open(os.path.join(tmp_dir, "weights.bin"), "wb") as weights_file:
+            for name, tensor in state_dict.items():
+                tensor = tensor.detach().cpu().contiguous()
+                key = (tensor.data_ptr(), tensor.numel(), tuple(tensor.shape))
+                if key not in written:
+                    array = tensor.numpy()
+                    padding = -offset % _ALIGNMENT
+                    weights_file.write(b"\0" * padding)
+                    offset += padding
+                    weights_file.write(array.tobytes())
+                    written[key] = {
+                        "dtype": array.dtype.str,
+                        "shape": list(array.shape),
+                        "offset": offset,
+                    }
+                    offset += array.nbytes
+                index[name] = written[key]
+        with open(os.path.join(tmp_dir, "index.json"), "w") as index_file:
+            json.dump(index, index_file)
+        config.to_json_file(os.path.join(tmp_dir, "config.json"))
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # Another process has written the entry in the meantime.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logger.info("Cached the converted weights at %s", entry)
+
+
+def load_converted(
+    entry: str, load_weights: bool = True
+) -> Optional[Tuple["PretrainedConfig", Optional[Dict[str, torch.Tensor]]]]:
+    """
+    Returns the config and the memory-mapped state dict of the cache entry, or `None` if there
+    is no such entry. With `load_weights=False` only the config is read.
+    """
+    config_path = os.path.join(entry, "config.json")
+    if not os.path.isfile(config_path):
+        return None
+    from transformers import AutoConfig
+
+    with open(config_path) as config_file:
+        config_dict = json.load(config_file)
+    config = AutoConfig.for_model(config_dict.pop("model_type"), **config_dict)
+    if not load_weights:
+        return config, None
+
+    with open(os.path.join(entry, "index.json")) as index_file:
+        index = json.load(index_file)
+    # Copy-on-write, so the tensors are writable but the file is never modified.
+    weights = np.memmap(os.path.join(entry, "weights.bin"), dtype=np.uint8, mode="c")
+    state_dict = {}
+    for name, spec in index.items():
+        dtype = np.dtype(spec["dtype"])
+        num_bytes = int(np.prod(spec["shape"], dtype=np.int64)) * dtype.itemsize
+        array = weights[spec["offset"] : spec["offset"] + num_bytes].view(dtype).reshape(spec["shape"])
+        state_dict[name] = torch.from_numpy(array)
+    logger.info("Loaded the converted weights from %s", entry)
+    return config, state_dict
+
+
+@contextlib.contextmanager
+def skip_pretrained_weights() -> Iterator[None]:
+    """
+    Within this context, `T5.from_pretrained_module` only builds the module and leaves the
+    pretrained weights out, e.g. while `load_archive` constructs a model whose weights are
+    replaced by those of the archive right after.
+    """
+    global _skip_pretrained_weights
+    previous, _skip_pretrained_weights = _skip_pretrained_weights, True
+    try:
+        yield
+    finally:
+        _skip_pretrained_weights = previous
+
+
+def skipping_pretrained_weights() -> bool:
+    return _skip_pretrained_weights
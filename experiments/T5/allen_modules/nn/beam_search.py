@@ -0,0 +1,120 @@
+from typing import Dict, Optional
+
+import torch
+
+from allennlp.data.tokenizers import PretrainedTransformerTokenizer
+from allennlp.nn import util
+from allennlp.nn.beam_search import BeamSearch
+
+# Syntactic classes of the sentencepiece tokens of a COGS logical form.
+START, WORD, SUBWORD, OPEN, CLOSE, COMMA, SEP, EOS, BANNED = range(9)
+NUM_CLASSES = 9
+
+
+def _build_transitions() -> torch.BoolTensor:
+    # Shape: (previous class, whether a bracket is open, next class)
+    allowed = torch.zeros(NUM_CLASSES, 2, NUM_CLASSES, dtype=torch.bool)
+    for open_bracket in (0, 1):
+        for prev in (START, OPEN, COMMA, SEP):
+            allowed[prev, open_bracket, WORD] = True
+        for prev in (WORD, SUBWORD):
+            allowed[prev, open_bracket, [WORD, SUBWORD, OPEN]] = True
+    for prev in (WORD, SUBWORD, CLOSE):
+        # `x _ 1 )`, `a , b`, and nested `( ... ) )` in the variable-free LF
+        allowed[prev, 1, [CLOSE, COMMA]] = True
+        # `... ) AND ...`, `* cake ( x _ 1 ) ; ...`, or the end of the form
+        allowed[prev, 0, EOS] = True
+    allowed[CLOSE, 0, [SEP, WORD]] = True
+    # Finished hypotheses are handled by the beam search, this only keeps their rows finite.
+    allowed[EOS, :, EOS] = True
+    return allowed
+
+
+@BeamSearch.register("cogs_constrained")
+class COGSConstrainedBeamSearch(BeamSearch):
+    """
+    Beam search that only extends hypotheses with tokens that keep the prefix a well-formed
+    COGS logical form (`x _ N`, `pred . role ( … , … )`, `AND`, `;` and brackets).
+
+    The syntax is tracked incrementally with a small pushdown automaton: the class of the
+    last token and the bracket depth are stored in the beam state, so they are reordered
+    together with the hypotheses. `T5.take_search_step` calls `constrain_logits` every step
+    to mask the tokens that would make the prefix ill-formed.
+
+    # Parameters
+
+    model_name : `str`, optional (default = `"t5-base"`)
+        The pretrained tokenizer whose sentencepiece vocabulary is classified.
+    """
+
+    def __init__(self, end_index: int, model_name: str = "t5-base", **kwargs) -> None:
+        super().__init__(end_index, **kwargs)
+        self._model_name = model_name
+        self._token_classes: Optional[torch.LongTensor] = None
+        self._transitions = _build_transitions()
+
+    def _classify_vocabulary(self, vocab_size: int) -> torch.LongTensor:
+        tokenizer = PretrainedTransformerTokenizer(self._model_name).tokenizer
+        classes = torch.full((vocab_size,), BANNED, dtype=torch.long)
+        special_ids = set(tokenizer.all_special_ids)
+        for token_id in range(min(vocab_size, len(tokenizer))):
+            if token_id in special_ids:
+                continue
+            piece = tokenizer.convert_ids_to_tokens(token_id)
+            text = piece.lstrip("▁")
+            if text == "(":
+                classes[token_id] = OPEN
+            elif text == ")":
+                classes[token_id] = CLOSE
+            elif text == ",":
+                classes[token_id] = COMMA
+            elif text in ("AND", ";"):
+                classes[token_id] = SEP
+            elif any(symbol in text for symbol in "(),;"):
+                # LF tokens are whitespace separated, so brackets never merge with other symbols
+                continue
+            else:
+                classes[token_id] = WORD if piece.startswith("▁") else SUBWORD
+        # With a restricted output vocabulary `_end_index` is a column of the logits, not a token id.
+        classes[tokenizer.eos_token_id] = EOS
+        return classes
+
+    def init_constraint_state(self, batch_size: int, device: torch.device) -> Dict[str, torch.Tensor]:
+        return {
+            "constraint_last_class": torch.full((batch_size,), START, dtype=torch.long, device=device),
+            "constraint_depth": torch.zeros(batch_size, dtype=torch.long, device=device),
+        }
+
+    def constrain_logits(
+        self,
+        logits: torch.Tensor,
+        last_predictions: torch.Tensor,
+        state: Dict[str, torch.Tensor],
+        step: int,
+        output_ids: Optional[torch.LongTensor] = None,
+    ) -> torch.Tensor:
+        """
+        Updates the tracker in `state` with `last_predictions` (token ids of shape `(group_size,)`)
+        and masks the `logits` of every token that is not a valid continuation.
+        If the LM head is restricted, `output_ids` maps the columns of `logits` to token ids.
+        """
+        if self._token_classes is None or self._token_classes.device != logits.device:
+            vocab_size = logits.size(-1) if output_ids is None else int(output_ids.max()) + 1
+            self._token_classes = self._classify_vocabulary(vocab_size).to(logits.device)
+            self._transitions = self._transitions.to(logits.device)
+
+        last_class = state["constraint_last_class"]
+        depth = state["constraint_depth"]
+        if step > 0:
+            # The first prediction is the decoder start token, which leaves the state at START.
+            last_class = self._token_classes[last_predictions]
+            depth = depth + (last_class == OPEN).long() - (last_class == CLOSE).long()
+            state["constraint_last_class"] = last_class
+            state["constraint_depth"] = depth
+
+        column_classes = self._token_classes if output_ids is None else self._token_classes[output_ids]
+        # Shape: (group_size, num_classes)
+        allowed_classes = self._transitions[last_class, (depth > 0).long()]
+        # Shape: (group_size, vocab_size)
+        allowed = allowed_classes[:, column_classes]
+        return logits.masked_fill(~allowed, util.min_value_of_dtype(logits.dtype))
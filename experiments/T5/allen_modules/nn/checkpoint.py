@@ -0,0 +1,71 @@
+import functools
+import weakref
+from typing import Any, Callable, Dict, List
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+from allennlp.nn.checkpoint import CheckpointWrapper
+
+# Marks the output fields that are returned through the checkpoint.
+_TENSOR = object()
+
+
+@CheckpointWrapper.register("t5_block")
+class T5BlockCheckpointWrapper(CheckpointWrapper):
+    """
+    Activation checkpointing for transformer blocks that are called with keyword arguments and
+    return a `NamedTuple`, like the T5 blocks. allennlp's `"torch"` wrapper only supports
+    positional arguments.
+
+    Every tensor argument is passed to `torch.utils.checkpoint.checkpoint` positionally, so
+    gradients still reach e.g. the encoder output through the cross attention and the relative
+    position bias shared between the blocks.
+    """
+
+    def wrap_module(self, module: nn.Module, **kwargs) -> nn.Module:
+        assert len(kwargs) == 0
+        # Same patching as allennlp's "torch" wrapper, the weakref avoids a reference cycle.
+        module.forward = functools.partial(  # type: ignore[assignment]
+            _checkpointed_block_forward, type(module).forward, weakref.ref(module)
+        )
+        return module
+
+
+def _checkpointed_block_forward(original_forward: Callable, weak_self, *args, **kwargs) -> Any:
+    module = weak_self()
+    assert module is not None, "patched forward method called after module has been garbage collected!"
+
+    if not (module.training and torch.is_grad_enabled()):
+        return original_forward(module, *args, **kwargs)
+
+    names = list(kwargs)
+    values: List[Any] = list(args) + [kwargs[name] for name in names]
+    tensor_positions = [i for i, value in enumerate(values) if isinstance(value, torch.Tensor)]
+    # The non-tensor fields of the output, filled in by `run_function`.
+    output_template: Dict[str, Any] = {}
+
+    def run_function(*tensors):
+        call_values = list(values)
+        for position, tensor in zip(tensor_positions, tensors):
+            call_values[position] = tensor
+        output = original_forward(
+            module, *call_values[: len(args)], **dict(zip(names, call_values[len(args):]))
+        )
+        if isinstance(output, torch.Tensor):
+            output_template["fields"] = None
+            return output
+        output_template["type"] = type(output)
+        output_template["fields"] = [
+            _TENSOR if isinstance(field, torch.Tensor) else field for field in output
+        ]
+        return tuple(field for field in output if isinstance(field, torch.Tensor))
+
+    tensor_outputs = checkpoint(run_function, *[values[i] for i in tensor_positions])
+    if output_template["fields"] is None:
+        return tensor_outputs
+
+    tensor_iter = iter(tensor_outputs)
+    fields = [next(tensor_iter) if field is _TENSOR else field for field in output_template["fields"]]
+    return output_template["type"](*fields)
@@ -0,0 +1,120 @@
+import contextlib
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+from allennlp.data import TensorDict
+from allennlp.training.callbacks.callback import TrainerCallback
+
+from allen_modules.common.profiling import StageProfiler, activate, timed_collation
+
+if TYPE_CHECKING:
+    from allennlp.training.gradient_descent_trainer import GradientDescentTrainer
+
+
+logger = logging.getLogger(__name__)
+
+
+@TrainerCallback.register("profiler")
+class ProfilerCallback(TrainerCallback):
+    """
+    Times the stages of the training hot path (reader tokenization, collation, encoder, decoder,
+    and during validation the beam steps, `batch_decode` and postprocessing) with a
+    `StageProfiler`, and every training and validation batch as a whole (`train/batch`,
+    `validation/batch`). The cumulative breakdown is written to `profile/train_stages.json` in
+    the serialization directory after every epoch and logged at the end of the training.
+
+    Stages that run in data loader worker processes (`num_workers > 0`) are not timed.
+
+    # Parameters
+
+    synchronize_cuda : `bool`, optional (default = `True`)
+        Wait for the GPU at the start and end of every stage, see `StageProfiler`.
+    trace_start_batch : `int`, optional (default = `None`)
+        If given, a `torch.profiler` window starts after this many training batches and is
+        written as the Chrome trace `profile/train_trace.json`.
+    trace_num_batches : `int`, optional (default = `5`)
+        The number of training batches in the `torch.profiler` window.
+    time_collation : `bool`, optional (default = `True`)
+        Wrap the `collate_fn` of the data loaders to time the collation.
+    """
+
+    def __init__(
+        self,
+        serialization_dir: str,
+        synchronize_cuda: bool = True,
+        trace_start_batch: Optional[int] = None,
+        trace_num_batches: int = 5,
+        time_collation: bool = True,
+    ) -> None:
+        super().__init__(serialization_dir)
+        self._profiler = StageProfiler(
+            os.path.join(serialization_dir, "profile"),
+            prefix="train_",
+            synchronize_cuda=synchronize_cuda,
+            trace_start_batch=trace_start_batch,
+            trace_num_batches=trace_num_batches,
+        )
+        self._time_collation = time_collation
+        self._collation: Optional[contextlib.ExitStack] = None
+        self._last_batch_end = 0.0
+
+    def on_start(self, trainer: "GradientDescentTrainer", is_primary: bool = True, **kwargs) -> None:
+        activate(self._profiler)
+        if self._time_collation:
+            self._collation = contextlib.ExitStack()
+            for data_loader in (trainer.data_loader, trainer._validation_data_loader):
+                if data_loader is not None:
+                    self._collation.enter_context(timed_collation(data_loader))
+        self._last_batch_end = time.perf_counter()
+
+    def on_batch(
+        self,
+        trainer: "GradientDescentTrainer",
+        batch_inputs: List[TensorDict],
+        batch_outputs: List[Dict[str, Any]],
+        batch_metrics: Dict[str, Any],
+        epoch: int,
+        batch_number: int,
+        is_training: bool,
+        is_primary: bool = True,
+        batch_grad_norm: Optional[float] = None,
+        **kwargs,
+    ) -> None:
+        batch_end = time.perf_counter()
+        # The first batch of an epoch also counts the start-up of the data loader.
+        self._profiler.record(
+            "train/batch" if is_training else "validation/batch", batch_end - self._last_batch_end
+        )
+        self._last_batch_end = batch_end
+        if is_training:
+            self._profiler.step()
+
+    def on_epoch(
+        self,
+        trainer: "GradientDescentTrainer",
+        metrics: Dict[str, Any],
+        epoch: int,
+        is_primary: bool = True,
+        **kwargs,
+    ) -> None:
+        if is_primary:
+            self._profiler.write()
+        self._last_batch_end = time.perf_counter()
+
+    def on_end(
+        self,
+        trainer: "GradientDescentTrainer",
+        metrics: Dict[str, Any] = None,
+        epoch: int = None,
+        is_primary: bool = True,
+        **kwargs,
+    ) -> None:
+        activate(None)
+        if self._collation is not None:
+            self._collation.close()
+            self._collation = None
+        if is_primary:
+            self._profiler.close()
+            logger.info(self._profiler.format_breakdown())
@@ -0,0 +1,156 @@
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+import torch
+from torch.cuda import amp
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.common.util import dump_metrics
+from allennlp.data import TensorDict
+from allennlp.training.callbacks.callback import TrainerCallback
+
+if TYPE_CHECKING:
+    from allennlp.training.gradient_descent_trainer import GradientDescentTrainer
+
+
+logger = logging.getLogger(__name__)
+
+
+@TrainerCallback.register("proxy_validation")
+class ProxyValidationCallback(TrainerCallback):
+    """
+    Runs a cheap proxy validation before the expensive beam-search validation of the
+    `modified_t5` model. After the last training batch of an epoch, the validation data is
+    scored in a single teacher-forced pass (`proxy_token_acc` and `proxy_seq_acc`, see
+    `TeacherForcedAccuracy`). The trainer then only runs the full validation with beam search
+    if `proxy_metric` improved, every `stride` epochs and after the last epoch.
+
+    Since the trainer only tracks the metrics of the full validations, the best checkpoint is
+    still picked by the `validation_metric` of the trainer, e.g. `"+acc"` for the exact match.
+    The proxy metrics of every epoch, and whether it ran the full validation, are written to
+    `proxy_metrics_epoch_<epoch>.json` in the serialization directory.
+
+    This replaces the `should_validate_callback`, `validation_start` has the same meaning.
+
+    # Parameters
+
+    validation_start : `int`, optional (default = `None`)
+        Neither the proxy nor the full validation run in the epochs before this one (0-based),
+        as with the `should_validate_callback`.
+    stride : `int`, optional (default = `None`)
+        Run the full validation every `stride` epochs, whether the proxy improved or not.
+    proxy_metric : `str`, optional (default = `"proxy_seq_acc"`)
+        The proxy metric (higher is better) whose improvement triggers the full validation.
+    """
+
+    def __init__(
+        self,
+        serialization_dir: str,
+        validation_start: Optional[int] = None,
+        stride: Optional[int] = None,
+        proxy_metric: str = "proxy_seq_acc",
+    ) -> None:
+        super().__init__(serialization_dir)
+        if stride is not None and stride < 1:
+            raise ConfigurationError(f"stride must be at least 1, got {stride}")
+        self._validation_start = validation_start
+        self._stride = stride
+        self._proxy_metric = proxy_metric
+        self._best_proxy: Optional[float] = None
+        self._num_batches: Optional[int] = None
+
+    def on_start(self, trainer: "GradientDescentTrainer", is_primary: bool = True, **kwargs) -> None:
+        if trainer._validation_data_loader is None:
+            raise ConfigurationError("proxy_validation needs a validation_data_loader")
+        if trainer._distributed:
+            raise ConfigurationError("proxy_validation does not support distributed training")
+        if not hasattr(trainer.model, "proxy_validation"):
+            raise ConfigurationError("proxy_validation needs a model with a teacher-forced proxy, e.g. modified_t5")
+        try:
+            num_batches = len(trainer.data_loader)
+        except TypeError:
+            raise ConfigurationError(
+                "proxy_validation needs to know the number of batches per epoch, "
+                "set the data loader's batches_per_epoch"
+            )
+        self._num_batches = math.ceil(num_batches / trainer._num_gradient_accumulation_steps)
+        # Decided after the last batch of every epoch.
+        trainer._should_validate_this_epoch = False
+
+    def on_batch(
+        self,
+        trainer: "GradientDescentTrainer",
+        batch_inputs: List[TensorDict],
+        batch_outputs: List[Dict[str, Any]],
+        batch_metrics: Dict[str, Any],
+        epoch: int,
+        batch_number: int,
+        is_training: bool,
+        is_primary: bool = True,
+        batch_grad_norm: Optional[float] = None,
+        **kwargs,
+    ) -> None:
+        if not is_training or batch_number != self._num_batches:
+            return
+        trainer._should_validate_this_epoch = self._should_validate(trainer, epoch)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"best_proxy": self._best_proxy}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self._best_proxy = state_dict["best_proxy"]
+
+    def _should_validate(self, trainer: "GradientDescentTrainer", epoch: int) -> bool:
+        # Like `should_validate_callback`, the epochs before `validation_start` aren't validated.
+        if self._validation_start is not None and epoch < self._validation_start:
+            return False
+        epochs_elapsed = epoch + 1
+
+        proxy_metrics = self._proxy_validation(trainer)
+        proxy = proxy_metrics[self._proxy_metric]
+        improved = self._best_proxy is None or proxy > self._best_proxy
+        if improved:
+            self._best_proxy = proxy
+        on_stride = self._stride is not None and epochs_elapsed % self._stride == 0
+        last_epoch = epochs_elapsed >= trainer._num_epochs
+        should_validate = improved or on_stride or last_epoch
+        logger.info(
+            "Proxy validation: %s = %.4f (best %.4f), %s beam search",
+            self._proxy_metric,
+            proxy,
+            self._best_proxy,
+            "running" if should_validate else "skipping",
+        )
+        # The epoch metrics of the trainer are only built after the validation, so the proxy
+        # metrics get their own file.
+        dump_metrics(
+            os.path.join(self.serialization_dir, f"proxy_metrics_epoch_{epoch}.json"),
+            {**proxy_metrics, "full_validation": should_validate},
+        )
+        return should_validate
+
+    def _proxy_validation(self, trainer: "GradientDescentTrainer") -> Dict[str, float]:
+        model = trainer.model
+        trainer._pytorch_model.eval()
+        # Same weights as the full validation.
+        if trainer._moving_average is not None:
+            trainer._moving_average.assign_average_value()
+        model.proxy_validation = True
+        try:
+            with torch.no_grad():
+                for batch in trainer._validation_data_loader:
+                    with amp.autocast(trainer._use_amp):
+                        trainer.batch_outputs(batch, for_training=False)
+            proxy_metrics = model.get_metrics(reset=True)
+        finally:
+            model.proxy_validation = False
+            if trainer._moving_average is not None:
+                trainer._moving_average.restore()
+            trainer._pytorch_model.train()
+        if self._proxy_metric not in proxy_metrics:
+            raise ConfigurationError(
+                f"Unknown proxy metric '{self._proxy_metric}', the model reports {list(proxy_metrics)}"
+            )
+        return proxy_metrics
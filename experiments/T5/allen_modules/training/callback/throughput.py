@@ -0,0 +1,93 @@
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+import torch
+
+from allennlp.common.util import dump_metrics
+from allennlp.data import TensorDict
+from allennlp.training.callbacks.callback import TrainerCallback
+
+if TYPE_CHECKING:
+    from allennlp.training.gradient_descent_trainer import GradientDescentTrainer
+
+
+logger = logging.getLogger(__name__)
+
+
+@TrainerCallback.register("throughput")
+class ThroughputCallback(TrainerCallback):
+    """
+    Measures the training throughput in (non-padding) tokens per second, source and target
+    together, and writes it to `throughput_epoch_<epoch>.json` in the serialization directory
+    (`training_tokens_per_second`, with the counted `training_tokens` and `training_seconds`).
+    The trainer writes its `metrics_epoch_<epoch>.json` before the callbacks run, so the value is
+    not added to the epoch metrics.
+
+    The clock runs from the end of the first training batch of an epoch to the end of its last
+    one, and the tokens of the first batch are not counted. Validation, checkpointing and the
+    start-up of the data loader are therefore not part of the measurement. The peak GPU memory is
+    already reported by the trainer as `peak_gpu_*_memory_MB`.
+    """
+
+    def __init__(self, serialization_dir: str) -> None:
+        super().__init__(serialization_dir)
+        self._tokens: Optional[torch.Tensor] = None
+        # Set by the first training batch of an epoch.
+        self._epoch_start: Optional[float] = None
+        self._last_batch_end = 0.0
+
+    def on_batch(
+        self,
+        trainer: "GradientDescentTrainer",
+        batch_inputs: List[TensorDict],
+        batch_outputs: List[Dict[str, Any]],
+        batch_metrics: Dict[str, Any],
+        epoch: int,
+        batch_number: int,
+        is_training: bool,
+        is_primary: bool = True,
+        batch_grad_norm: Optional[float] = None,
+        **kwargs,
+    ) -> None:
+        if not is_training:
+            return
+        if self._epoch_start is None:
+            self._epoch_start = self._last_batch_end = time.perf_counter()
+            return
+        for batch in batch_inputs:
+            for field in batch.values():
+                if not isinstance(field, dict):
+                    continue
+                for indexed in field.values():
+                    if isinstance(indexed, dict) and "mask" in indexed:
+                        # Kept on the device, so counting does not synchronize every batch.
+                        count = indexed["mask"].sum()
+                        self._tokens = count if self._tokens is None else self._tokens + count
+        self._last_batch_end = time.perf_counter()
+
+    def on_epoch(
+        self,
+        trainer: "GradientDescentTrainer",
+        metrics: Dict[str, Any],
+        epoch: int,
+        is_primary: bool = True,
+        **kwargs,
+    ) -> None:
+        tokens, self._tokens = self._tokens, None
+        epoch_start, self._epoch_start = self._epoch_start, None
+        if tokens is None or epoch_start is None or not is_primary:
+            return
+        elapsed = self._last_batch_end - epoch_start
+        if elapsed <= 0:
+            return
+        throughput = {
+            "training_tokens_per_second": tokens.item() / elapsed,
+            "training_tokens": tokens.item(),
+            "training_seconds": elapsed,
+        }
+        logger.info("Training throughput: %.1f tokens/s", throughput["training_tokens_per_second"])
+        dump_metrics(
+            os.path.join(self.serialization_dir, f"throughput_epoch_{epoch}.json"), throughput
+        )
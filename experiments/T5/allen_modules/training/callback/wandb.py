@@ -1,11 +1,17 @@
+import json
 import logging
 import os
-from typing import Optional, Dict, Any, List, Union, Tuple, TYPE_CHECKING
+import queue
+import threading
+from typing import Optional, Dict, Any, List, Union, Tuple, Callable, TYPE_CHECKING
 
 
+import numpy
 import torch
 
 from allennlp.common import Params
+from allennlp.common.checks import ConfigurationError
+from allennlp.data import TensorDict
 from allennlp.training.callbacks.callback import TrainerCallback
 from allennlp.training.callbacks.log_writer import LogWriterCallback
 
@@ -17,6 +23,74 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
+class _HistogramSnapshot:
+    """
+    A strided sample of at most `max_samples` values of a tensor, copied to the CPU on the
+    training thread. The histogram itself is computed by the logging worker.
+    """
+
+    def __init__(self, tensor: torch.Tensor, max_samples: int) -> None:
+        flat = tensor.detach().flatten()
+        if flat.numel() > max_samples:
+            stride = -(-flat.numel() // max_samples)
+            flat = flat[::stride]
+        self.values = flat.to("cpu", dtype=torch.float32, copy=True)
+
+    def histogram(self, num_bins: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        return numpy.histogram(self.values.numpy(), bins=num_bins)
+
+
+def _to_python(value: Any) -> Any:
+    # Tensors and numpy scalars, e.g. the tensor learning rate of `inverse_sqrt_tensor`, aren't
+    # JSON serializable. Converted on the worker, so the training thread doesn't synchronize.
+    if isinstance(value, (torch.Tensor, numpy.ndarray, numpy.generic)):
+        return value.tolist()
+    return value
+
+
+class _LoggingWorker:
+    """
+    Writes logged entries with `write(step, entry)` on a background thread. The queue holds at
+    most `max_queue_size` entries: scalar entries wait for room, histogram entries are dropped
+    when the worker falls behind.
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, write: Callable[[int, Dict[str, Any]], None], max_queue_size: int) -> None:
+        self._write = write
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue_size)
+        self.num_dropped = 0
+        self._thread = threading.Thread(target=self._run, name="wandb-logging", daemon=True)
+        self._thread.start()
+
+    def submit(self, step: int, entry: Dict[str, Any], droppable: bool = False) -> None:
+        if not droppable:
+            self._queue.put((step, entry))
+            return
+        try:
+            self._queue.put_nowait((step, entry))
+        except queue.Full:
+            self.num_dropped += 1
+
+    def close(self) -> None:
+        self._queue.put(self._CLOSE)
+        self._thread.join()
+        if self.num_dropped:
+            logger.warning("Dropped %d histogram log entries, the logging queue was full.", self.num_dropped)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is self._CLOSE:
+                return
+            try:
+                self._write(*item)
+            except Exception:
+                # Logging must never stop the training.
+                logger.exception("Failed to write a log entry")
+
+
 @TrainerCallback.register("debug_wandb")
 class WandBCallback(LogWriterCallback):
     """
@@ -46,12 +120,28 @@ class WandBCallback(LogWriterCallback):
         A description of the run.
     tags : `Optional[List[str]]`, optional (default = `None`)
         Tags to assign to the training run in W&B.
-    watch_model : `bool`, optional (default = `True`)
-        Whether or not W&B should watch the `Model`.
+    watch_model : `bool`, optional (default = `False`)
+        Whether or not W&B should watch the `Model`. Watching logs gradient histograms from hooks
+        on the training thread.
     files_to_save : `Tuple[str, ...]`, optional (default = `("config.json", "out.log")`)
         Extra files in the serialization directory to save to the W&B training run.
     wandb_kwargs : `Optional[Dict[str, Any]]`, optional (default = `None`)
         Additional key word arguments to pass to [`wandb.init()`](https://docs.wandb.ai/ref/python/init).
+    backend : `str`, optional (default = `"wandb"`)
+        `"wandb"` logs to Weights & Biases, `"local"` appends one JSON line per step to
+        `log_file` in the serialization directory instead, without initializing W&B.
+    log_file : `str`, optional (default = `"wandb_log.jsonl"`)
+        The file of the `"local"` backend.
+    max_queue_size : `int`, optional (default = `64`)
+        The number of logged steps that may wait for the background worker.
+    histogram_samples : `int`, optional (default = `10000`)
+        Histograms are computed from a strided sample of at most this many values per tensor.
+    histogram_bins : `int`, optional (default = `64`)
+        The number of bins of the histograms.
+
+    All entries of a batch are coalesced into one entry and handed to a background thread,
+    which computes the histograms and calls `wandb.log` (or writes the local file), so the
+    training thread never waits for the network or for the serialization.
     """
 
     def __init__(
@@ -68,11 +158,18 @@ class WandBCallback(LogWriterCallback):
         name: Optional[str] = None,
         notes: Optional[str] = None,
         tags: Optional[List[str]] = None,
-        watch_model: bool = True,
+        watch_model: bool = False,
         files_to_save: Tuple[str, ...] = ("config.json", "out.log"),
         wandb_kwargs: Optional[Dict[str, Any]] = None,
+        backend: str = "wandb",
+        log_file: str = "wandb_log.jsonl",
+        max_queue_size: int = 64,
+        histogram_samples: int = 10000,
+        histogram_bins: int = 64,
     ) -> None:
-        if "WANDB_API_KEY" not in os.environ:
+        if backend not in ("wandb", "local"):
+            raise ConfigurationError(f"backend must be 'wandb' or 'local', got '{backend}'")
+        if backend == "wandb" and "WANDB_API_KEY" not in os.environ:
             logger.warning(
                 "Missing environment variable 'WANDB_API_KEY' required to authenticate to Weights & Biases."
             )
@@ -86,6 +183,16 @@ class WandBCallback(LogWriterCallback):
             should_log_learning_rate=should_log_learning_rate,
         )
 
+        self._backend = backend
+        self._log_file = os.path.join(serialization_dir, log_file)
+        self._local_log: Optional[Any] = None
+        self._max_queue_size = max_queue_size
+        self._histogram_samples = histogram_samples
+        self._histogram_bins = histogram_bins
+        self._worker: Optional[_LoggingWorker] = None
+        # The entry of the current step, handed to the worker by `_flush`.
+        self._pending: Dict[str, Any] = {}
+        self._pending_step: Optional[int] = None
         self._watch_model = watch_model
         self._files_to_save = files_to_save
         self._run_id: Optional[str] = None
@@ -114,7 +221,7 @@ class WandBCallback(LogWriterCallback):
         self, tensors: Dict[str, torch.Tensor], log_prefix: str = "", epoch: Optional[int] = None
     ) -> None:
         self._log(
-            {k: self.wandb.Histogram(v.cpu().data.numpy().flatten()) for k, v in tensors.items()},  # type: ignore
+            {k: _HistogramSnapshot(v, self._histogram_samples) for k, v in tensors.items()},
             log_prefix=log_prefix,
             epoch=epoch,
         )
@@ -126,7 +233,85 @@ class WandBCallback(LogWriterCallback):
             dict_to_log = {f"{log_prefix}/{k}": v for k, v in dict_to_log.items()}
         if epoch is not None:
             dict_to_log["epoch"] = epoch
-        self.wandb.log(dict_to_log, step=self.trainer._total_batches_completed)  # type: ignore
+        step = self.trainer._total_batches_completed  # type: ignore
+        if self._pending_step is not None and step != self._pending_step:
+            self._flush()
+        self._pending_step = step
+        self._pending.update(dict_to_log)
+
+    def _flush(self) -> None:
+        if self._pending_step is None:
+            return
+        entry, step = self._pending, self._pending_step
+        self._pending, self._pending_step = {}, None
+        if not entry or self._worker is None:
+            return
+        has_histograms = any(isinstance(value, _HistogramSnapshot) for value in entry.values())
+        if has_histograms:
+            # Keep the scalars even if the histograms are dropped.
+            scalars = {k: v for k, v in entry.items() if not isinstance(v, _HistogramSnapshot)}
+            histograms = {k: v for k, v in entry.items() if isinstance(v, _HistogramSnapshot)}
+            if scalars:
+                self._worker.submit(step, scalars)
+            self._worker.submit(step, histograms, droppable=True)
+        else:
+            self._worker.submit(step, entry)
+
+    def _write(self, step: int, entry: Dict[str, Any]) -> None:
+        # Runs on the logging worker.
+        if self._backend == "local":
+            record: Dict[str, Any] = {"step": step}
+            for key, value in entry.items():
+                if isinstance(value, _HistogramSnapshot):
+                    counts, edges = value.histogram(self._histogram_bins)
+                    value = {"counts": counts.tolist(), "bin_edges": edges.tolist()}
+                record[key] = _to_python(value)
+            self._local_log.write(json.dumps(record) + "\n")  # type: ignore[union-attr]
+            return
+        for key, value in entry.items():
+            if isinstance(value, _HistogramSnapshot):
+                entry[key] = self.wandb.Histogram(np_histogram=value.histogram(self._histogram_bins))
+            else:
+                entry[key] = _to_python(value)
+        self.wandb.log(entry, step=step)
+
+    def on_batch(
+        self,
+        trainer: "GradientDescentTrainer",
+        batch_inputs: List[TensorDict],
+        batch_outputs: List[Dict[str, Any]],
+        batch_metrics: Dict[str, Any],
+        epoch: int,
+        batch_number: int,
+        is_training: bool,
+        is_primary: bool = True,
+        batch_grad_norm: Optional[float] = None,
+        **kwargs,
+    ) -> None:
+        super().on_batch(
+            trainer,
+            batch_inputs,
+            batch_outputs,
+            batch_metrics,
+            epoch,
+            batch_number,
+            is_training,
+            is_primary=is_primary,
+            batch_grad_norm=batch_grad_norm,
+            **kwargs,
+        )
+        self._flush()
+
+    def on_epoch(
+        self,
+        trainer: "GradientDescentTrainer",
+        metrics: Dict[str, Any],
+        epoch: int,
+        is_primary: bool = True,
+        **kwargs,
+    ) -> None:
+        super().on_epoch(trainer, metrics, epoch, is_primary=is_primary, **kwargs)
+        self._flush()
 
     def on_start(
         self, trainer: "GradientDescentTrainer", is_primary: bool = True, **kwargs
@@ -136,6 +321,11 @@ class WandBCallback(LogWriterCallback):
         if not is_primary:
             return None
 
+        self._worker = _LoggingWorker(self._write, self._max_queue_size)
+        if self._backend == "local":
+            self._local_log = open(self._log_file, "a")
+            return None
+
         import wandb
 
         self.wandb = wandb
@@ -156,7 +346,15 @@ class WandBCallback(LogWriterCallback):
 
     def close(self) -> None:
         super().close()
-        self.wandb.finish()  # type: ignore
+        self._flush()
+        if self._worker is not None:
+            self._worker.close()
+            self._worker = None
+        if self._local_log is not None:
+            self._local_log.close()
+            self._local_log = None
+        elif self._backend == "wandb":
+            self.wandb.finish()  # type: ignore
 
     def state_dict(self) -> Dict[str, Any]:
         return {
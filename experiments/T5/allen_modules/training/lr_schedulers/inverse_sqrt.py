@@ -1,7 +1,14 @@
+import re
+from typing import Any, Dict
+
 import torch
 
 from allennlp.training.learning_rate_schedulers.learning_rate_scheduler import LearningRateScheduler
 
+# Optimizers accept a tensor learning rate, read on the device by fused/capturable kernels,
+# since torch 2.2.
+_TENSOR_LR = tuple(int(v) for v in re.findall(r"\d+", torch.__version__)[:2]) >= (2, 2)
+
 
 @LearningRateScheduler.register("inverse_sqrt")
 class InverseSqrtLR(LearningRateScheduler):
@@ -36,4 +43,75 @@ class InverseSqrtLR(LearningRateScheduler):
         else:
             scale =  self.decay_factor * step ** -0.5
 
-        return [scale for _ in range(len(self.base_values))]
\ No newline at end of file
+        return [scale] * len(self.base_values)
+
+
+@LearningRateScheduler.register("inverse_sqrt_tensor")
+class TensorInverseSqrtLR(InverseSqrtLR):
+    """
+    The schedule of `InverseSqrtLR`, `warmup_end_lr * min(step / warmup_steps,
+    sqrt(warmup_steps / step))`, kept in a 0-dim tensor on the device of the parameters and
+    updated in place in closed form. With torch >= 2.2, every param group reads its `"lr"` from
+    that tensor, so a fused optimizer takes the learning rate on the device and a captured
+    (CUDA graph / compiled) training step that calls `update` is replayed without Python-side
+    writes to the param groups. Older torch versions get the same values as Python floats.
+
+    Registered as a `LearningRateScheduler` with name "inverse_sqrt_tensor".
+    """
+
+    def __init__(
+        self,
+        optimizer: torch.optim.Optimizer,
+        warmup_steps: int,
+        warmup_end_lr: float = 1.0,
+        last_epoch: int = -1,
+    ) -> None:
+        super().__init__(optimizer, warmup_steps, warmup_end_lr=warmup_end_lr, last_epoch=last_epoch)
+        device = next(
+            (param.device for group in optimizer.param_groups for param in group["params"]),
+            torch.device("cpu"),
+        )
+        self._step_tensor = torch.tensor(float(max(self.last_epoch, 0)), device=device)
+        self._lr_tensor = torch.zeros((), device=device)
+        self._update_lr()
+        self._bind_param_groups()
+
+    def _bind_param_groups(self) -> None:
+        if _TENSOR_LR:
+            for param_group in self.optimizer.param_groups:
+                param_group["lr"] = self._lr_tensor
+
+    def _update_lr(self) -> None:
+        # Shape: ()
+        ratio = self._step_tensor.clamp(min=1.0) / self.warmup_steps
+        torch.minimum(ratio, ratio.rsqrt(), out=self._lr_tensor)
+        self._lr_tensor.mul_(self.lr)
+
+    def update(self) -> None:
+        """
+        Advances the schedule by one batch with tensor operations only, so it can be part of a
+        captured training step. The param groups aren't touched.
+        """
+        self._step_tensor.add_(1.0)
+        self._update_lr()
+
+    def step_batch(self, batch_num_total: int = None) -> None:
+        if batch_num_total is None:
+            self.last_epoch += 1  # type: ignore
+            self._step_tensor.add_(1.0)
+        else:
+            self.last_epoch = batch_num_total
+            self._step_tensor.fill_(float(batch_num_total))
+        self._update_lr()
+        if not _TENSOR_LR:
+            super().step_batch(self.last_epoch)
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        # Keep the tensors the param groups (and any captured step) refer to.
+        step_tensor, lr_tensor = self._step_tensor, self._lr_tensor
+        super().load_state_dict(state_dict)
+        step_tensor.copy_(self._step_tensor)
+        lr_tensor.copy_(self._lr_tensor)
+        self._step_tensor, self._lr_tensor = step_tensor, lr_tensor
+        # The optimizer state was loaded before and replaced the learning rates.
+        self._bind_param_groups()
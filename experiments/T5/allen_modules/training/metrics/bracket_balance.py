@@ -0,0 +1,29 @@
+from allennlp.training.metrics.metric import Metric
+from typing import Dict
+
+from allen_modules.training.postprocess.postprocessor import BracketStats
+
+@Metric.register("bracket_balance")
+class BracketBalance(Metric):
+    """
+    Fraction of predictions whose brackets were unbalanced before postprocessing.
+    The names start with "_" so they stay out of the progress bar.
+    """
+    def __init__(self) -> None:
+        self.stats = BracketStats()
+
+    def __call__(self, stats: BracketStats):
+        self.stats.merge(stats)
+
+    def get_metric(self, reset: bool = False) -> Dict[str, float]:
+        num_texts = self.stats.num_texts
+        result = {
+            "_unclosed": self.stats.num_unclosed * 1.0 / num_texts if num_texts else 0.0,
+            "_overclosed": self.stats.num_overclosed * 1.0 / num_texts if num_texts else 0.0,
+        }
+        if reset:
+            self.reset()
+        return result
+
+    def reset(self) -> None:
+        self.stats = BracketStats()
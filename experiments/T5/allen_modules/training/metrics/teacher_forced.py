@@ -0,0 +1,56 @@
+from allennlp.training.metrics.metric import Metric
+from typing import Dict, Optional
+
+import torch
+
+@Metric.register("teacher_forced_accuracy")
+class TeacherForcedAccuracy(Metric):
+    """
+    Greedy token accuracy and sequence exact match of the teacher-forced decoder, i.e. the argmax
+    of the logits at every target position given the gold prefix. Much cheaper than beam search,
+    it is used as a proxy for the exact match accuracy. The counts are kept on the device, so
+    scoring a batch does not synchronize.
+    """
+    def __init__(self) -> None:
+        self._correct_tokens: Optional[torch.Tensor] = None
+        self._total_tokens: Optional[torch.Tensor] = None
+        self._correct_sequences: Optional[torch.Tensor] = None
+        self._total_sequences = 0
+
+    def __call__(self, logits: torch.Tensor, labels: torch.Tensor, mask: torch.BoolTensor):
+        """
+        :param logits: shape (batch_size, target_length, vocab_size)
+        :param labels: gold token ids, shape (batch_size, target_length)
+        :param mask: shape (batch_size, target_length), `False` at the padding
+        """
+        logits, labels, mask = self.detach_tensors(logits, labels, mask)
+        mask = mask.bool()
+        # Shape: (batch_size, target_length)
+        correct = logits.argmax(dim=-1) == labels
+        correct_tokens = (correct & mask).sum()
+        correct_sequences = (correct | ~mask).all(dim=-1).sum()
+        if self._correct_tokens is None:
+            self._correct_tokens = correct_tokens
+            self._total_tokens = mask.sum()
+            self._correct_sequences = correct_sequences
+        else:
+            self._correct_tokens += correct_tokens
+            self._total_tokens += mask.sum()
+            self._correct_sequences += correct_sequences
+        self._total_sequences += labels.size(0)
+
+    def get_metric(self, reset: bool = False) -> Dict[str, float]:
+        result = {"proxy_token_acc": 0.0, "proxy_seq_acc": 0.0}
+        if self._correct_tokens is not None:
+            total_tokens = self._total_tokens.item()
+            result["proxy_token_acc"] = self._correct_tokens.item() / total_tokens if total_tokens else 0.0
+            result["proxy_seq_acc"] = self._correct_sequences.item() / self._total_sequences
+        if reset:
+            self.reset()
+        return result
+
+    def reset(self) -> None:
+        self._correct_tokens = None
+        self._total_tokens = None
+        self._correct_sequences = None
+        self._total_sequences = 0
@@ -0,0 +1,47 @@
+import inspect
+from typing import Any, Dict, List, Tuple
+
+import torch
+
+from allennlp.training.optimizers import Optimizer, make_parameter_groups
+
+# torch>=2.0 has a fused CUDA kernel, older versions a multi-tensor (foreach) implementation
+# that updates all parameters of a group with a few horizontally fused kernels.
+_HAS_FUSED_ADAMW = "fused" in inspect.signature(torch.optim.AdamW.__init__).parameters
+if _HAS_FUSED_ADAMW:
+    _AdamW = torch.optim.AdamW
+else:
+    try:
+        from torch.optim._multi_tensor import AdamW as _AdamW
+    except ImportError:
+        _AdamW = torch.optim.AdamW
+
+
+@Optimizer.register("fused_adamw")
+class FusedAdamWOptimizer(Optimizer, _AdamW):
+    """
+    AdamW that updates all parameters with fused kernels instead of one kernel launch per
+    parameter and operation. Registered as an `Optimizer` with name "fused_adamw".
+    With `weight_decay: 0.0` it matches the "adam" optimizer.
+    """
+
+    def __init__(
+        self,
+        model_parameters: List[Tuple[str, torch.nn.Parameter]],
+        parameter_groups: List[Tuple[List[str], Dict[str, Any]]] = None,
+        lr: float = 0.001,
+        betas: Tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-08,
+        weight_decay: float = 0.01,
+        amsgrad: bool = False,
+    ):
+        kwargs = {"fused": True} if _HAS_FUSED_ADAMW else {}
+        super().__init__(
+            params=make_parameter_groups(model_parameters, parameter_groups),
+            lr=lr,
+            betas=betas,
+            eps=eps,
+            weight_decay=weight_decay,
+            amsgrad=amsgrad,
+            **kwargs,
+        )
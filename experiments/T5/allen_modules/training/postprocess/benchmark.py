@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of the batched postprocessors against the former per-string implementation.
+
+    python -m allen_modules.training.postprocess.benchmark model_archives/cogs_LF/0/output/out.test.pred.read.tsv
+
+Predictions are read from the last column of the tsv file and repeated up to `--num-predictions`.
+"""
+import argparse
+import csv
+import re
+import time
+from typing import List
+
+from allen_modules.training.postprocess.simple import COGSPostprocessor
+
+
+def legacy_cogs(predicted_texts: List[str], sort: bool = False) -> List[str]:
+    # The implementation before the batched postprocessors, kept as the reference.
+    output = []
+    for predicted_text in predicted_texts:
+        predicted_text = predicted_text.rstrip().lstrip()
+        for sym in [".", ",", "="]:
+            predicted_text = predicted_text.replace(sym, " {} ".format(sym))
+        predicted_text = " ".join(predicted_text.split())
+        if sort:
+            predicted_text = " AND ".join(sorted(re.split(r' AND | ; ', predicted_text)))
+        tokens = predicted_text.split()
+        lb = 0
+        for token in tokens:
+            if token == "(":
+                lb += 1
+            if token == ")":
+                lb -= 1
+        if lb >= 1:
+            for i in range(lb):
+                tokens.append(")")
+        output.append(" ".join(tokens))
+    return output
+
+
+def read_predictions(file_path: str, num_predictions: int) -> List[str]:
+    with open(file_path, "r") as data_file:
+        predictions = [row[-1] for row in csv.reader(data_file, delimiter="\t", quoting=csv.QUOTE_NONE) if row]
+    if not predictions:
+        raise ValueError("No predictions in {}".format(file_path))
+    return (predictions * (num_predictions // len(predictions) + 1))[:num_predictions]
+
+
+def time_call(fn, *args, repeats: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("prediction_file", type=str, help="tsv file whose last column holds predictions")
+    parser.add_argument("--num-predictions", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--sort", action="store_true", default=False)
+    args = parser.parse_args()
+
+    predictions = read_predictions(args.prediction_file, args.num_predictions)
+    batches = [predictions[i:i + args.batch_size] for i in range(0, len(predictions), args.batch_size)]
+    postprocessor = COGSPostprocessor(sort=args.sort)
+
+    expected = legacy_cogs(predictions, sort=args.sort)
+    output, stats = postprocessor.process_batch(predictions)
+    assert output == expected, "batched postprocessor differs from the reference"
+
+    legacy_time = time_call(lambda: [legacy_cogs(batch, sort=args.sort) for batch in batches])
+    batched_time = time_call(lambda: [postprocessor.process_batch(batch) for batch in batches])
+    print("{} predictions in batches of {}".format(len(predictions), args.batch_size))
+    print("legacy:  {:.3f}s".format(legacy_time))
+    print("batched: {:.3f}s ({:.2f}x)".format(batched_time, legacy_time / batched_time))
+    print("unclosed: {}, overclosed: {}, brackets added: {}".format(
+        stats.num_unclosed, stats.num_overclosed, stats.num_added))
+
+
+if __name__ == "__main__":
+    main()
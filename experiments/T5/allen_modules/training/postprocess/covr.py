@@ -2,8 +2,8 @@
 from typing import Union, Dict, Any, Optional, List
 import re
 import copy
-from allen_modules.training.postprocess.postprocessor import Postprocessor
-from allen_modules.training.postprocess.simple import SimplePostprocessor
+from allen_modules.training.postprocess.postprocessor import Postprocessor, BracketStats, bracket_depth
+from allen_modules.training.postprocess.simple import SimplePostprocessor, compile_symbols
 
 @Postprocessor.register("covr")
 class COVRPostprocessor(SimplePostprocessor):
@@ -17,13 +17,6 @@ class COVRPostprocessor(SimplePostprocessor):
         self.seg_symbols = segment_symbols
         self.skip_special_tokens = skip_special_tokens
 
-    def __call__(self, predicted_texts: List[str]):
-        """
-
-        :param predicted_texts: text string list returned by allennlp models
-        """
-        return self.format(predicted_texts, segment_symbols=self.seg_symbols)
-
     def format(self, predicted_texts: List[str],
                     segment_symbols: List[str] = None,
                     remove_symbols: List[str] = None):
@@ -31,38 +24,40 @@ class COVRPostprocessor(SimplePostprocessor):
 
         :param predicted_texts: text string list returned by allennlp models
         """
-        output = []
-        for predicted_text in predicted_texts:
-            predicted_text = predicted_text.rstrip().lstrip()
-            if segment_symbols is not None:
-                for sym in segment_symbols:
-                    predicted_text = predicted_text.replace(sym, " {} ".format(sym))
-            if remove_symbols is not None:
-                for sym in remove_symbols:
-                    predicted_text = predicted_text.replace(sym, "")
-            predicted_text = self.close_brackets(predicted_text)
-            predicted_text = self.reconstruct_rc_consts(predicted_text)
-            predicted_text = " ".join(predicted_text.split())
-            output.append(predicted_text)
-        return output
-
-    def close_brackets(self, predicted_text):
-        tokens = predicted_text.split()
-        bracketed = 0
-        for i in range(len(tokens)):
-            if tokens[i] == "(":
-                bracketed += 1
-            elif tokens[i] == ")":
-                bracketed -= 1
+        segment_pairs = compile_symbols(tuple(segment_symbols or ()))
+        remove_pairs = compile_symbols(tuple(remove_symbols or ()), "")
+        stats = BracketStats()
+        return [
+            self.postprocess_tokens(self.tokenize(predicted_text, segment_pairs, remove_pairs), stats)
+            for predicted_text in predicted_texts
+        ]
+
+    def postprocess_tokens(self, tokens: List[str], stats: BracketStats) -> str:
+        bracketed = bracket_depth(tokens)
+        closed = self._close_bracket_tokens(tokens, bracketed)
+        stats.update(bracketed, num_added=len(closed) - len(tokens))
+        return self._reconstruct_rc_tokens(closed)
+
+    def _close_bracket_tokens(self, tokens: List[str], bracketed: int) -> List[str]:
         if bracketed > 0:
-            tokens += [")" for _ in range(bracketed)]
+            return tokens + [")" for _ in range(bracketed)]
         elif bracketed < 0:
             if tokens[len(tokens)+bracketed:] != [")" for _ in range(bracketed)]:
-                return predicted_text
-            tokens = tokens[:len(tokens)+bracketed]
-        return " ".join(tokens)
+                return tokens
+            return tokens[:len(tokens)+bracketed]
+        return tokens
+
+    def close_brackets(self, predicted_text):
+        tokens = predicted_text.split()
+        closed = self._close_bracket_tokens(tokens, bracket_depth(tokens))
+        if closed is tokens and bracket_depth(tokens) < 0:
+            return predicted_text
+        return " ".join(closed)
 
     def reconstruct_rc_consts(self, predicted_text:str):
+        return self._reconstruct_rc_tokens(predicted_text.split())
+
+    def _reconstruct_rc_tokens(self, tokens: List[str]) -> str:
         def find_closed_brackets(tokens, idx):
             bracketed = 0
             for i in range(idx, len(tokens)):
@@ -80,7 +75,6 @@ class COVRPostprocessor(SimplePostprocessor):
             i = 0
             const_start_idx = 0
             # print(len(tokens))
-            print(tokens)
             while i < len(tokens):
                 # print(i)
                 if tokens[i] == "(":
@@ -161,7 +155,6 @@ class COVRPostprocessor(SimplePostprocessor):
                 else:
                     new_tree = self
                 return new_tree
-        tokens = predicted_text.split()
         try:
             tree = covr_tree(tokens)
         except AssertionError:
@@ -2,7 +2,7 @@
     We use this base class to implement task-specific post-process functions
 """
 
-from typing import Union, Dict, Any, Optional, List
+from typing import Union, Dict, Any, Optional, List, Tuple
 from os import PathLike
 from pathlib import Path
 import torch
@@ -16,11 +16,51 @@ from allennlp.common import Registrable
 from allennlp.models import Model
 from allennlp.data import DataLoader
 
+class BracketStats(object):
+    """
+        Counts how many postprocessed predictions had unbalanced brackets
+    """
+
+    def __init__(self):
+        self.num_texts = 0
+        # predictions with missing ")" (closed by the postprocessor, if it does so)
+        self.num_unclosed = 0
+        # predictions with more ")" than "("
+        self.num_overclosed = 0
+        self.num_added = 0
+
+    def update(self, depth: int, num_added: int = 0):
+        """
+
+        :param depth: number of "(" minus number of ")" of a prediction before postprocessing
+        :param num_added: number of ")" the postprocessor appended
+        """
+        self.num_texts += 1
+        if depth > 0:
+            self.num_unclosed += 1
+        elif depth < 0:
+            self.num_overclosed += 1
+        self.num_added += num_added
+
+    def merge(self, other: "BracketStats"):
+        self.num_texts += other.num_texts
+        self.num_unclosed += other.num_unclosed
+        self.num_overclosed += other.num_overclosed
+        self.num_added += other.num_added
+        return self
+
+
+def bracket_depth(tokens: List[str]) -> int:
+    return tokens.count("(") - tokens.count(")")
+
+
 class Postprocessor(Registrable):
     """
         Base class for postprocessing predictions of allennlp models
     """
 
+    skip_special_tokens = True
+
     def __call__(self, predicted_texts: List[str]):
         """
 
@@ -28,6 +68,18 @@ class Postprocessor(Registrable):
         """
         raise NotImplementedError
 
+    def process_batch(self, predicted_texts: List[str]) -> Tuple[List[str], BracketStats]:
+        """
+
+        :param predicted_texts: text string list returned by allennlp models
+        :return: the postprocessed strings and the bracket balance of the predictions
+        """
+        stats = BracketStats()
+        output = self(predicted_texts)
+        for predicted_text in predicted_texts:
+            stats.update(bracket_depth(predicted_text.split()))
+        return output, stats
+
     def format(self):
         """
 
@@ -1,8 +1,20 @@
-
-from typing import Union, Dict, Any, Optional, List
+from typing import Union, Dict, Any, Optional, List, Tuple
+from functools import lru_cache
 import re
 
-from allen_modules.training.postprocess.postprocessor import Postprocessor
+from allen_modules.training.postprocess.postprocessor import Postprocessor, BracketStats, bracket_depth
+
+_CONJUNCT_SEPARATOR = re.compile(r' AND | ; ')
+
+
+@lru_cache(maxsize=None)
+def compile_symbols(symbols: Tuple[str, ...], replacement: str = " {} ") -> Tuple[Tuple[str, str], ...]:
+    """
+    Precomputes the `(symbol, replacement)` pairs of a postprocessor once. Chained `str.replace`
+    calls are faster than a regular expression on strings as short as a logical form.
+    """
+    return tuple((sym, replacement.format(sym)) for sym in symbols)
+
 
 @Postprocessor.register("simple")
 class SimplePostprocessor(Postprocessor):
@@ -21,7 +33,44 @@ class SimplePostprocessor(Postprocessor):
 
         :param predicted_texts: text string list returned by allennlp models
         """
-        return self.format(predicted_texts, segment_symbols=self.seg_symbols)
+        return self.process_batch(predicted_texts)[0]
+
+    def tokenize(self, predicted_text: str,
+                 segment_pairs: Tuple[Tuple[str, str], ...] = (),
+                 remove_pairs: Tuple[Tuple[str, str], ...] = ()) -> List[str]:
+        """
+        Segments and removes the symbols of the precomputed pairs and splits on whitespace.
+        """
+        for sym, replacement in segment_pairs:
+            predicted_text = predicted_text.replace(sym, replacement)
+        for sym, replacement in remove_pairs:
+            predicted_text = predicted_text.replace(sym, replacement)
+        return predicted_text.split()
+
+    def postprocess_tokens(self, tokens: List[str], stats: BracketStats) -> str:
+        """
+        Task-specific postprocessing of the tokens of one prediction.
+
+        :param stats: bracket balance of the batch, updated with this prediction
+        """
+        stats.update(bracket_depth(tokens))
+        return " ".join(tokens)
+
+    def process_batch(self, predicted_texts: List[str]) -> Tuple[List[str], BracketStats]:
+        """
+
+        :param predicted_texts: text string list returned by allennlp models
+        :return: the postprocessed strings and the bracket balance of the predictions
+        """
+        segment_pairs = compile_symbols(tuple(self.seg_symbols or ()))
+        postprocess_tokens = self.postprocess_tokens
+        stats = BracketStats()
+        output = []
+        for predicted_text in predicted_texts:
+            for sym, replacement in segment_pairs:
+                predicted_text = predicted_text.replace(sym, replacement)
+            output.append(postprocess_tokens(predicted_text.split(), stats))
+        return output, stats
 
     def format(self, predicted_texts: List[str],
                     segment_symbols: List[str] = None,
@@ -30,18 +79,12 @@ class SimplePostprocessor(Postprocessor):
 
         :param predicted_texts: text string list returned by allennlp models
         """
-        output = []
-        for predicted_text in predicted_texts:
-            predicted_text = predicted_text.rstrip().lstrip()
-            if segment_symbols is not None:
-                for sym in segment_symbols:
-                    predicted_text = predicted_text.replace(sym, " {} ".format(sym))
-            if remove_symbols is not None:
-                for sym in remove_symbols:
-                    predicted_text = predicted_text.replace(sym, "")
-            predicted_text = " ".join(predicted_text.split())
-            output.append(predicted_text)
-        return output
+        segment_pairs = compile_symbols(tuple(segment_symbols or ()))
+        remove_pairs = compile_symbols(tuple(remove_symbols or ()), "")
+        return [
+            " ".join(self.tokenize(predicted_text, segment_pairs, remove_pairs))
+            for predicted_text in predicted_texts
+        ]
 
 
 @Postprocessor.register("cogs")
@@ -56,37 +99,25 @@ class COGSPostprocessor(SimplePostprocessor):
         self.seg_symbols = [".", ",", "="]
         self.sort = sort
 
-    def __call__(self, predicted_texts: List[str]):
-        """
-
-        :param predicted_texts: text string list returned by allennlp models
-        """
-        predicted_texts = self.format(predicted_texts, segment_symbols=self.seg_symbols)
-
-        return [self.postprocess_mr(predicted_text) for predicted_text in predicted_texts]
-
     def close_brackets(self, predicted_texts: str):
         tokens = predicted_texts.split()
-        lb = 0
-        for token in tokens:
-            if token == "(":
-                lb += 1
-            if token == ")":
-                lb -= 1
+        lb = bracket_depth(tokens)
         if lb >= 1:
-            for i in range(lb):
-                tokens.append(")")
+            tokens += [")"] * lb
         return " ".join(tokens)
 
-    def postprocess_mr(self, predicted_texts: str):
+    def postprocess_tokens(self, tokens: List[str], stats: BracketStats) -> str:
+        lb = bracket_depth(tokens)
+        predicted_text = " ".join(tokens)
         if self.sort:
-            conjuncts = re.split(r' AND | ; ', predicted_texts)
-            new_conjuncts = sorted(conjuncts)
-            predicted_texts = " AND ".join(new_conjuncts)
-
-        predicted_texts = self.close_brackets(predicted_texts)
+            predicted_text = " AND ".join(sorted(_CONJUNCT_SEPARATOR.split(predicted_text)))
+        if lb >= 1:
+            predicted_text += " )" * lb
+        stats.update(lb, num_added=max(lb, 0))
+        return predicted_text
 
-        return predicted_texts
+    def postprocess_mr(self, predicted_texts: str):
+        return self.postprocess_tokens(predicted_texts.split(), BracketStats())
 
 @Postprocessor.register("cfq")
 class CFQPostprocessor(SimplePostprocessor):
@@ -101,11 +132,9 @@ class CFQPostprocessor(SimplePostprocessor):
         self.sort = sort
         self.use_brackets = sort_use_brackets
 
-    def __call__(self, predicted_texts: List[str]):
-
-        predicted_texts = self.format(predicted_texts, segment_symbols=self.seg_symbols)
-
-        return [self.postprocess_program(predicted_text) for predicted_text in predicted_texts]
+    def postprocess_tokens(self, tokens: List[str], stats: BracketStats) -> str:
+        stats.update(bracket_depth(tokens))
+        return self.postprocess_program(" ".join(tokens))
 
     def _get_program_parts(self, program):
         """
@@ -159,4 +188,4 @@ class CFQPostprocessor(SimplePostprocessor):
         # program_processed = program_processed.replace("lb", "{")
         # program_processed = program_processed.replace("rb", "}")
         # program_processed = program_processed.replace("#", "^")
-        return program_processed
\ No newline at end of file
+        return program_processed
@@ -0,0 +1,26 @@
+archive_path=$1
+
+test_data=$2
+
+num_examples=${3:-2000}
+
+mkdir -p "${archive_path}/threads_benchmark"
+
+subset="${archive_path}/threads_benchmark/gen.${num_examples}.tsv"
+
+head -n $num_examples $test_data > $subset
+
+# intra-op threads, inter-op threads
+for setting in "1 1" "2 1" "4 1" "4 2" "8 1" "8 2" "$(nproc) 1"; do
+    set -- $setting
+    start=$(date +%s.%N)
+    allennlp eval $archive_path $subset \
+              --include-package allen_modules \
+              --cuda-device -1 \
+              --batch-size 64 \
+              --intra-op-threads $1 \
+              --inter-op-threads $2 \
+              --overrides '{"model.beam_search.beam_size": 4}' > /dev/null 2>&1
+    end=$(date +%s.%N)
+    echo "intra=$1 inter=$2 $(echo "$num_examples / ($end - $start)" | bc -l | xargs printf '%.2f') examples/s"
+done
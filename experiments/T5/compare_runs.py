@@ -0,0 +1,64 @@
+"""
+Compares a training profile (e.g. configs/cogs_LF_bf16) with its fp32 baseline:
+dev accuracy, peak GPU memory and training throughput of the final epoch.
+
+    python compare_runs.py model_archives/cogs_LF/0 model_archives/cogs_LF_bf16/0
+
+Exits with status 1 when the dev accuracies differ by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+ROWS = [
+    ("dev acc", "validation_acc"),
+    ("peak GPU memory (MB)", "peak_gpu_0_memory_MB"),
+    ("tokens/s", "training_tokens_per_second"),
+    ("training time", "training_duration"),
+]
+
+
+def read_metrics(archive_path):
+    with open(os.path.join(archive_path, "metrics.json")) as f:
+        metrics = json.load(f)
+    # The throughput callback writes its own file per epoch.
+    epochs = [
+        int(match.group(1))
+        for match in (re.fullmatch(r"throughput_epoch_(\d+)\.json", name) for name in os.listdir(archive_path))
+        if match is not None
+    ]
+    if epochs:
+        with open(os.path.join(archive_path, "throughput_epoch_{}.json".format(max(epochs)))) as f:
+            metrics.update(json.load(f))
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline", type=str, help="serialization directory of the fp32 run")
+    parser.add_argument("profile", type=str, help="serialization directory of the run to check")
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="largest accepted absolute difference of the dev accuracy")
+    args = parser.parse_args()
+
+    baseline, profile = read_metrics(args.baseline), read_metrics(args.profile)
+    print("{:<22}{:>16}{:>16}".format("", "baseline", "profile"))
+    for name, key in ROWS:
+        values = [metrics.get(key, "-") for metrics in (baseline, profile)]
+        values = ["{:.4f}".format(v) if isinstance(v, float) else str(v) for v in values]
+        print("{:<22}{:>16}{:>16}".format(name, *values))
+
+    if "validation_acc" not in baseline or "validation_acc" not in profile:
+        print("validation_acc missing, was the last epoch validated?")
+        sys.exit(1)
+    diff = abs(baseline["validation_acc"] - profile["validation_acc"])
+    if diff > args.tolerance:
+        print("dev accuracy differs by {:.4f} > {}".format(diff, args.tolerance))
+        sys.exit(1)
+    print("dev accuracy within {} of the baseline".format(args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
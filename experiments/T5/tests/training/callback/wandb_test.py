@@ -0,0 +1,33 @@
+import json
+from types import SimpleNamespace
+
+import torch
+
+from allennlp.common.testing import AllenNlpTestCase
+
+from allen_modules.training.callback.wandb import WandBCallback
+
+
+class TestWandBCallback(AllenNlpTestCase):
+    def test_local_backend_writes_tensor_learning_rates(self):
+        model = torch.nn.Linear(2, 1)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        # As bound by the `inverse_sqrt_tensor` scheduler on torch >= 2.2.
+        optimizer.param_groups[0]["lr"] = torch.tensor(0.5)
+        trainer = SimpleNamespace(model=model, optimizer=optimizer, _total_batches_completed=3)
+        # Written by `allennlp train` before the callbacks are built.
+        with open(self.TEST_DIR / "config.json", "w") as config_file:
+            json.dump({}, config_file)
+
+        callback = WandBCallback(
+            serialization_dir=str(self.TEST_DIR), backend="local", should_log_learning_rate=True
+        )
+        callback.on_start(trainer)
+        callback._log_learning_rates()
+        callback.close()
+
+        with open(self.TEST_DIR / "wandb_log.jsonl") as log_file:
+            records = [json.loads(line) for line in log_file]
+        assert records == [
+            {"step": 3, "learning_rate/weight": 0.5, "learning_rate/bias": 0.5}
+        ]
@@ -1,4 +1,9 @@
 import json
+import os
+from multiprocessing import Pool
+
+import fire
+
 
 def tsv_to_json(tsv_filename, json_filename, instruction=None):
     data_list = []
@@ -11,17 +16,50 @@ def tsv_to_json(tsv_filename, json_filename, instruction=None):
         json.dump(data_list, f_json, indent=4, separators=(',', ':'))
     return data_list
 
-def main():
+def tsv_to_jsonl(tsv_filename, jsonl_filename, instruction=None):
+    # streams one JSON object per line, so neither the TSV nor the output is held in memory
+    num_rows = 0
+    with open(tsv_filename) as f_tsv, open(jsonl_filename, 'w') as f_jsonl:
+        for line_num, line in enumerate(f_tsv, start=1):
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 3 or not all(fields):
+                raise ValueError(f"{tsv_filename}:{line_num}: expected 3 non-empty columns "
+                                 f"(input, output, gen_type), got {len(fields)}")
+            source, target, gen_type = (field.strip() for field in fields)
+            data = {'instruction': instruction, 'input': source, 'output': target,
+                    'gen_type': gen_type}
+            f_jsonl.write(json.dumps(data) + '\n')
+            num_rows += 1
+    return num_rows
+
+def _convert(args):
+    tsv_filename, out_filename, instruction, jsonl = args
+    if jsonl:
+        num_rows = tsv_to_jsonl(tsv_filename, out_filename, instruction=instruction)
+    else:
+        num_rows = len(tsv_to_json(tsv_filename, out_filename, instruction=instruction))
+    return out_filename, num_rows
+
+def main(jsonl=False, num_workers=8):
 
     instruction = 'Parse the input sentence into COGS meaning representation.'
 
     filenames = ["train", "dev", "test", "gen"]
+    extension = "jsonl" if jsonl else "json"
 
+    jobs = []
     for lf in ["cogs_LF", "varfree_LF"]:
         for fname in filenames:
             tsv_filename = f"../../data/{lf}/{fname}.tsv"
-            json_filename = f"data/{lf}/{fname}.json"
-            _ = tsv_to_json(tsv_filename, json_filename, instruction=instruction)
+            json_filename = f"data/{lf}/{fname}.{extension}"
+            if not os.path.exists(tsv_filename):
+                print(f"Skipping missing {tsv_filename}")
+                continue
+            jobs.append((tsv_filename, json_filename, instruction, jsonl))
+
+    with Pool(min(num_workers, len(jobs)) or 1) as pool:
+        for out_filename, num_rows in pool.imap_unordered(_convert, jobs):
+            print(f"Wrote {num_rows} rows to {out_filename}")
 
 if __name__ == '__main__':
-    main()
+    fire.Fire(main)
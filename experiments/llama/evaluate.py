@@ -1,9 +1,11 @@
+import datetime
 import os
 import sys
 
 import fire
 import gradio as gr
 import torch
+import torch.distributed as dist
 import json
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import BatchSampler
@@ -38,12 +40,24 @@ def main(
     datapath: str = None,
     max_new_tokens=256,
     pred_output_path: str = "",
+    quiet: bool = False,  # if True, mistakes go to mistakes.tsv next to pred_output_path instead of stdout
+    dist_timeout_minutes: int = 240,  # how long ranks wait for each other before the merge
 ):
+    # when started by a launcher (torchrun), every rank decodes a disjoint shard of the data
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    rank = int(os.environ.get("RANK", 0))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    sharded = world_size != 1
+    if sharded:
+        # ranks finish their shards at different times, the barrier before the merge waits for the slowest
+        dist.init_process_group(backend="gloo", timeout=datetime.timedelta(minutes=dist_timeout_minutes))
+        if device == "cuda":
+            torch.cuda.set_device(local_rank)
+
     # detect if the directory of pred_output_path does not exist
     if pred_output_path != "":
         pred_output_dir = os.path.dirname(pred_output_path)
-        if not os.path.exists(pred_output_dir):
-            os.makedirs(pred_output_dir)
+        os.makedirs(pred_output_dir, exist_ok=True)
 
     # write somthing to pred_output_path
     # if pred_output_path != "":
@@ -62,7 +76,7 @@ def main(
             base_model,
             load_in_8bit=load_8bit,
             torch_dtype=torch.float16,
-            device_map="auto",
+            device_map={"": local_rank} if sharded else "auto",
         )
         model = PeftModel.from_pretrained(
             model,
@@ -123,16 +137,21 @@ def main(
         # Use bucket batching to speed up the inference process
 
 
-        eval_dataloader = DataLoader(data["train"], batch_size=32)
+        eval_data = data["train"]
+        if sharded:
+            # contiguous shards keep the original order when rank 0 concatenates them
+            eval_data = eval_data.shard(num_shards=world_size, index=rank, contiguous=True)
+
+        eval_dataloader = DataLoader(eval_data, batch_size=32)
         # start_time = time.time()
-        for batch in tqdm(eval_dataloader):
+        for batch in tqdm(eval_dataloader, disable=rank != 0):
             # get the longest output length in the batch
             max_output_len = max([len(x) for x in batch["output"]])
             pred_output += evaluate_batch(batch)
 
 
 
-        with open(pred_output_path, "w") as f:
+        with open(shard_path(pred_output_path), "w") as f:
             f.writelines(pred_output)
 
     def evaluate_batch(batch,
@@ -149,7 +168,7 @@ def main(
                                             batch["input"][i])
                                             for i in range(batch_size)]
         gold_outputs = batch["output"]
-        encodings = tokenizer(prompts, return_tensors="pt", padding=True).to('cuda')
+        encodings = tokenizer(prompts, return_tensors="pt", padding=True).to(device)
         generation_config = GenerationConfig(
             temperature=temperature,
             top_p=top_p,
@@ -179,8 +198,46 @@ def main(
 
         return output
 
-    acc = ExactMatchAcc()
+    def shard_path(path):
+        return f"{path}.shard{rank}" if sharded else path
+
+    mistakes_path = os.path.join(os.path.dirname(pred_output_path), "mistakes.tsv")
+    acc = ExactMatchAcc(
+        quiet=quiet,
+        mistakes_path=shard_path(mistakes_path) if quiet else None,
+    )
     evaluate(data_path=datapath)
+    acc.close()
+
+    if sharded:
+        with open(shard_path(pred_output_path) + ".counts.json", "w") as f:
+            json.dump(acc.get_counts(), f)
+        dist.barrier()
+        if rank != 0:
+            dist.destroy_process_group()
+            return
+        # rank 0 merges the shard predictions and reduces the per gen_type counts
+        acc = ExactMatchAcc()
+        with open(pred_output_path, "w") as f_out:
+            for shard in range(world_size):
+                shard_pred_path = f"{pred_output_path}.shard{shard}"
+                with open(shard_pred_path) as f_in:
+                    f_out.writelines(f_in)
+                with open(shard_pred_path + ".counts.json") as f_in:
+                    acc.merge_counts(json.load(f_in))
+                os.remove(shard_pred_path)
+                os.remove(shard_pred_path + ".counts.json")
+        if quiet:
+            # same order as the predictions; a shard without mistakes never opened its file
+            with open(mistakes_path, "w") as f_out:
+                for shard in range(world_size):
+                    shard_mistakes_path = f"{mistakes_path}.shard{shard}"
+                    if os.path.exists(shard_mistakes_path):
+                        with open(shard_mistakes_path) as f_in:
+                            f_out.writelines(f_in)
+                        os.remove(shard_mistakes_path)
+        dist.destroy_process_group()
+
     print(acc.compute_metric())
     metric_path = os.path.join(os.path.dirname(pred_output_path), "metrics.json")
     with open(metric_path, "w") as f:
@@ -21,6 +21,8 @@ from peft import (
 )
 from transformers import LlamaForCausalLM, LlamaTokenizer
 
+from preprocess import load_or_build
+from utils.packing import PackedDataCollator, pack_dataset, token_utilization
 from utils.prompter import Prompter
 
 
@@ -47,6 +49,7 @@ def train(
     # llm hyperparams
     train_on_inputs: bool = False,  # if False, masks out inputs in loss
     group_by_length: bool = False,  # faster, but produces an odd training loss curve
+    packing: bool = False,  # pack several examples into each row of cutoff_len tokens
     # wandb params
     wandb_project: str = "",
     wandb_run_name: str = "",
@@ -54,6 +57,8 @@ def train(
     wandb_log_model: str = "",  # options: false | true
     resume_from_checkpoint: str = None,  # either training checkpoint or final adapter
     prompt_template_name: str = "cogs",  # The prompt template to use, will default to alpaca.
+    tokenized_cache_dir: str = "",  # if set, load (or build once) the pre-tokenized dataset from here
+    num_proc: int = None,  # workers used when building the tokenized dataset
     seed: int = 0,
 ):
     torch.manual_seed(seed)
@@ -76,12 +81,14 @@ def train(
             f"lora_target_modules: {lora_target_modules}\n"
             f"train_on_inputs: {train_on_inputs}\n"
             f"group_by_length: {group_by_length}\n"
+            f"packing: {packing}\n"
             f"wandb_project: {wandb_project}\n"
             f"wandb_run_name: {wandb_run_name}\n"
             f"wandb_watch: {wandb_watch}\n"
             f"wandb_log_model: {wandb_log_model}\n"
             f"resume_from_checkpoint: {resume_from_checkpoint or False}\n"
             f"prompt template: {prompt_template_name}\n"
+            f"tokenized_cache_dir: {tokenized_cache_dir or False}\n"
         )
     assert (
         base_model
@@ -181,7 +188,20 @@ def train(
     )
     model = get_peft_model(model, config)
 
-    if data_path.endswith(".json") or data_path.endswith(".jsonl"):
+    if tokenized_cache_dir:
+        # already tokenized and label-masked, prepare_split only shuffles it
+        data = {
+            "train": load_or_build(
+                data_path,
+                base_model,
+                cache_dir=tokenized_cache_dir,
+                prompt_template_name=prompt_template_name,
+                cutoff_len=cutoff_len,
+                train_on_inputs=train_on_inputs,
+                num_proc=num_proc,
+            )
+        }
+    elif data_path.endswith(".json") or data_path.endswith(".jsonl"):
         data = load_dataset("json", data_files=data_path)
     else:
         data = load_dataset(data_path)
@@ -208,20 +228,39 @@ def train(
 
     model.print_trainable_parameters()  # Be more transparent about the % of trainable params.
 
+    def prepare_split(split):
+        if tokenized_cache_dir:
+            return split.shuffle()
+        return split.shuffle().map(generate_and_tokenize_prompt)
+
     if val_set_size > 0:
         train_val = data["train"].train_test_split(
             test_size=val_set_size, shuffle=True, seed=42
         )
-        train_data = (
-            train_val["train"].shuffle().map(generate_and_tokenize_prompt)
-        )
-        val_data = (
-            train_val["test"].shuffle().map(generate_and_tokenize_prompt)
-        )
+        train_data = prepare_split(train_val["train"])
+        val_data = prepare_split(train_val["test"])
     else:
-        train_data = data["train"].shuffle().map(generate_and_tokenize_prompt)
+        train_data = prepare_split(data["train"])
         val_data = None
 
+    if packing:
+        padded_lengths = [len(ids) for ids in train_data["input_ids"]]
+        train_data = pack_dataset(train_data, cutoff_len)
+        if val_data is not None:
+            val_data = pack_dataset(val_data, cutoff_len)
+        if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+            packed_lengths = [len(ids) for ids in train_data["input_ids"]]
+            print(
+                f"Packed {len(padded_lengths)} examples into {len(packed_lengths)} rows, "
+                f"token utilization {token_utilization(padded_lengths, micro_batch_size):.1%} "
+                f"(padded) -> {token_utilization(packed_lengths, micro_batch_size):.1%} (packed)"
+            )
+        data_collator = PackedDataCollator(pad_token_id=tokenizer.pad_token_id)
+    else:
+        data_collator = transformers.DataCollatorForSeq2Seq(
+            tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True
+        )
+
     if not ddp and torch.cuda.device_count() > 1:
         # keeps Trainer from trying its own DataParallelism when more than 1 gpu is available
         model.is_parallelizable = True
@@ -249,12 +288,12 @@ def train(
             load_best_model_at_end=True if val_set_size > 0 else False,
             ddp_find_unused_parameters=False if ddp else None,
             group_by_length=group_by_length,
+            # position_ids are not in the peft forward signature and would be dropped
+            remove_unused_columns=not packing,
             report_to="wandb" if use_wandb else None,
             run_name=wandb_run_name if use_wandb else None,
         ),
-        data_collator=transformers.DataCollatorForSeq2Seq(
-            tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True
-        ),
+        data_collator=data_collator,
     )
     model.config.use_cache = False
 
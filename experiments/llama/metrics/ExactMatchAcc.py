@@ -1,34 +1,147 @@
+import re
+
+import numpy as np
+
+
+def _sort_named_arguments(tokens):
+    # recursively sorts "role = value" arguments inside brackets; positional
+    # arguments such as "( x _ 3 , x _ 1 )" keep their order
+    output = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] != "(":
+            output.append(tokens[i])
+            i += 1
+            continue
+        depth, args, start = 0, [], i + 1
+        for j in range(i, len(tokens)):
+            if tokens[j] == "(":
+                depth += 1
+            elif tokens[j] == ")":
+                depth -= 1
+                if depth == 0:
+                    break
+            elif tokens[j] == "," and depth == 1:
+                args.append(tokens[start:j])
+                start = j + 1
+        else:
+            # unbalanced brackets, leave the rest untouched
+            return output + tokens[i:]
+        args.append(tokens[start:j])
+        args = [_sort_named_arguments(arg) for arg in args]
+        if all("=" in arg for arg in args):
+            args = sorted(args)
+        output.append("(")
+        output += " , ".join(" ".join(arg) for arg in args).split()
+        output.append(")")
+        i = j + 1
+    return output
+
+
+def order_invariant_form(lf):
+    """
+    Canonical form of a logical form that ignores the order of conjuncts
+    (COGS LF) and of named arguments (variable-free LF).
+    """
+    conjuncts = re.split(r" AND | ; ", lf.strip())
+    conjuncts = [" ".join(_sort_named_arguments(c.split())) for c in conjuncts]
+    return " AND ".join(sorted(conjuncts))
 
 
 class ExactMatchAcc:
-    def __init__(self):
+    def __init__(self, quiet=False, mistakes_path=None, order_invariant=True):
         self.results = {}
         self.gold_num = 0
         self.corr_num = 0
+        self.unordered_corr_num = 0
+        self.quiet = quiet
+        self.order_invariant = order_invariant
+        self.mistakes_path = mistakes_path
+        self._mistakes_file = None
 
     def add_batch(self, pred, gold, gen_types=None):
-        for i in range(len(pred)):
-            if pred[i] == gold[i]:
-                self.corr_num += 1
-            else:
-                print("PRED: {}".format(pred[i]))
-                print("GOLD: {}".format(gold[i]))
-
-            if gen_types is not None:
-                gen_type = gen_types[i]
+        pred = np.asarray(pred, dtype=object)
+        gold = np.asarray(gold, dtype=object)
+        correct = pred == gold
+        wrong = np.flatnonzero(~correct)
+
+        # strictly correct predictions are also correct up to order, so only
+        # the mismatches need to be canonicalized
+        unordered_correct = correct.copy()
+        if self.order_invariant:
+            for i in wrong:
+                unordered_correct[i] = order_invariant_form(pred[i]) == order_invariant_form(gold[i])
+
+        self.corr_num += int(correct.sum())
+        self.unordered_corr_num += int(unordered_correct.sum())
+        self.gold_num += len(pred)
+
+        if gen_types is not None:
+            types, inverse = np.unique(np.asarray(gen_types), return_inverse=True)
+            corr = np.bincount(inverse, weights=correct, minlength=len(types))
+            unordered_corr = np.bincount(inverse, weights=unordered_correct, minlength=len(types))
+            total = np.bincount(inverse, minlength=len(types))
+            for gen_type, c, u, t in zip(types.tolist(), corr, unordered_corr, total):
                 if gen_type not in self.results:
-                    self.results[gen_type] = [0, 0]
-                if pred[i] == gold[i]:
-                    self.results[gen_type][0] += 1
-                self.results[gen_type][1] += 1
+                    self.results[gen_type] = [0, 0, 0]
+                self.results[gen_type][0] += int(c)
+                self.results[gen_type][1] += int(t)
+                self.results[gen_type][2] += int(u)
+
+        if len(wrong) > 0:
+            self._log_mistakes(pred[wrong], gold[wrong],
+                               None if gen_types is None else [gen_types[i] for i in wrong])
+        if not self.quiet:
+            print(self.compute_metric())
+
+    def _log_mistakes(self, pred, gold, gen_types=None):
+        if not self.quiet:
+            for p, g in zip(pred, gold):
+                print("PRED: {}".format(p))
+                print("GOLD: {}".format(g))
+        if self.mistakes_path is None:
+            return
+        # the file is only created once the first mistake shows up
+        if self._mistakes_file is None:
+            self._mistakes_file = open(self.mistakes_path, "w")
+        if gen_types is None:
+            gen_types = [""] * len(pred)
+        self._mistakes_file.writelines(
+            "\t".join([p, g, t]) + "\n" for p, g, t in zip(pred, gold, gen_types)
+        )
+
+    def close(self):
+        if self._mistakes_file is not None:
+            self._mistakes_file.close()
+            self._mistakes_file = None
 
-            self.gold_num += 1
-        print(self.compute_metric())
+    def get_counts(self):
+        return {
+            "gold_num": self.gold_num,
+            "corr_num": self.corr_num,
+            "unordered_corr_num": self.unordered_corr_num,
+            "results": self.results,
+        }
 
+    def merge_counts(self, counts):
+        # adds the raw counts of another accumulator, e.g. one evaluation shard
+        self.gold_num += counts["gold_num"]
+        self.corr_num += counts["corr_num"]
+        self.unordered_corr_num += counts["unordered_corr_num"]
+        for gen_type, values in counts["results"].items():
+            if gen_type not in self.results:
+                self.results[gen_type] = [0, 0, 0]
+            for i, value in enumerate(values):
+                self.results[gen_type][i] += value
 
     def compute_metric(self):
         metric_dict = {}
         metric_dict["ACC"] = self.corr_num * 1.0 / self.gold_num
         for gen_type in self.results:
             metric_dict[gen_type] = self.results[gen_type][0] * 1.0 / self.results[gen_type][1]
-        return metric_dict
\ No newline at end of file
+        if self.order_invariant:
+            unordered = {"ACC": self.unordered_corr_num * 1.0 / self.gold_num}
+            for gen_type in self.results:
+                unordered[gen_type] = self.results[gen_type][2] * 1.0 / self.results[gen_type][1]
+            metric_dict["order_invariant"] = unordered
+        return metric_dict
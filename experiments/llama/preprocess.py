@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import os.path as osp
+
+import fire
+import numpy as np
+from datasets import load_dataset, load_from_disk
+from transformers import LlamaTokenizerFast
+
+from utils.prompter import Prompter
+
+
+def cached_dataset_path(
+    cache_dir: str,
+    data_path: str,
+    base_model: str,
+    prompt_template_name: str = "cogs",
+    cutoff_len: int = 256,
+    train_on_inputs: bool = False,
+) -> str:
+    # the cache is keyed by everything that changes the tokenized output:
+    # the raw data file, the prompt template, the tokenizer and cutoff_len
+    with open(osp.join("templates", f"{prompt_template_name}.json")) as fp:
+        template = json.load(fp)
+    key = json.dumps(
+        {
+            "data_path": osp.abspath(data_path),
+            "data_mtime": osp.getmtime(data_path) if osp.exists(data_path) else None,
+            "template": template,
+            "tokenizer": base_model,
+            "cutoff_len": cutoff_len,
+            "train_on_inputs": train_on_inputs,
+        },
+        sort_keys=True,
+    )
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    name = osp.splitext(osp.basename(data_path))[0]
+    return osp.join(cache_dir, f"{name}.{prompt_template_name}.{cutoff_len}.{digest}")
+
+
+def tokenize_dataset(
+    dataset,
+    tokenizer,
+    prompter: Prompter,
+    cutoff_len: int = 256,
+    train_on_inputs: bool = False,
+    num_proc: int = None,
+    batch_size: int = 1000,
+):
+    eos_token_id = tokenizer.eos_token_id
+
+    def tokenize_batch(batch):
+        user_prompts = [
+            prompter.generate_prompt(instruction, input)
+            for instruction, input in zip(batch["instruction"], batch["input"])
+        ]
+        full_prompts = [
+            f"{user_prompt}{output}"
+            for user_prompt, output in zip(user_prompts, batch["output"])
+        ]
+        # a single pass of the fast tokenizer; the offsets tell us where the
+        # user prompt ends, so it does not need to be tokenized a second time
+        result = tokenizer(
+            full_prompts,
+            truncation=True,
+            max_length=cutoff_len,
+            padding=False,
+            return_offsets_mapping=True,
+        )
+        input_ids, attention_mask, labels = [], [], []
+        for ids, offsets, user_prompt in zip(
+            result["input_ids"], result["offset_mapping"], user_prompts
+        ):
+            ids = np.asarray(ids, dtype=np.int64)
+            if ids[-1] != eos_token_id and len(ids) < cutoff_len:
+                ids = np.append(ids, eos_token_id)
+            label = ids.copy()
+            if not train_on_inputs:
+                starts = np.asarray(offsets, dtype=np.int64)[:, 0]
+                user_prompt_len = np.searchsorted(starts, len(user_prompt))
+                label[:user_prompt_len] = -100
+            input_ids.append(ids)
+            attention_mask.append(np.ones_like(ids))
+            labels.append(label)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels,
+        }
+
+    return dataset.map(
+        tokenize_batch,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+    )
+
+
+def load_or_build(
+    data_path: str,
+    base_model: str,
+    cache_dir: str = "data/tokenized",
+    prompt_template_name: str = "cogs",
+    cutoff_len: int = 256,
+    train_on_inputs: bool = False,
+    num_proc: int = None,
+):
+    path = cached_dataset_path(
+        cache_dir,
+        data_path,
+        base_model,
+        prompt_template_name=prompt_template_name,
+        cutoff_len=cutoff_len,
+        train_on_inputs=train_on_inputs,
+    )
+    if osp.exists(path):
+        # arrow files are memory-mapped, nothing is tokenized here
+        return load_from_disk(path)
+
+    tokenizer = LlamaTokenizerFast.from_pretrained(base_model)
+    prompter = Prompter(prompt_template_name)
+    if data_path.endswith(".json") or data_path.endswith(".jsonl"):
+        data = load_dataset("json", data_files=data_path)
+    else:
+        data = load_dataset(data_path)
+    tokenized = tokenize_dataset(
+        data["train"],
+        tokenizer,
+        prompter,
+        cutoff_len=cutoff_len,
+        train_on_inputs=train_on_inputs,
+        num_proc=num_proc,
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    tokenized.save_to_disk(path)
+    return load_from_disk(path)
+
+
+def main(
+    data_path: str = "data/cogs_LF/train.json",
+    base_model: str = "",
+    cache_dir: str = "data/tokenized",
+    prompt_template_name: str = "cogs",
+    cutoff_len: int = 256,
+    train_on_inputs: bool = False,
+    num_proc: int = None,
+):
+    assert (
+        base_model
+    ), "Please specify a --base_model, e.g. --base_model='yahma/llama-7b-hf'"
+    data = load_or_build(
+        data_path,
+        base_model,
+        cache_dir=cache_dir,
+        prompt_template_name=prompt_template_name,
+        cutoff_len=cutoff_len,
+        train_on_inputs=train_on_inputs,
+        num_proc=num_proc,
+    )
+    print(f"{len(data)} tokenized examples cached under {data.cache_files[0]['filename']}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
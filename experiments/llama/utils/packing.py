@@ -0,0 +1,113 @@
+"""
+Helpers to pack several tokenized examples into one training row.
+"""
+
+from typing import Dict, List
+
+import numpy as np
+import torch
+from datasets import Dataset
+
+
+def pack_dataset(dataset: Dataset, cutoff_len: int) -> Dataset:
+    # best-fit decreasing: every example goes into the fullest row that still has room.
+    # Rows are indexed by their remaining capacity, so a lookup costs at most cutoff_len steps.
+    lengths = np.asarray([len(ids) for ids in dataset["input_ids"]])
+    rows: List[List[int]] = []
+    rows_by_space: Dict[int, List[int]] = {}
+    for idx in np.argsort(-lengths, kind="stable"):
+        length = int(lengths[idx])
+        row_id = None
+        for space in range(length, cutoff_len + 1):
+            if rows_by_space.get(space):
+                row_id = rows_by_space[space].pop()
+                break
+        if row_id is None:
+            row_id = len(rows)
+            rows.append([])
+            space = cutoff_len
+        rows[row_id].append(int(idx))
+        rows_by_space.setdefault(space - length, []).append(row_id)
+
+    all_input_ids = dataset["input_ids"]
+    all_labels = dataset["labels"]
+    packed = {"input_ids": [], "labels": [], "position_ids": []}
+    for row in rows:
+        input_ids, labels, position_ids = [], [], []
+        for idx in row:
+            example_labels = list(all_labels[idx])
+            # the first token of an example must not be predicted from the previous one
+            example_labels[0] = -100
+            input_ids += all_input_ids[idx]
+            labels += example_labels
+            position_ids += range(len(all_input_ids[idx]))
+        packed["input_ids"].append(input_ids)
+        packed["labels"].append(labels)
+        packed["position_ids"].append(position_ids)
+    return Dataset.from_dict(packed)
+
+
+def token_utilization(lengths, batch_size: int, pad_to_multiple_of: int = 8) -> float:
+    # fraction of non-pad tokens when consecutive rows are batched and padded to the longest one
+    lengths = np.asarray(lengths)
+    if len(lengths) == 0:
+        return 0.0
+    n_batches = -(-len(lengths) // batch_size)
+    padded = np.zeros(n_batches * batch_size, dtype=np.int64)
+    padded[: len(lengths)] = lengths
+    longest = padded.reshape(n_batches, batch_size).max(axis=1)
+    longest = -(-longest // pad_to_multiple_of) * pad_to_multiple_of
+    batch_rows = np.full(n_batches, batch_size)
+    batch_rows[-1] = len(lengths) - (n_batches - 1) * batch_size
+    return float(lengths.sum() / (longest * batch_rows).sum())
+
+
+class PackedDataCollator(object):
+    """
+    Pads packed rows and builds a block-diagonal causal attention mask,
+    so tokens only attend to earlier tokens of the same example.
+    Requires a transformers version that accepts 4D attention masks.
+    """
+
+    def __init__(
+        self,
+        pad_token_id: int = 0,
+        pad_to_multiple_of: int = 8,
+        dtype: torch.dtype = torch.float16,
+    ):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.dtype = dtype
+
+    def __call__(self, features):
+        max_len = max(len(f["input_ids"]) for f in features)
+        max_len = -(-max_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        batch_size = len(features)
+
+        input_ids = torch.full((batch_size, max_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, max_len), -100, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, max_len), dtype=torch.long)
+        is_real = torch.zeros((batch_size, max_len), dtype=torch.bool)
+        for i, f in enumerate(features):
+            n = len(f["input_ids"])
+            input_ids[i, :n] = torch.as_tensor(f["input_ids"])
+            labels[i, :n] = torch.as_tensor(f["labels"])
+            position_ids[i, :n] = torch.as_tensor(f["position_ids"])
+            is_real[i, :n] = True
+
+        # segment ids start at 1 for each packed example, padding keeps 0
+        segments = torch.cumsum((position_ids == 0) & is_real, dim=1) * is_real
+        same_segment = segments[:, :, None] == segments[:, None, :]
+        causal = torch.tril(torch.ones((max_len, max_len), dtype=torch.bool))
+        allowed = same_segment & causal & is_real[:, None, :]
+        # padding queries attend to themselves, which keeps the softmax finite
+        allowed |= torch.eye(max_len, dtype=torch.bool)
+        attention_mask = torch.zeros((batch_size, 1, max_len, max_len), dtype=self.dtype)
+        attention_mask.masked_fill_(~allowed[:, None], torch.finfo(self.dtype).min)
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "attention_mask": attention_mask,
+        }